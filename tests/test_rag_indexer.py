@@ -0,0 +1,625 @@
+"""Testes do pipeline de build/consulta de tools/rag_indexer.py com embeddings determinísticos (sem download de modelo)."""
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+import time
+import sys
+from pathlib import Path
+from typing import List
+
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "tools"))
+import rag_indexer  # type: ignore  # noqa: E402
+from langchain_core.embeddings import Embeddings  # type: ignore  # noqa: E402
+
+SHARED = (
+    "Sempre registre as decisões de arquitetura no banco de memória antes de encerrar a tarefa, "
+    "incluindo contexto, alternativas avaliadas e a justificativa final da escolha."
+)
+
+
+class HashEmbeddings(Embeddings):
+    """Bag-of-words com hashing em 64 dimensões: determinístico e rápido."""
+
+    dim = 64
+
+    def _vec(self, text: str) -> List[float]:
+        v = [0.0] * self.dim
+        for tok in re.findall(r"\w+", text.lower()):
+            v[int(hashlib.md5(tok.encode("utf-8")).hexdigest(), 16) % self.dim] += 1.0
+        norm = sum(x * x for x in v) ** 0.5 or 1.0
+        return [x / norm for x in v]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._vec(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._vec(text)
+
+
+def _reset_planner(monkeypatch):
+    """Estado de classe do QueryPlanner limpo (custos padrão, nada carregado do disco)."""
+    for attr, value in (("_costs", dict(rag_indexer.DEADLINE_COST_DEFAULTS)), ("_skips", {}),
+                        ("_loaded", set()), ("_dirty", False), ("_saved_at", 0.0), ("_pending", None)):
+        monkeypatch.setattr(rag_indexer.QueryPlanner, attr, value)
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(rag_indexer, "_get_embeddings", lambda model_name=None: HashEmbeddings())
+    monkeypatch.setattr(rag_indexer, "_METRICS_FILE", str(tmp_path / ".rag" / "metrics.jsonl"))
+    rag_indexer._INDEX_CACHE.clear()
+    _reset_planner(monkeypatch)
+    rules = tmp_path / "rules"
+    rules.mkdir()
+    (rules / "behavioral-rules.md").write_text(f"# Memória\n\n{SHARED}\n", encoding="utf-8")
+    (rules / "todo2-rules.md").write_text(f"# Memória\n\n{SHARED}\n", encoding="utf-8")
+    yield tmp_path
+    rag_indexer._INDEX_CACHE.clear()
+
+
+def _build(root: Path, **kwargs):
+    return rag_indexer.build_index(
+        root=root,
+        index_path=root / ".rag" / "index",
+        model_name="hash",
+        include_dirs=[Path("rules")],
+        **kwargs,
+    )
+
+
+def test_dedup_keeps_chunks_with_different_filter_metadata(repo):
+    _build(repo, backend="faiss")
+    for step, name in (("step1", "behavioral-rules.md"), ("step3", "todo2-rules.md")):
+        docs = rag_indexer.query_index(
+            repo / ".rag" / "index", "decisões de arquitetura no banco de memória",
+            k=4, filter_step=step, model_name="hash",
+        )
+        assert docs, f"filtro {step} não encontrou o texto compartilhado"
+        assert all(d.metadata["step"] == step for d in docs)
+        assert any(p.endswith(name) for d in docs for p in rag_indexer._doc_file_paths(d))
+
+
+def test_chroma_rebuild_updates_metadata_of_existing_chunks(repo):
+    rule = repo / "rules" / "custom.mdc"
+    body = "# Revisão\n\nRevise cada pull request verificando testes, cobertura e impacto em desempenho.\n"
+    rule.write_text(f"---\ndescription: revisão\nalwaysApply: false\n---\n{body}", encoding="utf-8")
+    _build(repo, backend="chroma")
+    rule.write_text(f"---\ndescription: revisão\nalwaysApply: true\n---\n{body}", encoding="utf-8")
+    _build(repo, backend="chroma")
+    docs = rag_indexer.query_index(
+        repo / ".rag" / "index", "revise pull request testes cobertura",
+        k=4, filter_rule_type="always-apply", model_name="hash",
+    )
+    hits = [d for d in docs if "pull request" in d.page_content]
+    assert hits and all(d.metadata["always_apply"] for d in hits)
+
+
+def test_chroma_noop_rebuild_keeps_current_generation(repo):
+    index_path = repo / ".rag" / "index"
+    _build(repo, backend="chroma")
+    first = rag_indexer.current_generation(index_path)
+    _build(repo, backend="chroma")
+    assert rag_indexer.current_generation(index_path) == first
+    assert rag_indexer.list_generations(index_path) == [first]
+
+
+def test_semantic_cache_skips_results_of_failed_rerank(repo, monkeypatch):
+    _build(repo, backend="faiss")
+    cache = rag_indexer.configure_semantic_cache(path=None)
+    calls = []
+
+    def rerank(q, docs, top_n, timeout_s=None):
+        calls.append(q)
+        return docs if len(calls) == 1 else list(reversed(docs))  # 1ª chamada falha (ordem original)
+
+    monkeypatch.setattr(rag_indexer, "_google_rerank", rerank)
+    query = dict(q="decisões de arquitetura", rerank_llm="google", model_name="hash", semantic_cache_distance=0.05)
+    rag_indexer.query_index(repo / ".rag" / "index", **query)
+    assert cache.snapshot()["size"] == 0
+    rag_indexer.query_index(repo / ".rag" / "index", **query)
+    assert cache.snapshot()["size"] == 1 and len(calls) == 2
+
+
+def test_compact_keeps_deduplicated_chunk_while_a_source_exists(repo):
+    index_path = repo / ".rag" / "index"
+    (repo / "rules" / "notes-a.md").write_text(f"# Notas\n\n{SHARED} Notas.\n", encoding="utf-8")
+    text_b = f"# Prefácio\n\nContexto sobre filas de revisão.\n\n# Notas\n\n{SHARED} Notas.\n"
+    (repo / "rules" / "notes-b.md").write_text(text_b, encoding="utf-8")
+    _build(repo, backend="faiss")
+    docs = rag_indexer.query_index(index_path, "Notas decisões de arquitetura", k=6, model_name="hash")
+    notes = [d for d in docs if d.page_content.rstrip().endswith("Notas.")]
+    assert len(notes) == 1 and notes[0].metadata["file_path"].endswith("notes-a.md")
+    (repo / "rules" / "notes-a.md").unlink()
+
+    report = rag_indexer.inspect_index(index_path, model_name="hash", root=repo)
+    assert report["problems"]["chunks_from_missing_files"] == 0
+    assert report["problems"]["chunks_citing_missing_files"] == 1
+
+    rag_indexer.compact_index(index_path, model_name="hash", root=repo)
+    rag_indexer._INDEX_CACHE.clear()
+    docs = rag_indexer.query_index(index_path, "Notas decisões de arquitetura", k=6, model_name="hash")
+    notes = [d for d in docs if d.page_content.rstrip().endswith("Notas.")]
+    assert len(notes) == 1
+    assert rag_indexer._doc_file_paths(notes[0]) == [str(repo / "rules" / "notes-b.md")]
+    # offsets e seção passam a descrever o arquivo sobrevivente
+    meta = notes[0].metadata
+    assert meta["start_index"] == text_b.index("# Notas") > 0
+    assert text_b[meta["start_index"]:meta["end_index"]] == notes[0].page_content
+    assert meta["section_index"] == 1 and meta["header_path"] == "Notas" and meta["h1"] == "Notas"
+    assert rag_indexer.inspect_index(index_path, model_name="hash", root=repo)["healthy"]
+
+
+def test_repeated_text_at_different_offsets_is_not_a_duplicate(repo):
+    (repo / "rules" / "repeat.md").write_text(f"# Nota\n\n{SHARED}\n# Nota\n\n{SHARED}\n", encoding="utf-8")
+    _build(repo, backend="faiss", dedup=False)
+    report = rag_indexer.inspect_index(repo / ".rag" / "index", model_name="hash", root=repo)
+    assert report["problems"]["duplicate_entries"] == 0
+    assert report["healthy"]
+
+
+def test_governor_abort_publishes_nothing(repo):
+    index_path = repo / ".rag" / "index"
+    governor = rag_indexer.BuildGovernor(max_memory_mb=1)
+    with pytest.raises(rag_indexer.BuildAborted):
+        _build(repo, backend="auto", governor=governor)
+    assert rag_indexer.current_generation(index_path) is None
+    assert rag_indexer.list_generations(index_path) == []
+    assert not any((index_path / rag_indexer.GENERATIONS_DIR).iterdir())
+
+
+def test_failed_rerank_does_not_feed_planner_cost(repo, monkeypatch):
+    _build(repo, backend="faiss")
+
+    def failing(q, docs, top_n, timeout_s=None):
+        time.sleep(0.05)
+        return docs  # falha: ordem original
+
+    monkeypatch.setattr(rag_indexer, "_google_rerank", failing)
+    rag_indexer.query_index(repo / ".rag" / "index", "memória", rerank_llm="google", model_name="hash")
+    assert rag_indexer.QueryPlanner.estimate("rerank") == rag_indexer.DEADLINE_COST_DEFAULTS["rerank"]
+
+
+def test_switching_faiss_to_chroma_publishes_only_chroma(repo):
+    index_path = repo / ".rag" / "index"
+    _build(repo, backend="faiss")
+    (repo / "rules" / "todo2-rules.md").write_text("# Tarefas\n\nTexto novo sobre filas de tarefas pendentes.\n", encoding="utf-8")
+    _build(repo, backend="chroma")
+    gen_dir = rag_indexer.resolve_index_dir(index_path)
+    assert not (gen_dir / "index.faiss").exists() and not (gen_dir / "index.pkl").exists()
+    rag_indexer._INDEX_CACHE.clear()
+    _, backend, _ = rag_indexer.load_index(index_path, model_name="hash")
+    assert backend == "chroma"
+    docs = rag_indexer.query_index(index_path, "filas de tarefas pendentes", k=4, model_name="hash")
+    assert any("Texto novo" in d.page_content for d in docs)
+
+
+def test_pca_projection_round_trip_on_low_rank_vectors():
+    import numpy as np
+
+    rng = np.random.default_rng(1)
+    X = rng.standard_normal((50, 8)) @ rng.standard_normal((8, 64))  # posto 8 em 64 dimensões
+    proj = rag_indexer.fit_projection(X, 8, method="pca")
+    assert proj["components"].shape == (64, 8)
+    lifted = rag_indexer.lift_projection(proj, rag_indexer.apply_projection(proj, X))
+    assert np.allclose(lifted, X, atol=1e-3)
+    assert proj["variance_retained"] == pytest.approx(1.0, abs=1e-4)
+    assert rag_indexer.projection_recall(X, proj) == 1.0
+
+
+def test_pca_clamps_target_dim_to_sample_count():
+    import numpy as np
+
+    proj = rag_indexer.fit_projection(np.random.default_rng(2).standard_normal((3, 64)), 16, method="pca")
+    assert proj["components"].shape == (64, 3)
+
+
+def test_reduced_index_answers_queries(repo):
+    index_path = repo / ".rag" / "index"
+    (repo / "rules" / "review.md").write_text("# Revisão\n\nRevise cada pull request com testes.\n", encoding="utf-8")
+    _build(repo, backend="faiss", reduce_dim=16)
+    proj = rag_indexer.load_projection(rag_indexer.resolve_index_dir(index_path))
+    assert proj is not None and proj["components"].shape[0] == 64
+    # poucos chunks: o PCA fica abaixo de 16 dimensões e as métricas registram a dimensão real
+    metrics = [json.loads(line) for line in (repo / ".rag" / "metrics.jsonl").read_text(encoding="utf-8").splitlines()]
+    build = [m for m in metrics if m["type"] == "build"][-1]
+    assert build["projection"]["target_dim"] == proj["components"].shape[1] < 16
+    docs = rag_indexer.query_index(index_path, "revise pull request testes", k=1, model_name="hash")
+    assert "pull request" in docs[0].page_content
+
+
+@pytest.mark.parametrize("options", [{"reduce_dim": 64}, {"reduce_dim": 16, "reduce_method": "svd"}])
+def test_invalid_projection_options_are_not_swallowed_by_fallback(repo, options):
+    index_path = repo / ".rag" / "index"
+    with pytest.raises(ValueError):
+        _build(repo, backend="auto", **options)
+    assert rag_indexer.current_generation(index_path) is None
+
+
+class _GeminiStandIn:
+    """Servidor HTTP local que imita `generateContent`: modos ok (ordem invertida), slow e error."""
+
+    def __init__(self) -> None:
+        import http.server
+        import threading
+
+        self.mode = "ok"
+        self.delay_s = 0.0
+        self.hits = 0
+        self.inflight = 0
+        self.max_inflight = 0
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                prompt = body["contents"][0]["parts"][0]["text"]
+                with stand_in.lock:
+                    stand_in.hits += 1
+                    stand_in.inflight += 1
+                    stand_in.max_inflight = max(stand_in.max_inflight, stand_in.inflight)
+                try:
+                    time.sleep(stand_in.delay_s if stand_in.mode != "slow" else 1.0)
+                    if stand_in.mode == "error":
+                        self.send_response(500)
+                        self.end_headers()
+                        return
+                    n = len(re.findall(r"^\[\d+\]", prompt, flags=re.M))
+                    text = ",".join(str(i) for i in range(n, 0, -1))
+                    payload = json.dumps({"candidates": [{"content": {"parts": [{"text": text}]}}]}).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                finally:
+                    with stand_in.lock:
+                        stand_in.inflight -= 1
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    stand_in = _GeminiStandIn()
+    monkeypatch.setenv("RAG_RERANK_ENDPOINT", stand_in.url)
+    monkeypatch.delenv("GOOGLE_API_KEY", raising=False)
+    yield stand_in
+    stand_in.server.shutdown()
+    stand_in.server.server_close()
+
+
+def _docs(*texts):
+    return [rag_indexer.Document(page_content=t, metadata={"chunk_id": f"c{i}"}) for i, t in enumerate(texts)]
+
+
+def test_remote_rerank_reorders_and_caches(gemini):
+    reranker = rag_indexer._RemoteReranker()
+    docs = _docs("a", "b", "c")
+    assert [d.page_content for d in reranker.rerank("q", docs, top_n=2)] == ["c", "b"]
+    assert [d.page_content for d in reranker.rerank("q", docs, top_n=2)] == ["c", "b"]
+    assert gemini.hits == 1 and reranker.stats["cache_hits"] == 1
+
+
+def test_remote_rerank_timeout_keeps_original_order(gemini):
+    gemini.mode = "slow"
+    reranker = rag_indexer._RemoteReranker()
+    docs = _docs("a", "b")
+    t0 = time.perf_counter()
+    assert reranker.rerank("q", docs, timeout_s=0.2) is docs
+    assert time.perf_counter() - t0 < 0.8
+    assert reranker.stats["timeouts"] == 1
+
+
+def test_remote_rerank_breaker_opens_and_half_opens(gemini):
+    gemini.mode = "error"
+    reranker = rag_indexer._RemoteReranker(breaker_failures=2, breaker_cooldown_s=0.2)
+    docs = _docs("a", "b")
+    for i in range(2):
+        assert reranker.rerank(f"q{i}", docs) is docs
+    assert reranker.stats["errors"] == 2
+    assert reranker.rerank("q2", docs) is docs
+    assert gemini.hits == 2 and reranker.stats["short_circuits"] == 1  # aberto: nem chega ao servidor
+    time.sleep(0.25)
+    assert reranker.rerank("q3", docs) is docs  # meio-aberto: uma falha reabre o circuito
+    assert reranker.rerank("q4", docs) is docs
+    assert gemini.hits == 3 and reranker.stats["short_circuits"] == 2
+    time.sleep(0.25)
+    gemini.mode = "ok"
+    assert [d.page_content for d in reranker.rerank("q5", docs)] == ["b", "a"]
+    assert [d.page_content for d in reranker.rerank("q6", docs)] == ["b", "a"]  # fechado de novo
+    assert gemini.hits == 5
+
+
+def test_google_rerank_many_respects_concurrency(gemini, monkeypatch):
+    gemini.delay_s = 0.1
+    monkeypatch.setattr(rag_indexer, "_RERANKER", rag_indexer._RemoteReranker(concurrency=2))
+    items = [(f"q{i}", _docs("a", "b", "c"), None) for i in range(6)]
+    results = rag_indexer._google_rerank_many(items)
+    assert all([d.page_content for d in r] == ["c", "b", "a"] for r in results)
+    assert gemini.hits == 6 and gemini.max_inflight == 2
+
+
+def test_eval_latency_includes_batched_rerank_per_timeout(repo, monkeypatch):
+    import rag_eval  # type: ignore
+
+    _build(repo, backend="faiss")
+    batches = []
+
+    def rerank_many(items, timeout_s=None):
+        batches.append((timeout_s, len(items)))
+        time.sleep(0.2)
+        return [list(reversed(docs)) for _, docs, _ in items]
+
+    monkeypatch.setattr(rag_eval, "_google_rerank_many", rerank_many)
+    common = {"index_path": str(repo / ".rag" / "index"), "root": str(repo), "model": "hash", "rerank_timeout": 3.0}
+    cases = [
+        {"name": "padrão", "q": "decisões de arquitetura", "rerank_llm": "google"},
+        {"name": "curto", "q": "memória", "rerank_llm": "google", "rerank_timeout": 0.5},
+    ]
+    results, _ = rag_eval.evaluate(cases, common, workers=2, rerank_timeout=3.0)
+    assert sorted(batches) == [(0.5, 1), (3.0, 1)]
+    assert all(r["latency_ms"] >= 200 for r in results)
+
+
+def test_planner_probes_skipped_rerank_and_persists_costs(repo, monkeypatch):
+    index_path = repo / ".rag" / "index"
+    _build(repo, backend="faiss")
+    monkeypatch.setattr(rag_indexer, "DEADLINE_PROBE_EVERY", 3)
+    calls = []
+
+    def rerank(q, docs, top_n, timeout_s=None):
+        calls.append(q)
+        time.sleep(0.02)
+        return list(reversed(docs))
+
+    monkeypatch.setattr(rag_indexer, "_google_rerank", rerank)
+    query = dict(rerank_llm="google", model_name="hash", deadline_ms=800)
+    for i in range(3):  # estimativa padrão (1500 ms) > prazo: pula duas vezes, a terceira é sonda
+        rag_indexer.query_index(index_path, f"memória {i}", **query)
+    assert len(calls) == 1
+    learned = rag_indexer.QueryPlanner.estimate("rerank")
+    assert learned < 800
+    saved = json.loads((index_path / rag_indexer.PLANNER_COSTS_FILE).read_text(encoding="utf-8"))
+    assert saved["rerank"] == pytest.approx(learned, abs=1e-3)
+
+    # novo processo: a média móvel volta do disco e o rerank cabe no prazo sem esperar outra sonda
+    _reset_planner(monkeypatch)
+    rag_indexer.query_index(index_path, "memória 3", **query)
+    assert len(calls) == 2
+
+
+def test_search_stage_excludes_facet_and_hierarchy_loading(repo):
+    index_path = repo / ".rag" / "index"
+    _build(repo, backend="faiss")
+    rag_indexer.query_index(index_path, "memória", always_apply=True, hierarchical_sections=2, model_name="hash")
+    metrics = [json.loads(line) for line in (repo / ".rag" / "metrics.jsonl").read_text(encoding="utf-8").splitlines()]
+    stages = [m for m in metrics if m["type"] == "query"][-1]["stages_ms"]
+    assert {"facets", "hierarchy", "search"} <= set(stages)
+
+
+def test_relocate_drops_positions_when_text_is_only_a_near_duplicate(tmp_path):
+    (tmp_path / "b.md").write_text(f"## Notas\n\n{SHARED}\n", encoding="utf-8")
+    meta = {"file_path": "a.md", "start_index": 0, "end_index": 10, "section_index": 0, "header_path": "Notas", "h1": "Notas"}
+    rag_indexer._relocate_chunk(meta, f"# Notas\n\n{SHARED} Fim.", "b.md", tmp_path)
+    assert not set(rag_indexer._POSITION_KEYS) & set(meta)
+    assert rag_indexer._merge_spans([rag_indexer.Document(page_content="x", metadata=meta)])[0]["section"] is None
+
+
+def test_group_build_resolves_manifest_paths_and_federates(repo):
+    docs_dir = repo / "docs"
+    docs_dir.mkdir()
+    (docs_dir / "deploy.md").write_text("# Deploy\n\nPublique a versão com tags semânticas após a revisão.\n", encoding="utf-8")
+    conf = repo / "conf"
+    conf.mkdir()
+    manifest = conf / "groups.yaml"
+    manifest.write_text(
+        "groups:\n"
+        "  all:\n"
+        "    indexes:\n"
+        "      - {index_path: ../.rag/rules, include_dirs: [rules]}\n"
+        "      - {index_path: ../.rag/docs, include_dirs: [docs], backend: faiss}\n",
+        encoding="utf-8",
+    )
+    results = rag_indexer.build_index_group(manifest, "all", root=repo, model_name="hash", backend="chroma")
+    rules_idx, docs_idx = (repo / ".rag" / "rules").resolve(), (repo / ".rag" / "docs").resolve()
+    assert [(Path(p).resolve(), be) for p, be, _ in results] == [(rules_idx, "chroma"), (docs_idx, "faiss")]
+
+    docs = rag_indexer.query_index(
+        rules_idx, "publique versão tags decisões de arquitetura", k=4,
+        extra_index_paths=[docs_idx], model_name="hash",
+    )
+    sources = {Path(p).name for d in docs for p in rag_indexer._doc_file_paths(d)}
+    assert "deploy.md" in sources and sources & {"behavioral-rules.md", "todo2-rules.md"}
+
+
+def test_governor_yields_to_queries_on_its_own_index(repo, monkeypatch):
+    index_path = repo / ".rag" / "index"
+    _build(repo, backend="faiss")
+    elsewhere = repo / "elsewhere"
+    elsewhere.mkdir()
+    monkeypatch.chdir(elsewhere)
+    rag_indexer.query_index(index_path, "memória", model_name="hash")
+    assert (index_path / rag_indexer.QUERY_HEARTBEAT_FILE).exists()
+    assert not (elsewhere / ".rag").exists()
+
+    monkeypatch.chdir(repo)
+    governor = rag_indexer.BuildGovernor(yield_to_queries=True, max_pause_s=0.1)
+    (repo / "rules" / "extra.md").write_text("# Extra\n\nTexto novo para forçar embedding.\n", encoding="utf-8")
+    _build(repo, backend="faiss", governor=governor, embed_workers=2)
+    metrics = [json.loads(line) for line in (repo / ".rag" / "metrics.jsonl").read_text(encoding="utf-8").splitlines()]
+    build = [m for m in metrics if m["type"] == "build"][-1]
+    assert build["governor"]["pauses"] >= 1
+    assert build["embed"]["workers"] == 1 and build["embed"]["workers_requested"] == 2
+
+
+def test_dedup_collapses_md_and_mdc_copies_of_a_rule(repo):
+    index_path = repo / ".rag" / "index"
+    body = "# Ferramentas\n\nUse sempre o linter do projeto e rode a suíte de testes antes de abrir o pull request.\n"
+    (repo / "rules" / "tools-rules.md").write_text(body, encoding="utf-8")
+    (repo / "rules" / "cursor").mkdir()
+    (repo / "rules" / "cursor" / "tools-rules.mdc").write_text(
+        f"---\ndescription: ferramentas\nglobs: src/**/*.ts\n---\n{body}", encoding="utf-8"
+    )
+    _build(repo, backend="faiss")
+    docs = rag_indexer.query_index(index_path, "linter suíte de testes pull request", k=6, model_name="hash")
+    hits = [d for d in docs if "linter" in d.page_content]
+    assert len(hits) == 1
+    assert sorted(Path(p).name for p in rag_indexer._doc_file_paths(hits[0])) == ["tools-rules.md", "tools-rules.mdc"]
+    scoped = rag_indexer.query_index(index_path, "linter testes", k=6, applies_to="src/app.ts", model_name="hash")
+    assert any("linter" in d.page_content for d in scoped)
+
+
+def _span_doc(text, fp, start, section=0):
+    meta = {"file_path": fp, "start_index": start, "end_index": start + len(text), "section_index": section}
+    return rag_indexer.Document(page_content=text, metadata=meta)
+
+
+def test_pack_context_merges_overlapping_chunks_without_repeating_overlap():
+    source = "".join(f"linha {i} sobre decisões de arquitetura\n" for i in range(12))
+    a, b = source[0:200], source[150:400]
+    other = _span_doc("Outra seção com conteúdo bem diferente.", "a.md", 500, section=1)
+    legacy = rag_indexer.Document(page_content="Chunk de índice antigo sem offsets.", metadata={"file_path": "a.md"})
+    spans, stats = rag_indexer.pack_context([_span_doc(b, "a.md", 150), other, _span_doc(a, "a.md", 0), legacy], budget_tokens=None)
+    merged = [sp for sp in spans if sp["chunks"] == 2]
+    assert len(merged) == 1 and merged[0]["text"] == source[0:400]
+    assert merged[0]["rel"] == 1.0  # herda a melhor posição entre os chunks fundidos
+    assert stats["spans"] == 3 and stats["spans_packed"] == 3
+
+
+def test_pack_context_respects_budget_and_drops_redundant_spans():
+    texts = [f"Tópico {i}: " + " ".join(f"palavra{i}x{j}" for j in range(60)) + "\nfim\n" for i in range(6)]
+    docs = [_span_doc(t, f"f{i}.md", 0) for i, t in enumerate(texts)]
+    docs.insert(1, _span_doc(texts[0], "copia.md", 0))  # mesmo texto em outro arquivo: redundante
+    spans, stats = rag_indexer.pack_context(docs, budget_tokens=300)
+    assert stats["packed_tokens"] <= 300 and stats["truncated"] == 1
+    assert spans[0]["file_path"] == "f0.md"
+    assert all(sp["file_path"] != "copia.md" for sp in spans)
+    assert stats["spans_packed"] < len(texts)
+
+
+def _hash_worker_init(model_name, threads):
+    """Inicializador dos processos de embedding nos testes: HashEmbeddings no lugar do modelo HF."""
+    rag_indexer._WORKER_EMBEDDINGS = HashEmbeddings()
+
+
+def test_embed_parallel_matches_serial_vectors(monkeypatch):
+    import numpy as np
+
+    monkeypatch.setattr(rag_indexer, "_get_embeddings", lambda model_name=None: HashEmbeddings())
+    monkeypatch.setattr(rag_indexer, "_embed_worker_init", _hash_worker_init)
+    texts = [f"chunk {i} sobre {SHARED.split()[i % 20]} e tarefa {i * 7}" for i in range(300)]
+    serial, info1 = rag_indexer.embed_parallel(texts, "hash", workers=1)
+    parallel, info2 = rag_indexer.embed_parallel(texts, "hash", workers=2, threads_per_worker=1)
+    assert info1["workers"] == 1 and info2["workers"] == 2
+    assert parallel.shape == serial.shape == (300, HashEmbeddings.dim)
+    assert np.array_equal(parallel, serial)
+
+
+def test_hierarchical_query_searches_only_the_closest_section(repo):
+    index_path = repo / ".rag" / "index"
+    (repo / "rules" / "ops.md").write_text(
+        "# Deploy\n\nPublique a versão com tags semânticas e changelog.\n\n"
+        "# Incidentes\n\nAbra um incidente, acione o plantão e registre a linha do tempo.\n",
+        encoding="utf-8",
+    )
+    (repo / "rules" / "style.md").write_text("# Estilo\n\nUse nomes descritivos e funções curtas.\n", encoding="utf-8")
+    _build(repo, backend="faiss")
+    hier = rag_indexer.load_hierarchy(rag_indexer.resolve_index_dir(index_path))
+    assert {(Path(s["file_path"]).name, s["header_path"]) for s in hier["sections"]} >= {
+        ("ops.md", "Deploy"), ("ops.md", "Incidentes"), ("style.md", "Estilo"),
+    }
+
+    q = "acione o plantão e registre a linha do tempo do incidente"
+    docs = rag_indexer.query_index(index_path, q, k=4, hierarchical_sections=1, model_name="hash")
+    assert docs and all(d.metadata.get("header_path") == "Incidentes" for d in docs)
+    metrics = [json.loads(line) for line in (repo / ".rag" / "metrics.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert [m for m in metrics if m["type"] == "query"][-1]["hierarchical"] == {"sections": 1, "candidates": len(docs)}
+
+    flat = rag_indexer.query_index(index_path, q, k=4, model_name="hash")
+    assert len(flat) > len(docs)  # a busca plana considera o corpus inteiro
+
+
+def test_chunk_offsets_cover_every_character_of_the_source():
+    body = " ".join(f"palavra{i}" for i in range(400))
+    text = (
+        "---\ndescription: regras\n---\n"
+        "# Título\n\nIntro com acentuação: ação, memória.\n\n"
+        "## Código\n\n```bash\n# não é cabeçalho\necho ok\n```\n\n"
+        f"### Longo\n\n{body}\n"
+    )
+    doc = rag_indexer.Document(page_content=text, metadata={"file_path": "r.md"})
+    sections = rag_indexer.split_markdown([doc])
+    assert [s.headers[-1][1] if s.headers else None for s in sections] == [None, "Título", "Código", "Longo"]
+    assert sections[0].start == 0 and sections[-1].end == len(text)
+    for prev, nxt in zip(sections, sections[1:]):
+        assert prev.end == nxt.start  # seções contíguas: nenhum caractere perdido entre elas
+
+    chunks = rag_indexer.split_char(sections, chunk_size=200, chunk_overlap=40)
+    assert len(chunks) > len(sections)
+    covered = [False] * len(text)
+    for c in chunks:
+        d = c.to_document()
+        assert d.page_content == text[c.start:c.end] == text[d.metadata["start_index"]:d.metadata["end_index"]]
+        for i in range(c.start, c.end):
+            covered[i] = True
+    assert all(covered[i] or text[i].isspace() for i in range(len(text)))
+    assert all(c.src is sections[0].src for c in chunks)  # um único buffer por arquivo
+
+
+class _StopWatch(Exception):
+    pass
+
+
+def _run_watch_once(repo, monkeypatch):
+    """Executa o watch até a primeira espera (inicialização + eventual rebuild de recuperação); retorna as métricas."""
+    def stop(_s):
+        raise _StopWatch()
+
+    with monkeypatch.context() as m, pytest.raises(_StopWatch):
+        m.setattr(rag_indexer.time, "sleep", stop)
+        rag_indexer._watch_loop(
+            repo, repo / ".rag" / "index", "hash", 800, 120, [Path("rules")], set(),
+            set(rag_indexer.INCLUDE_EXTS), None, interval=0.2, quiet=True, backend="faiss",
+        )
+    return [json.loads(line) for line in (repo / ".rag" / "metrics.jsonl").read_text(encoding="utf-8").splitlines()]
+
+
+def test_watch_catches_up_from_journal_reusing_vectors(repo, monkeypatch):
+    index_path = repo / ".rag" / "index"
+
+    metrics = _run_watch_once(repo, monkeypatch)
+    first = rag_indexer.current_generation(index_path)
+    assert [m for m in metrics if m["type"] == "watch_build"][-1]["full"] is True
+
+    # mudanças com o watch parado: um arquivo alterado e um novo
+    (repo / "rules" / "todo2-rules.md").write_text("# Tarefas\n\nFila de tarefas pendentes revisada.\n", encoding="utf-8")
+    (repo / "rules" / "new.md").write_text("# Novo\n\nRegra nova sobre revisão de código.\n", encoding="utf-8")
+    metrics = _run_watch_once(repo, monkeypatch)
+    watch = [m for m in metrics if m["type"] == "watch_build"][-1]
+    assert (watch["catch_up"], watch["full"], watch["reused_vectors"]) == (True, False, True)
+    assert (watch["created"], watch["changed"], watch["deleted"]) == (1, 1, 0)
+    build = [m for m in metrics if m["type"] == "build"][-1]
+    assert build["embed"]["reused"] >= 1 and build["embed"]["chunks"] == 2  # só os chunks novos são embutidos
+    second = rag_indexer.current_generation(index_path)
+    assert second != first
+
+    # vetores reaproveitados são os mesmos de um embedding completo
+    vecs = rag_indexer._generation_vectors(index_path, HashEmbeddings())
+    rag_indexer._INDEX_CACHE.clear()
+    vs, _, _ = rag_indexer.load_index(index_path, embeddings=HashEmbeddings())
+    for cid, doc in vs.docstore._dict.items():
+        assert vecs[cid] == pytest.approx(HashEmbeddings().embed_query(doc.page_content), abs=1e-6)
+
+    _run_watch_once(repo, monkeypatch)  # sem mudanças: journal em dia, nenhuma geração nova
+    assert rag_indexer.current_generation(index_path) == second
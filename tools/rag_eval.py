@@ -1,26 +1,53 @@
 """
-Simple harness to evaluate RAG retrieval against YAML cases.
+Evaluation harness for RAG retrieval against YAML cases.
 
 Usage:
   ${workspaceFolder}/.venv/Scripts/python.exe tools/rag_eval.py --index-path .rag/index.vscode --profile vscode --cases tests/rag-cases.yaml
 
+  # Compare parameter sets / indexes in one report (variant > case > common)
+  python tools/rag_eval.py --index-path .rag/index.vscode --cases tests/rag-cases.yaml --workers 8 \
+      --variant base: --variant lambda07:lambda_mult=0.7,fetch_k=40 \
+      --variant chunk400:index_path=.rag/index.c400 --report .rag/eval-report.json
+
 It will:
 - Load test cases from YAML
-- Run queries through tools/rag_indexer.py (importing its functions)
-- Check expectations (min_results, step filter expectation, contains substrings)
-- Print a compact report and write metrics via rag_indexer _write_metrics
+- Run queries concurrently through tools/rag_indexer.py (importing its functions) against a
+  shared, once-loaded index
+- Rerank cases that ask for it (rerank_llm) in concurrent, timeout-bounded batches, one per
+  rerank_timeout value; each case's latency includes its share of its batch's time
+  (cases with deadline_ms rerank inside the query, where the deadline planner can skip it)
+- Check expectations (min_results, contains substrings)
+- Score retrieval quality against labels (relevant_files / relevant_ids): recall@k, MRR, nDCG@k
+- Record per-case latency and report p50/p90/p95/p99 per run
+- Print a compact report (plus a comparison table when several variants run) and write metrics
+  via rag_indexer _write_metrics
 """
 from __future__ import annotations
 
 import argparse
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 import sys
+import time
 import yaml
 
 # Allow importing sibling module
 sys.path.append(str(Path(__file__).resolve().parent))
-from rag_indexer import query_index  # type: ignore
+from rag_indexer import (  # type: ignore
+    DEFAULT_CONTEXT_BUDGET,
+    DEFAULT_MODEL,
+    query_index,
+    _chunk_id,
+    _doc_file_paths,
+    _google_rerank_many,
+    _get_embeddings,
+    _INDEX_CACHE,
+    _write_aggregated_output,
+    _write_metrics,
+)
 
 
 def load_cases(path: Path) -> List[Dict[str, Any]]:
@@ -30,21 +57,63 @@ def load_cases(path: Path) -> List[Dict[str, Any]]:
     return data
 
 
-def run_case(case: Dict[str, Any], common: Dict[str, Any]) -> Dict[str, Any]:
+def load_variants(path: Path) -> List[Dict[str, Any]]:
+    """Variants file: YAML list of {name, ...overrides} (ex.: index_path, lambda_mult, fetch_k)."""
+    data = yaml.safe_load(path.read_text(encoding="utf-8"))
+    if not isinstance(data, list):
+        raise ValueError("Variants YAML must be a list")
+    out = []
+    for i, v in enumerate(data, 1):
+        v = dict(v or {})
+        out.append({"name": str(v.pop("name", f"run{i}")), "overrides": v})
+    return out
+
+
+def parse_variant(spec: str) -> Dict[str, Any]:
+    """`name:key=value,key=value` → {name, overrides}; values are parsed as YAML scalars."""
+    name, _, rest = spec.partition(":")
+    overrides: Dict[str, Any] = {}
+    for item in filter(None, (s.strip() for s in rest.split(","))):
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError(f"Invalid variant override (expected key=value): {item}")
+        overrides[key.strip().replace("-", "_")] = yaml.safe_load(value)
+    return {"name": name or "run", "overrides": overrides}
+
+
+def run_case(
+    case: Dict[str, Any],
+    common: Dict[str, Any],
+    defer_rerank: bool = False,
+    overrides: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """Executa a consulta do caso. Com defer_rerank, o rerank fica pendente para `rerank_pending`."""
+    overrides = overrides or {}
+
+    def param(key: str, default: Any = None) -> Any:
+        if key in overrides:
+            return overrides[key]
+        return case.get(key, common.get(key, default))
+
     name = case.get("name") or case.get("id") or "case"
     q = case["q"]
-    k = case.get("k", common.get("k", 6))
-    fetch_k = case.get("fetch_k", common.get("fetch_k", 20))
-    lambda_mult = case.get("lambda_mult", common.get("lambda_mult", 0.5))
+    k = param("k", 6)
+    fetch_k = param("fetch_k", 20)
+    lambda_mult = param("lambda_mult", 0.5)
     filters = {
-        "filter_step": case.get("filter_step", common.get("filter_step")),
-        "filter_rule_type": case.get("filter_rule_type", common.get("filter_rule_type")),
-        "filter_priority": case.get("filter_priority", common.get("filter_priority")),
+        "filter_step": param("filter_step"),
+        "filter_rule_type": param("filter_rule_type"),
+        "filter_priority": param("filter_priority"),
     }
-    compress = case.get("compress", common.get("compress", False))
-    sim_th = case.get("similarity_threshold", common.get("similarity_threshold", 0.25))
-    rerank_llm = case.get("rerank_llm", common.get("rerank_llm"))
-    rerank_top_n = case.get("rerank_top_n", common.get("rerank_top_n"))
+    compress = param("compress", False)
+    sim_th = param("similarity_threshold", 0.25)
+    rerank_llm = param("rerank_llm")
+    rerank_top_n = param("rerank_top_n")
+    out_file = Path(case["out_file"]) if case.get("out_file") else None
+    context_budget = param("context_budget", DEFAULT_CONTEXT_BUDGET)
+    deadline_ms = param("deadline_ms")
+    # com prazo, o rerank fica dentro da consulta para que o planejador possa pulá-lo ou encurtá-lo
+    pending = bool(defer_rerank and not deadline_ms and rerank_llm and rerank_llm.lower() == "google")
 
     root = Path(common.get("root", "."))
     include_dirs = [Path(p) for p in common.get("include_dirs", [])]
@@ -52,9 +121,9 @@ def run_case(case: Dict[str, Any], common: Dict[str, Any]) -> Dict[str, Any]:
     include_exts = set(common.get("include_exts", [])) if common.get("include_exts") else None
     ignore_files = [Path(p) for p in common.get("ignore_files", [])]
 
-    from rag_indexer import DEFAULT_MODEL  # type: ignore
+    t0 = time.perf_counter()
     docs = query_index(
-        index_path=Path(common["index_path"]),
+        index_path=Path(param("index_path")),
         q=q,
         k=k,
         fetch_k=fetch_k,
@@ -64,16 +133,113 @@ def run_case(case: Dict[str, Any], common: Dict[str, Any]) -> Dict[str, Any]:
         filter_priority=filters["filter_priority"],
         compress=compress,
         similarity_threshold=sim_th,
-    model_name=common.get("model") or DEFAULT_MODEL,
+        model_name=param("model") or DEFAULT_MODEL,
         root=root,
         include_dirs=include_dirs,
         exclude_dirs=exclude_dirs,
         include_exts=include_exts,
         ignore_files=ignore_files,
-        out_file=Path(case["out_file"]) if case.get("out_file") else None,
-        rerank_llm=rerank_llm,
+        out_file=None if pending else out_file,
+        rerank_llm=None if pending else rerank_llm,
         rerank_top_n=rerank_top_n,
+        rerank_timeout=param("rerank_timeout"),
+        context_budget=context_budget,
+        always_apply=bool(param("always_apply", False)),
+        applies_to=param("applies_to"),
+        hierarchical_sections=param("hierarchical_sections"),
+        deadline_ms=deadline_ms,
     )
+    latency_ms = (time.perf_counter() - t0) * 1000.0
+
+    return {
+        "name": name,
+        "case": case,
+        "q": q,
+        "k": k,
+        "docs": docs,
+        "latency_ms": latency_ms,
+        "pending_rerank": pending,
+        "rerank_top_n": rerank_top_n,
+        "rerank_timeout": param("rerank_timeout"),
+        "out_file": out_file,
+        "context_budget": context_budget,
+    }
+
+
+def rerank_pending(runs: List[Dict[str, Any]], timeout_s: Optional[float] = None) -> None:
+    """Reordena em lote (concorrente) os casos com rerank pendente e grava seus out_files.
+
+    Os casos são agrupados pelo próprio `rerank_timeout` (variante > caso > comum; `timeout_s` quando
+    ausente) e cada grupo vira um lote. O tempo de cada lote é dividido igualmente entre seus casos e
+    somado ao `latency_ms`, para que a latência reportada inclua o rerank.
+    """
+    groups: Dict[Optional[float], List[Dict[str, Any]]] = {}
+    for r in runs:
+        if r["pending_rerank"] and r["docs"]:
+            timeout = r.get("rerank_timeout")
+            groups.setdefault(timeout if timeout is not None else timeout_s, []).append(r)
+    for timeout, todo in groups.items():
+        t0 = time.perf_counter()
+        ranked = _google_rerank_many(
+            [(r["q"], r["docs"], r["rerank_top_n"] or len(r["docs"])) for r in todo],
+            timeout_s=timeout,
+        )
+        share_ms = (time.perf_counter() - t0) * 1000.0 / len(todo)
+        for r, docs in zip(todo, ranked):
+            if docs:
+                r["docs"] = docs
+            r["latency_ms"] += share_ms
+    for r in runs:
+        if r["pending_rerank"] and r["out_file"]:
+            _write_aggregated_output(r["out_file"], r["q"], r["docs"], budget_tokens=r["context_budget"])
+        r["pending_rerank"] = False
+
+
+def _doc_labels(doc: Any, relevant_files: List[str], relevant_ids: List[str]) -> List[str]:
+    """Labels (arquivo/chunk id) atendidos por um resultado."""
+    hits: List[str] = []
+    fps = [fp.replace("\\", "/") for fp in _doc_file_paths(doc)]
+    for label in relevant_files:
+        norm = label.replace("\\", "/")
+        if any(fp.endswith(norm) or norm in fp for fp in fps):
+            hits.append(f"file:{label}")
+    if relevant_ids:
+        cid = _chunk_id(doc)
+        for label in relevant_ids:
+            if cid == label:
+                hits.append(f"id:{label}")
+    return hits
+
+
+def score_retrieval(docs: List[Any], case: Dict[str, Any], k: int) -> Optional[Dict[str, float]]:
+    """recall@k, MRR e nDCG@k (ganho binário, cada label conta uma vez). None se o caso não tem labels."""
+    relevant_files = [str(x) for x in (case.get("relevant_files") or [])]
+    relevant_ids = [str(x) for x in (case.get("relevant_ids") or [])]
+    n_labels = len(relevant_files) + len(relevant_ids)
+    if not n_labels:
+        return None
+    found: set = set()
+    first_rank: Optional[int] = None
+    dcg = 0.0
+    for rank, d in enumerate(docs[:k], 1):
+        new = [lab for lab in _doc_labels(d, relevant_files, relevant_ids) if lab not in found]
+        if new:
+            found.update(new)
+            dcg += 1.0 / math.log2(rank + 1)
+            if first_rank is None:
+                first_rank = rank
+    idcg = sum(1.0 / math.log2(r + 1) for r in range(1, min(k, n_labels) + 1))
+    return {
+        "recall": len(found) / n_labels,
+        "mrr": 1.0 / first_rank if first_rank else 0.0,
+        "ndcg": dcg / idcg if idcg else 0.0,
+    }
+
+
+def check_case(run: Dict[str, Any]) -> Dict[str, Any]:
+    case = run["case"]
+    name = run["name"]
+    docs = run["docs"]
 
     # Assertions
     min_results = case.get("min_results")
@@ -94,9 +260,104 @@ def run_case(case: Dict[str, Any], common: Dict[str, Any]) -> Dict[str, Any]:
         "pass": ok,
         "reasons": reasons,
         "count": len(docs),
+        "latency_ms": round(run["latency_ms"], 3),
+        "scores": score_retrieval(docs, case, run["k"]),
     }
 
 
+def percentile(values: List[float], pct: float) -> float:
+    """Percentil por nearest-rank (0 se vazio)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(results: List[Dict[str, Any]], wall_s: float) -> Dict[str, Any]:
+    lat = [r["latency_ms"] for r in results]
+    scored = [r["scores"] for r in results if r["scores"]]
+
+    def mean(key: str) -> Optional[float]:
+        return round(sum(s[key] for s in scored) / len(scored), 4) if scored else None
+
+    return {
+        "cases": len(results),
+        "passed": sum(1 for r in results if r["pass"]),
+        "labeled": len(scored),
+        "recall_at_k": mean("recall"),
+        "mrr": mean("mrr"),
+        "ndcg_at_k": mean("ndcg"),
+        "latency_ms": {
+            "p50": round(percentile(lat, 50), 3),
+            "p90": round(percentile(lat, 90), 3),
+            "p95": round(percentile(lat, 95), 3),
+            "p99": round(percentile(lat, 99), 3),
+            "max": round(max(lat), 3) if lat else 0.0,
+        },
+        "wall_s": round(wall_s, 4),
+        "qps": round(len(results) / wall_s, 3) if wall_s > 0 else None,
+    }
+
+
+def evaluate(
+    cases: List[Dict[str, Any]],
+    common: Dict[str, Any],
+    overrides: Optional[Dict[str, Any]] = None,
+    workers: int = 4,
+    rerank_timeout: Optional[float] = None,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """Executa todos os casos em paralelo (índice compartilhado) e retorna (resultados, resumo)."""
+    overrides = overrides or {}
+    # Aquece índice e modelo uma vez, fora da medição de latência
+    model = overrides.get("model") or common.get("model") or DEFAULT_MODEL
+    index_path = Path(overrides.get("index_path") or common["index_path"])
+    _INDEX_CACHE.get(index_path, model_name=model, embeddings=_get_embeddings(model))
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="rag-eval") as ex:
+        runs = list(ex.map(lambda c: run_case(c, common, defer_rerank=True, overrides=overrides), cases))
+    rerank_pending(runs, timeout_s=rerank_timeout)
+    wall_s = time.perf_counter() - t0
+    results = [check_case(r) for r in runs]
+    return results, summarize(results, wall_s)
+
+
+def _fmt(v: Optional[float]) -> str:
+    return "-" if v is None else f"{v:.3f}"
+
+
+def print_run(name: str, results: List[Dict[str, Any]], summary: Dict[str, Any]) -> None:
+    lat = summary["latency_ms"]
+    print(f"RAG Eval [{name}]: {summary['passed']}/{summary['cases']} cases passed")
+    print(
+        f"  recall@k={_fmt(summary['recall_at_k'])} mrr={_fmt(summary['mrr'])} ndcg@k={_fmt(summary['ndcg_at_k'])}"
+        f" (labeled={summary['labeled']}) | latency ms p50={lat['p50']:.1f} p95={lat['p95']:.1f}"
+        f" p99={lat['p99']:.1f} | wall={summary['wall_s']:.2f}s"
+    )
+    for r in results:
+        status = "PASS" if r["pass"] else "FAIL"
+        msg = "; ".join(r["reasons"]) if r["reasons"] else ""
+        print(f"- {status} {r['name']} (count={r['count']}, {r['latency_ms']:.1f}ms) {msg}")
+
+
+def print_comparison(runs: List[Dict[str, Any]]) -> None:
+    """Tabela comparativa entre variantes, com deltas relativos à primeira."""
+    base = runs[0]["summary"]
+    print("\n=== Comparação ===")
+    print(f"{'run':<20} {'pass':>7} {'recall':>8} {'mrr':>8} {'ndcg':>8} {'p50ms':>8} {'p99ms':>8}")
+    for run in runs:
+        s = run["summary"]
+        row = (
+            f"{run['name']:<20} {s['passed']:>3}/{s['cases']:<3} {_fmt(s['recall_at_k']):>8} {_fmt(s['mrr']):>8}"
+            f" {_fmt(s['ndcg_at_k']):>8} {s['latency_ms']['p50']:>8.1f} {s['latency_ms']['p99']:>8.1f}"
+        )
+        if run is not runs[0] and s["ndcg_at_k"] is not None and base["ndcg_at_k"] is not None:
+            row += f"  Δndcg={s['ndcg_at_k'] - base['ndcg_at_k']:+.3f}"
+            row += f" Δp99={s['latency_ms']['p99'] - base['latency_ms']['p99']:+.1f}ms"
+        print(row)
+
+
 def main() -> None:
     ap = argparse.ArgumentParser(description="RAG evaluation harness")
     ap.add_argument("--index-path", type=str, required=True)
@@ -104,6 +365,12 @@ def main() -> None:
     ap.add_argument("--cases", type=str, required=True)
     ap.add_argument("--model", type=str, default=None)
     ap.add_argument("--root", type=str, default=".")
+    ap.add_argument("--rerank-timeout", type=float, default=None, help="Prazo (s) por chamada de rerank remoto")
+    ap.add_argument("--workers", type=int, default=4, help="Casos executados em paralelo")
+    ap.add_argument("--variant", type=str, action="append", default=None,
+                    help="Variante nome:chave=valor,... (ex.: lambda07:lambda_mult=0.7,index_path=.rag/index.c400)")
+    ap.add_argument("--variants", type=str, default=None, help="YAML com lista de variantes [{name, ...overrides}]")
+    ap.add_argument("--report", type=str, default=None, help="Salvar relatório JSON completo")
     args = ap.parse_args()
 
     # Profile defaults for include dirs/exts/ignore
@@ -128,6 +395,7 @@ def main() -> None:
         "index_path": args.index_path,
         "root": str(root),
         "model": args.model,
+        "rerank_timeout": args.rerank_timeout,
     }
     if include_dirs:
         common["include_dirs"] = [str(p) for p in include_dirs]
@@ -136,15 +404,37 @@ def main() -> None:
     if ignore_files:
         common["ignore_files"] = [str(p) for p in ignore_files]
 
+    variants: List[Dict[str, Any]] = []
+    if args.variants:
+        variants.extend(load_variants(Path(args.variants)))
+    variants.extend(parse_variant(v) for v in (args.variant or []))
+    if not variants:
+        variants = [{"name": "default", "overrides": {}}]
+
     cases = load_cases(Path(args.cases))
-    results = [run_case(c, common) for c in cases]
+    runs: List[Dict[str, Any]] = []
+    for v in variants:
+        results, summary = evaluate(
+            cases, common, overrides=v["overrides"], workers=args.workers, rerank_timeout=args.rerank_timeout
+        )
+        runs.append({"name": v["name"], "overrides": v["overrides"], "summary": summary, "cases": results})
+        print_run(v["name"], results, summary)
+        _write_metrics({
+            "type": "eval",
+            "run": v["name"],
+            "index_path": str(v["overrides"].get("index_path") or args.index_path),
+            "overrides": v["overrides"],
+            "workers": args.workers,
+            **summary,
+            "timestamp": time.time(),
+        })
 
-    passed = sum(1 for r in results if r["pass"])
-    print(f"RAG Eval: {passed}/{len(results)} cases passed")
-    for r in results:
-        status = "PASS" if r["pass"] else "FAIL"
-        msg = "; ".join(r["reasons"]) if r["reasons"] else ""
-        print(f"- {status} {r['name']} (count={r['count']}) {msg}")
+    if len(runs) > 1:
+        print_comparison(runs)
+    if args.report:
+        out = Path(args.report)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        out.write_text(json.dumps({"runs": runs}, ensure_ascii=False, indent=2), encoding="utf-8")
 
 
 if __name__ == "__main__":
@@ -30,21 +30,30 @@ Notes:
 from __future__ import annotations
 
 import argparse
+import asyncio
+import atexit
+import hashlib
+import multiprocessing
 import os
+import re
+import shutil
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 import time
 import json
 from fnmatch import fnmatch
-from typing import Dict, Iterable, List, Optional, Tuple, Set, Any
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Set, Any
 
 # LangChain core deps
 from langchain.schema import Document # type: ignore
-from langchain_text_splitters import ( # type: ignore
-    MarkdownHeaderTextSplitter,
-    RecursiveCharacterTextSplitter,
-)
+from langchain_text_splitters import RecursiveCharacterTextSplitter # type: ignore
 
 # Embeddings
+from langchain_core.embeddings import Embeddings # type: ignore
 from langchain_huggingface import HuggingFaceEmbeddings # type: ignore
 
 # Vector stores (FAISS preferred; Chroma fallback)
@@ -57,16 +66,89 @@ try:
 except Exception:  # pragma: no cover - best effort import
     CHROMA_AVAILABLE = False
 
-# Retrieval & compression
-from langchain.retrievers import ContextualCompressionRetriever # pyright: ignore[reportMissingImports]
+# Compression
 from langchain.retrievers.document_compressors import EmbeddingsFilter # type: ignore
 
 
 # ---------------------------- Configuration ---------------------------- #
 DEFAULT_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 DEFAULT_INDEX_PATH = ".rag/index"
+DEFAULT_GROUPS_MANIFEST = "rag-groups.yaml"
 EXCLUDE_DIRS = {".git", "node_modules", "dist", "build", "images", ".rag", ".venv"}
 INCLUDE_EXTS = {".md", ".mdc"}
+BACKENDS = ("auto", "faiss", "chroma")
+
+# Deduplicação de chunks quase idênticos (SimHash 64 bits sobre shingles de 3 palavras)
+DEDUP_HAMMING_DISTANCE = 3
+DEDUP_MIN_TOKENS = 8
+DEDUP_FILTER_KEYS = ("step", "rule_type", "priority")  # filtros da consulta; facetas são unidas no representante
+CHROMA_BATCH_SIZE = 256
+
+# Embedding paralelo em processos no build (1 = no próprio processo; 0 = um processo por núcleo)
+DEFAULT_EMBED_WORKERS = 1
+EMBED_MIN_SHARD = 64
+EMBED_SHARDS_PER_WORKER = 4
+
+# Builds governados (watch em servidor compartilhado): lotes pequenos que cedem às consultas
+GOVERNOR_BATCH_SIZE = 32
+GOVERNOR_QUERY_WINDOW_S = 2.0
+GOVERNOR_PAUSE_S = 0.25
+GOVERNOR_MAX_PAUSE_S = 30.0
+QUERY_HEARTBEAT_FILE = "query.heartbeat"
+
+# Publicação versionada: <index_path>/generations/<geração>/ + ponteiro `current`
+GENERATIONS_DIR = "generations"
+CURRENT_LINK = "current"
+CURRENT_FILE = "CURRENT"
+DEFAULT_KEEP_GENERATIONS = 3
+
+# Journal do watch (<index_path>/watch-journal.json): estado indexado para retomar após restart
+WATCH_JOURNAL_FILE = "watch-journal.json"
+WATCH_JOURNAL_VERSION = 1
+
+# Rerank remoto (Gemini): prazo por chamada, paralelismo em lote, cache e circuit breaker
+RERANK_MODEL = "gemini-1.5-flash"
+RERANK_API_URL = "https://generativelanguage.googleapis.com"
+RERANK_TIMEOUT_S = 8.0
+RERANK_CONCURRENCY = 4
+RERANK_CACHE_SIZE = 512
+RERANK_BREAKER_FAILURES = 3
+RERANK_BREAKER_COOLDOWN_S = 30.0
+
+# Cache semântico de consultas (reaproveita resultados de consultas parafraseadas)
+SEMANTIC_CACHE_SIZE = 256
+SEMANTIC_CACHE_DISTANCE = 0.05
+SEMANTIC_CACHE_SAVE_INTERVAL_S = 5.0
+
+# Metadados por arquivo (frontmatter MDC), cacheados por hash do conteúdo
+FILE_META_CACHE_SIZE = 4096
+FACETS_FILE = "facets.json"
+
+# Índice hierárquico (arquivo → seção → chunk): vetores-resumo gravados com a geração
+HIERARCHY_FILE = "hierarchy.json"
+HIERARCHY_VECTORS = "hierarchy.npz"
+DEFAULT_HIER_SECTIONS = 8
+
+# Redução de dimensionalidade (PCA ou projeção ortogonal aleatória) treinada no build
+PROJECTION_FILE = "projection.npz"
+PROJECTION_METHODS = ("pca", "random")
+PROJECTION_RECALL_K = 10
+PROJECTION_RECALL_SAMPLE = 200
+
+# Empacotamento de contexto do --out-file (orçamento em tokens estimados; 0 = sem limite)
+DEFAULT_CONTEXT_BUDGET = 3000
+CONTEXT_CHARS_PER_TOKEN = 4
+CONTEXT_LAMBDA = 0.7
+CONTEXT_REDUNDANCY = 0.9
+CONTEXT_MIN_TAIL_TOKENS = 48
+
+# Consultas com prazo (--deadline-ms): custos estimados por etapa (ms), refinados por média móvel
+DEADLINE_COST_DEFAULTS = {"search_per_candidate": 0.5, "compress_per_doc": 5.0, "rerank": 1500.0}
+DEADLINE_COST_EWMA = 0.3
+DEADLINE_MIN_RERANK_MS = 200.0
+DEADLINE_PROBE_EVERY = 20  # a cada N pulos de uma etapa opcional, uma consulta a executa para remedir o custo
+PLANNER_COSTS_FILE = "planner-costs.json"  # médias móveis persistidas na raiz do índice
+PLANNER_COSTS_SAVE_INTERVAL_S = 5.0
 
 
 def debug(msg: str) -> None:
@@ -173,34 +255,141 @@ def load_documents(paths: Iterable[Path]) -> List[Document]:
     return docs
 
 
-def split_markdown(docs: List[Document]) -> List[Document]:
-    md_splitter = MarkdownHeaderTextSplitter(
-        headers_to_split_on=[("#", "h1"), ("##", "h2"), ("###", "h3")],
-        strip_headers=False,
-    )
-    header_chunks: List[Document] = []
-    for d in docs:
-        try:
-            parts = md_splitter.split_text(d.page_content)
-            for part in parts:
-                part.metadata = {**d.metadata}
-            header_chunks.extend(parts)
-        except Exception:
-            header_chunks.append(d)
-    debug(f"Chunks por cabeçalho: {len(header_chunks)}")
-    return header_chunks
+# ------------------------ Chunks compactos (build) ------------------------ #
+class SourceText:
+    """Buffer de texto de um arquivo carregado + metadados por arquivo, compartilhados pelos seus chunks."""
 
+    __slots__ = ("text", "meta")
 
-def split_char(chunks: List[Document], chunk_size: int = 800, chunk_overlap: int = 120) -> List[Document]:
+    def __init__(self, text: str, meta: Dict[str, Any]) -> None:
+        self.text = text
+        self.meta = meta
+
+
+class Chunk:
+    """Chunk compacto do pipeline de build: trecho [start, end) do buffer do arquivo.
+
+    Guarda só offsets, o índice da seção e a tupla (internada) de cabeçalhos; campos esparsos
+    (chunk_id, file_paths da deduplicação) ficam em `extra`. O `Document` do LangChain é criado
+    apenas na fronteira com o vector store (`to_document`); no pipeline os campos são lidos com `get`.
+    """
+
+    __slots__ = ("src", "start", "end", "section", "headers", "extra")
+
+    def __init__(
+        self,
+        src: SourceText,
+        start: int,
+        end: int,
+        section: Optional[int] = None,
+        headers: Tuple[Tuple[str, str], ...] = (),
+    ) -> None:
+        self.src = src
+        self.start = start
+        self.end = end
+        self.section = section
+        self.headers = headers
+        self.extra: Optional[Dict[str, Any]] = None
+
+    @property
+    def page_content(self) -> str:
+        return self.src.text[self.start:self.end]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        return self.src.meta.get(key, default)
+
+    def set(self, key: str, value: Any) -> None:
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def _meta(self) -> Dict[str, Any]:
+        meta = dict(self.src.meta)
+        meta.update(self.headers)
+        if self.section is not None:
+            meta["section_index"] = self.section
+            meta["header_path"] = " > ".join(v for _, v in self.headers)
+        meta["start_index"] = self.start
+        meta["end_index"] = self.end
+        if self.extra:
+            meta.update(self.extra)
+        return meta
+
+    def to_document(self, text: Optional[str] = None) -> Document:
+        """`Document` do chunk; `text` reaproveita um texto já fatiado (evita uma segunda cópia)."""
+        return Document(page_content=self.page_content if text is None else text, metadata=self._meta())
+
+
+_HEADER_RE = re.compile(r"^(#{1,3})[ \t]+(.+?)[ \t#]*$")
+_FENCE_RE = re.compile(r"^[ \t]*(```|~~~)")
+
+
+def split_markdown(docs: List[Document]) -> List[Chunk]:
+    """Seções por cabeçalho (H1–H3, ignorando blocos de código) como offsets no buffer de cada arquivo.
+
+    Tuplas de cabeçalhos repetidas entre seções são internadas num pool local à chamada (um build),
+    liberado ao fim do build.
+    """
+    pool: Dict[Any, Any] = {}
+
+    def intern(value: Any) -> Any:
+        return pool.setdefault(value, value)
+
+    sections: List[Chunk] = []
+    for d in docs:
+        src = SourceText(d.page_content or "", d.metadata)
+        text = src.text
+        levels: Dict[int, str] = {}
+        sec_headers: Tuple[Tuple[str, str], ...] = ()
+        start = pos = 0
+        fence: Optional[str] = None
+        n = 0
+        for line in text.splitlines(keepends=True):
+            m_fence = _FENCE_RE.match(line)
+            if m_fence:
+                if fence is None:
+                    fence = m_fence.group(1)
+                elif line.strip().startswith(fence):
+                    fence = None
+            elif fence is None:
+                m = _HEADER_RE.match(line.strip())
+                if m:
+                    if text[start:pos].strip():
+                        sections.append(Chunk(src, start, pos, n, sec_headers))
+                        n += 1
+                    level = len(m.group(1))
+                    levels = {lv: v for lv, v in levels.items() if lv < level}
+                    levels[level] = m.group(2)
+                    sec_headers = intern(tuple((intern(f"h{lv}"), intern(v)) for lv, v in sorted(levels.items())))
+                    start = pos
+            pos += len(line)
+        if text[start:].strip():
+            sections.append(Chunk(src, start, len(text), n, sec_headers))
+    debug(f"Chunks por cabeçalho: {len(sections)}")
+    return sections
+
+
+def split_char(chunks: List[Chunk], chunk_size: int = 800, chunk_overlap: int = 120) -> List[Chunk]:
+    """Split recursivo por caracteres de cada seção; os pedaços continuam sendo offsets no buffer."""
     char_splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap,
     )
-    final_chunks: List[Document] = []
+    final_chunks: List[Chunk] = []
     for h in chunks:
-        parts = char_splitter.split_text(h.page_content)
-        for content in parts:
-            final_chunks.append(Document(page_content=content, metadata=h.metadata))
+        text = h.page_content
+        index = prev_len = 0
+        for piece in char_splitter.split_text(text):
+            # mesma busca de offsets do add_start_index do LangChain
+            index = text.find(piece, max(0, index + prev_len - chunk_overlap))
+            if index < 0:
+                index = text.find(piece)
+                if index < 0:
+                    continue
+            prev_len = len(piece)
+            final_chunks.append(Chunk(h.src, h.start + index, h.start + index + len(piece), h.section, h.headers))
     debug(f"Chunks finais após split recursivo: {len(final_chunks)}")
     return final_chunks
 
@@ -229,12 +418,800 @@ def classify_rule(file_path: str) -> Dict[str, str]:
     return {"step": step, "rule_type": rule_type, "priority": priority}
 
 
-def attach_metadata(chunks: List[Document]) -> None:
-    for c in chunks:
-        file_path = c.metadata.get("source") or c.metadata.get("file_path") or ""
+_FRONTMATTER_RE = re.compile(r"^\ufeff?---[ \t]*\r?\n(.*?)\r?\n---[ \t]*(?:\r?\n|$)", re.S)
+_FILE_META_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_FILE_META_CACHE_LOCK = threading.Lock()
+
+
+def parse_frontmatter(text: str) -> Dict[str, Any]:
+    """Frontmatter YAML (`---` ... `---`) do início do arquivo; {} se ausente ou inválido."""
+    m = _FRONTMATTER_RE.match(text)
+    if not m:
+        return {}
+    try:
+        import yaml  # type: ignore
+
+        data = yaml.safe_load(m.group(1))
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        # sem PyYAML (ou YAML inválido): pares simples `chave: valor`
+        data: Dict[str, Any] = {}
+        for line in m.group(1).splitlines():
+            key, sep, val = line.partition(":")
+            if sep and key.strip() and not key.startswith((" ", "\t")):
+                data[key.strip()] = val.strip().strip("'\"")
+        return data
+
+
+def _as_bool(v: Any) -> bool:
+    if isinstance(v, str):
+        return v.strip().lower() in ("true", "yes", "1", "on")
+    return bool(v)
+
+
+def _as_globs(v: Any) -> List[str]:
+    if not v:
+        return []
+    items = v if isinstance(v, (list, tuple)) else str(v).split(",")
+    return [str(g).strip().strip("'\"") for g in items if str(g).strip()]
+
+
+def extract_file_metadata(text: str) -> Dict[str, Any]:
+    """Campos tipados do frontmatter MDC (description, globs, alwaysApply), cacheados por hash do conteúdo."""
+    key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    with _FILE_META_CACHE_LOCK:
+        hit = _FILE_META_CACHE.get(key)
+        if hit is not None:
+            _FILE_META_CACHE.move_to_end(key)
+            return dict(hit)
+    fm = parse_frontmatter(text)
+    meta: Dict[str, Any] = {
+        "content_hash": key,
+        "description": str(fm.get("description") or ""),
+        "globs": _as_globs(fm.get("globs")),
+        "always_apply": _as_bool(fm.get("alwaysApply", False)),
+    }
+    with _FILE_META_CACHE_LOCK:
+        _FILE_META_CACHE[key] = meta
+        while len(_FILE_META_CACHE) > FILE_META_CACHE_SIZE:
+            _FILE_META_CACHE.popitem(last=False)
+    return dict(meta)
+
+
+def attach_metadata(docs: List[Document]) -> None:
+    """Metadados por arquivo (antes do split): classificação pelo nome + frontmatter MDC.
+
+    Roda uma vez por documento carregado; os chunks herdam os campos no split. O frontmatter é
+    cacheado por hash do conteúdo, então rebuilds (ex.: `watch`) só reprocessam arquivos alterados.
+    """
+    for d in docs:
+        file_path = d.metadata.get("source") or d.metadata.get("file_path") or ""
         meta = classify_rule(str(file_path))
-        c.metadata.update(meta)
-        c.metadata["file_path"] = str(file_path)
+        meta.update(extract_file_metadata(d.page_content or ""))
+        if meta["rule_type"] == "unknown":
+            if meta["always_apply"]:
+                meta["rule_type"] = "always-apply"
+            elif meta["globs"]:
+                meta["rule_type"] = "specific-files"
+        d.metadata.update(meta)
+        d.metadata["file_path"] = str(file_path)
+
+
+def glob_applies(globs: Iterable[str], target: str) -> bool:
+    """True se algum glob (estilo Cursor: `src/**/*.ts`, `*.md`) cobre o caminho `target`."""
+    t = re.sub(r"^(\./)+", "", target.replace("\\", "/"))
+    name = t.rsplit("/", 1)[-1]
+    for g in globs:
+        g = re.sub(r"^(\./)+", "", g.replace("\\", "/"))
+        variants = {g, g.replace("**/", "")}
+        if any(fnmatch(t, v) for v in variants) or ("/" not in g and fnmatch(name, g)):
+            return True
+    return False
+
+
+def _simhashes(texts: List[str]) -> Tuple[List[int], List[int]]:
+    """SimHash de 64 bits de cada texto (shingles de 3 palavras) e a contagem de tokens."""
+    import numpy as np  # type: ignore
+
+    bit_idx = np.arange(64, dtype=np.uint64)
+    hashes: List[int] = []
+    n_tokens: List[int] = []
+    for text in texts:
+        tokens = re.findall(r"\w+", text.lower())
+        n_tokens.append(len(tokens))
+        if not tokens:
+            hashes.append(0)
+            continue
+        shingles = [" ".join(tokens[i:i + 3]) for i in range(max(1, len(tokens) - 2))]
+        hs = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(sh.encode("utf-8"), digest_size=8).digest(), "big") for sh in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        bits = ((hs[:, None] >> bit_idx) & np.uint64(1)).astype(np.int32)
+        votes = (bits * 2 - 1).sum(axis=0)
+        hashes.append(int(sum(1 << i for i in range(64) if votes[i] > 0)))
+    return hashes, n_tokens
+
+
+def _dedup_filter_key(c: Chunk) -> Tuple[Any, ...]:
+    """Valores dos metadados filtráveis de um chunk (listas viram tuplas ordenadas)."""
+    return tuple(
+        tuple(sorted(map(str, v))) if isinstance(v, (list, tuple, set)) else v
+        for v in (c.get(k) for k in DEDUP_FILTER_KEYS)
+    )
+
+
+def dedup_chunks(
+    chunks: List[Chunk],
+    max_distance: int = DEDUP_HAMMING_DISTANCE,
+) -> Tuple[List[Chunk], Dict[str, Any]]:
+    """Colapsa chunks quase idênticos (SimHash com distância de Hamming <= max_distance).
+
+    O primeiro chunk de cada grupo é mantido como representante e recebe `file_paths` com todos os
+    arquivos de origem; candidatos são achados por blocos de 16 bits (princípio da casa dos pombos,
+    válido para max_distance <= 3). Chunks curtos (< DEDUP_MIN_TOKENS) só colapsam se idênticos.
+    Só colapsam chunks com os mesmos metadados filtráveis (`DEDUP_FILTER_KEYS`), para que filtros
+    por step/rule_type/priority continuem achando o texto em cada arquivo de origem. As facetas do
+    frontmatter (`always_apply`, `globs`) não impedem o colapso (ex.: a mesma regra em `.md` sem
+    frontmatter e em `.mdc`): o representante recebe a união delas.
+    """
+    hashes, n_tokens = _simhashes([c.page_content for c in chunks])
+    buckets: Dict[Tuple[Any, int, int], List[int]] = {}
+    exact: Dict[Tuple[Any, str], int] = {}
+    kept: List[Chunk] = []
+    kept_hash: List[int] = []
+    removed = 0
+    for c, h, nt in zip(chunks, hashes, n_tokens):
+        norm = " ".join(c.page_content.split())
+        fkey = _dedup_filter_key(c)
+        rep_i = exact.get((fkey, norm))
+        if rep_i is None and nt >= DEDUP_MIN_TOKENS:
+            for b in range(4):
+                for j in buckets.get((fkey, b, (h >> (16 * b)) & 0xFFFF), ()):
+                    if bin(h ^ kept_hash[j]).count("1") <= max_distance:
+                        rep_i = j
+                        break
+                if rep_i is not None:
+                    break
+        fp = str(c.get("file_path") or "")
+        if rep_i is not None:
+            rep = kept[rep_i]
+            paths = rep.get("file_paths")
+            if paths is None:
+                paths = [rep.get("file_path") or ""]
+                rep.set("file_paths", paths)
+            if fp not in paths:
+                paths.append(fp)
+            if c.get("always_apply") and not rep.get("always_apply"):
+                rep.set("always_apply", True)
+            globs = c.get("globs") or []
+            if any(g not in (rep.get("globs") or []) for g in globs):
+                rep.set("globs", sorted(set(rep.get("globs") or []) | set(globs)))
+            rep.set("dup_count", int(rep.get("dup_count", 1)) + 1)
+            removed += 1
+            continue
+        idx = len(kept)
+        kept.append(c)
+        kept_hash.append(h)
+        exact.setdefault((fkey, norm), idx)
+        if nt >= DEDUP_MIN_TOKENS:
+            for b in range(4):
+                buckets.setdefault((fkey, b, (h >> (16 * b)) & 0xFFFF), []).append(idx)
+    stats = {
+        "chunks_before_dedup": len(chunks),
+        "dedup_removed": removed,
+        "dedup_ratio": round(removed / len(chunks), 4) if chunks else 0.0,
+    }
+    debug(f"Dedup: {removed}/{len(chunks)} chunks colapsados (ratio={stats['dedup_ratio']})")
+    return kept, stats
+
+
+def _doc_file_paths(d: Document) -> List[str]:
+    """Arquivos de origem de um chunk (vários quando duplicatas foram colapsadas)."""
+    fps = d.metadata.get("file_paths")
+    if isinstance(fps, str):
+        fps = [x for x in fps.split(",") if x]
+    if not fps:
+        fps = [d.metadata.get("file_path") or ""]
+    return [str(x) for x in fps]
+
+
+def assign_chunk_ids(chunks: List[Chunk]) -> List[str]:
+    """Atribui `chunk_id` estável (hash de arquivo + conteúdo) a cada chunk e retorna a lista de ids.
+
+    Chunks idênticos no mesmo arquivo recebem sufixo ordinal (`-2`, `-3`...), mantendo os ids únicos.
+    """
+    ids: List[str] = []
+    seen: Dict[str, int] = {}
+    for c in chunks:
+        if c.extra:
+            c.extra.pop("chunk_id", None)
+        base = _chunk_hash(str(c.get("file_path") or c.get("source") or ""), c.page_content)
+        n = seen.get(base, 0) + 1
+        seen[base] = n
+        cid = base if n == 1 else f"{base}-{n}"
+        c.set("chunk_id", cid)
+        ids.append(cid)
+    return ids
+
+
+def _chroma_metadata(meta: Dict[str, Any]) -> Dict[str, Any]:
+    """Chroma aceita apenas escalares em metadados: listas viram texto separado por vírgula.
+
+    Inclui `meta_hash` (hash dos demais campos), usado pelo upsert incremental para detectar
+    metadados alterados em ids existentes (ex.: frontmatter editado, `file_paths` da deduplicação).
+    """
+    out: Dict[str, Any] = {}
+    for k, v in meta.items():
+        if v is None or k == "meta_hash":
+            continue
+        if isinstance(v, (list, tuple, set)):
+            v = ",".join(str(x) for x in v)
+        elif not isinstance(v, (str, int, float, bool)):
+            v = str(v)
+        out[k] = v
+    out["meta_hash"] = hashlib.sha1(json.dumps(out, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return out
+
+
+def _chroma_where(
+    filter_step: Optional[str] = None,
+    filter_rule_type: Optional[str] = None,
+    filter_priority: Optional[str] = None,
+) -> Optional[Dict[str, Any]]:
+    """Monta a cláusula `where` do Chroma para os filtros de metadados (None se não houver filtros)."""
+    conds = [
+        {key: val}
+        for key, val in (("step", filter_step), ("rule_type", filter_rule_type), ("priority", filter_priority))
+        if val
+    ]
+    if not conds:
+        return None
+    return conds[0] if len(conds) == 1 else {"$and": conds}
+
+
+def _chroma_upsert(
+    index_path: Path,
+    chunks: List[Document],
+    embeddings: Any,
+    batch_size: int = CHROMA_BATCH_SIZE,
+    embed_fn: Optional[Callable[[List[str]], Any]] = None,
+) -> Tuple[Any, Dict[str, int]]:
+    """Sincroniza a coleção Chroma persistente com `chunks` de forma incremental.
+
+    Ids ausentes do build atual (arquivos removidos/alterados, duplicatas de builds antigos) são
+    removidos em lote; apenas chunks com ids novos são embutidos e inseridos. Ids existentes cujo
+    `meta_hash` mudou têm só os metadados atualizados (sem re-embedding). Com `embed_fn`
+    (ex.: embedding em processos) os vetores dos chunks novos são calculados de uma vez e
+    inseridos diretamente na coleção.
+    """
+    vs = Chroma(embedding_function=embeddings, persist_directory=str(index_path))
+    res = vs._collection.get(include=["metadatas"])
+    existing: Dict[str, Dict[str, Any]] = {
+        cid: dict(meta or {}) for cid, meta in zip(res.get("ids") or [], res.get("metadatas") or [])
+    }
+    wanted = {c.metadata["chunk_id"] for c in chunks}
+    stale = sorted(set(existing) - wanted)
+    fresh = [c for c in chunks if c.metadata["chunk_id"] not in existing]
+    retag: List[Tuple[str, Dict[str, Any]]] = []
+    for c in chunks:
+        old = existing.get(c.metadata["chunk_id"])
+        if old is None:
+            continue
+        meta = _chroma_metadata(c.metadata)
+        if old.get("meta_hash") != meta["meta_hash"]:
+            # update do Chroma mescla metadados: chaves que sumiram são removidas com None
+            meta.update({k: None for k in old if k not in meta})
+            retag.append((c.metadata["chunk_id"], meta))
+
+    for i in range(0, len(stale), batch_size):
+        vs.delete(ids=stale[i:i + batch_size])
+    for i in range(0, len(retag), batch_size):
+        batch_meta = retag[i:i + batch_size]
+        vs._collection.update(ids=[cid for cid, _ in batch_meta], metadatas=[m for _, m in batch_meta])
+    vectors = embed_fn([c.page_content for c in fresh]) if embed_fn and fresh else None
+    for i in range(0, len(fresh), batch_size):
+        batch = fresh[i:i + batch_size]
+        if vectors is not None:
+            vs._collection.upsert(
+                ids=[c.metadata["chunk_id"] for c in batch],
+                embeddings=[list(map(float, v)) for v in vectors[i:i + batch_size]],
+                documents=[c.page_content for c in batch],
+                metadatas=[_chroma_metadata(c.metadata) for c in batch],
+            )
+            continue
+        vs.add_documents(
+            [Document(page_content=c.page_content, metadata=_chroma_metadata(c.metadata)) for c in batch],
+            ids=[c.metadata["chunk_id"] for c in batch],
+        )
+    persist = getattr(vs, "persist", None)
+    if callable(persist):
+        try:
+            persist()
+        except Exception:
+            pass  # chromadb >= 0.4 persiste automaticamente
+    stats = {
+        "upserted": len(fresh),
+        "deleted": len(stale),
+        "updated": len(retag),
+        "unchanged": len(chunks) - len(fresh) - len(retag),
+    }
+    debug(f"Chroma: +{stats['upserted']} -{stats['deleted']} ~{stats['updated']} ={stats['unchanged']}")
+    return vs, stats
+
+
+def _chroma_in_sync(index_path: Path, chunks: List[Document]) -> bool:
+    """True se a geração Chroma atual já tem exatamente estes chunk_ids com os mesmos metadados."""
+    if not current_generation(index_path):
+        return False
+    index_dir = resolve_index_dir(index_path)
+    if not (index_dir / "chroma.sqlite3").is_file():
+        return False
+    try:
+        vs = Chroma(persist_directory=str(index_dir))
+        res = vs._collection.get(include=["metadatas"])
+    except Exception:
+        return False
+    stored = {cid: (meta or {}).get("meta_hash") for cid, meta in zip(res.get("ids") or [], res.get("metadatas") or [])}
+    if len(stored) != len(chunks):
+        return False
+    return all(stored.get(c.metadata["chunk_id"], "") == _chroma_metadata(c.metadata)["meta_hash"] for c in chunks)
+
+
+# ------------------------- Gerações do índice ------------------------- #
+def _generations_dir(index_path: Path) -> Path:
+    return index_path / GENERATIONS_DIR
+
+
+def current_generation(index_path: Path) -> Optional[str]:
+    """Nome da geração publicada em `index_path` (symlink `current` ou arquivo `CURRENT`), se houver."""
+    link = index_path / CURRENT_LINK
+    try:
+        if link.is_symlink():
+            return Path(os.readlink(link)).name
+    except OSError:
+        pass
+    ptr = index_path / CURRENT_FILE
+    try:
+        name = ptr.read_text(encoding="utf-8").strip()
+        return name or None
+    except OSError:
+        return None
+
+
+def resolve_index_dir(index_path: Path) -> Path:
+    """Diretório efetivo do índice: a geração `current` ou o próprio `index_path` (layout legado)."""
+    gen = current_generation(index_path)
+    if gen:
+        d = _generations_dir(index_path) / gen
+        if d.is_dir():
+            return d
+    return index_path
+
+
+def list_generations(index_path: Path) -> List[str]:
+    """Gerações publicadas, da mais antiga para a mais recente."""
+    gdir = _generations_dir(index_path)
+    if not gdir.is_dir():
+        return []
+    return sorted(p.name for p in gdir.iterdir() if p.is_dir() and not p.name.startswith("."))
+
+
+def _generation_token(index_path: Path) -> str:
+    """Identifica a versão atual do índice (geração ou mtime dos arquivos no layout legado)."""
+    gen = current_generation(index_path)
+    if gen:
+        return gen
+    try:
+        mtimes = [p.stat().st_mtime_ns for p in index_path.iterdir() if p.is_file()]
+        return f"legacy:{max(mtimes) if mtimes else 0}"
+    except OSError:
+        return "legacy:0"
+
+
+def _stage_generation(index_path: Path) -> Tuple[str, Path]:
+    """Cria um diretório de staging para uma nova geração (invisível aos leitores até a publicação)."""
+    now = time.time()
+    gen = f"{time.strftime('%Y%m%dT%H%M%S', time.localtime(now))}.{int(now % 1 * 1e6):06d}-{uuid.uuid4().hex[:6]}"
+    staging = _generations_dir(index_path) / f".staging-{gen}"
+    staging.mkdir(parents=True, exist_ok=False)
+    return gen, staging
+
+
+_CHROMA_SEGMENT_RE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+
+def _seed_staging(index_path: Path, staging: Path) -> bool:
+    """Copia o store Chroma da geração atual para o staging (base do upsert incremental).
+
+    Só artefatos do Chroma são copiados (`chroma.sqlite3` e os diretórios de segmento por UUID);
+    se a geração atual não for Chroma (ex.: FAISS antes de `--backend chroma`) nada é copiado,
+    para que arquivos FAISS antigos não sejam publicados junto com a nova geração.
+    """
+    src = resolve_index_dir(index_path)
+    if not (src / "chroma.sqlite3").is_file():
+        return False
+    shutil.copy2(src / "chroma.sqlite3", staging / "chroma.sqlite3")
+    for item in src.iterdir():
+        if item.is_dir() and _CHROMA_SEGMENT_RE.match(item.name):
+            shutil.copytree(item, staging / item.name)
+    return True
+
+
+def _switch_current(index_path: Path, gen: str) -> None:
+    """Troca o ponteiro `current` atomicamente (rename de symlink; fallback: arquivo CURRENT)."""
+    target = Path(GENERATIONS_DIR) / gen
+    tmp_link = index_path / f".{CURRENT_LINK}.{uuid.uuid4().hex[:6]}"
+    try:
+        os.symlink(target, tmp_link, target_is_directory=True)
+        os.replace(tmp_link, index_path / CURRENT_LINK)
+        try:
+            (index_path / CURRENT_FILE).unlink()
+        except OSError:
+            pass
+        return
+    except OSError as e:
+        try:
+            tmp_link.unlink()
+        except OSError:
+            pass
+        debug(f"Symlink indisponível ({e}); usando arquivo {CURRENT_FILE}")
+    tmp_file = index_path / f".{CURRENT_FILE}.{uuid.uuid4().hex[:6]}"
+    tmp_file.write_text(gen, encoding="utf-8")
+    os.replace(tmp_file, index_path / CURRENT_FILE)
+    link = index_path / CURRENT_LINK
+    if link.is_symlink():
+        try:
+            link.unlink()
+        except OSError:
+            pass
+
+
+def _publish_generation(index_path: Path, gen: str, staging: Path, keep: int = DEFAULT_KEEP_GENERATIONS) -> Path:
+    """Promove o staging a geração publicada, aponta `current` para ela e poda gerações antigas."""
+    final = _generations_dir(index_path) / gen
+    os.replace(staging, final)
+    _switch_current(index_path, gen)
+    _prune_generations(index_path, keep)
+    return final
+
+
+def _prune_generations(index_path: Path, keep: int) -> List[str]:
+    """Mantém a geração atual + `keep` anteriores; remove as demais e stagings abandonados."""
+    removed: List[str] = []
+    gdir = _generations_dir(index_path)
+    current = current_generation(index_path)
+    gens = list_generations(index_path)
+    old = gens[:-(max(0, keep) + 1)]
+    for name in old:
+        if name == current:
+            continue
+        shutil.rmtree(gdir / name, ignore_errors=True)
+        removed.append(name)
+    # stagings órfãos (builds interrompidos há mais de 1h)
+    if gdir.is_dir():
+        for p in gdir.iterdir():
+            if p.name.startswith(".staging-"):
+                try:
+                    if time.time() - p.stat().st_mtime > 3600:
+                        shutil.rmtree(p, ignore_errors=True)
+                except OSError:
+                    pass
+    if removed:
+        debug(f"Gerações removidas: {', '.join(removed)}")
+    return removed
+
+
+def rollback_index(index_path: Path, to: Optional[str] = None) -> str:
+    """Aponta `current` para uma geração anterior (padrão: a imediatamente anterior à atual)."""
+    gens = list_generations(index_path)
+    if to is None:
+        current = current_generation(index_path)
+        older = [g for g in gens if current is None or g < current]
+        if not older:
+            raise RuntimeError(f"Nenhuma geração anterior disponível em {index_path}")
+        to = older[-1]
+    elif to not in gens:
+        raise RuntimeError(f"Geração '{to}' não encontrada em {index_path}")
+    _switch_current(index_path, to)
+    debug(f"Rollback: {index_path} → {to}")
+    return to
+
+
+def _write_facets(index_dir: Path, chunks: List[Document]) -> None:
+    """Índice invertido dos campos tipados (alwaysApply, globs) → chunk ids, gravado com a geração."""
+    facets: Dict[str, Any] = {"always_apply": [], "globs": {}}
+    for c in chunks:
+        cid = c.metadata["chunk_id"]
+        if c.metadata.get("always_apply"):
+            facets["always_apply"].append(cid)
+        for g in c.metadata.get("globs") or []:
+            facets["globs"].setdefault(g, []).append(cid)
+    (index_dir / FACETS_FILE).write_text(json.dumps(facets, ensure_ascii=False), encoding="utf-8")
+
+
+_FACETS: Dict[str, Optional[Dict[str, Any]]] = {}
+
+
+def load_facets(index_path: Path) -> Optional[Dict[str, Any]]:
+    """Facetas da geração atual (None para índices antigos, sem `facets.json`)."""
+    index_dir = resolve_index_dir(index_path)
+    key = str(index_dir.resolve())
+    if key not in _FACETS:
+        try:
+            _FACETS[key] = json.loads((index_dir / FACETS_FILE).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            _FACETS[key] = None
+    return _FACETS[key]
+
+
+def facet_chunk_ids(
+    facets: Dict[str, Any],
+    always_apply: bool = False,
+    applies_to: Optional[str] = None,
+) -> Optional[Set[str]]:
+    """Chunk ids que atendem aos filtros tipados (None = sem filtro).
+
+    `always_apply`: apenas regras com alwaysApply. `applies_to`: regras aplicáveis ao caminho dado
+    (alwaysApply ou algum glob que o cubra), resolvido sobre os globs distintos do índice.
+    """
+    ids: Optional[Set[str]] = None
+    always = set(facets.get("always_apply") or [])
+    if always_apply:
+        ids = set(always)
+    if applies_to:
+        applicable = set(always)
+        for g, gids in (facets.get("globs") or {}).items():
+            if glob_applies([g], applies_to):
+                applicable.update(gids)
+        ids = applicable if ids is None else ids & applicable
+    return ids
+
+
+def _chroma_vectors(vs: Any, ids: List[str], batch_size: int = CHROMA_BATCH_SIZE) -> List[Any]:
+    """Vetores armazenados no Chroma para `ids`, na mesma ordem."""
+    by_id: Dict[str, Any] = {}
+    for i in range(0, len(ids), batch_size):
+        res = vs._collection.get(ids=ids[i:i + batch_size], include=["embeddings"])
+        by_id.update(zip(res["ids"], res["embeddings"]))
+    return [by_id[cid] for cid in ids]
+
+
+def _write_hierarchy(index_dir: Path, chunks: List[Document], vectors: Any) -> None:
+    """Vetores-resumo por seção (média normalizada dos chunks) e por arquivo (média das seções).
+
+    `hierarchy.json` guarda arquivos e seções (arquivo, section_index, header_path, chunk ids);
+    `hierarchy.npz` guarda as matrizes. Nenhum embedding extra é calculado no build.
+    """
+    import numpy as np  # type: ignore
+
+    if not chunks:
+        return
+
+    def unit(m: Any) -> Any:
+        return m / (np.linalg.norm(m, axis=-1, keepdims=True) + 1e-12)
+
+    vecs = unit(np.asarray([np.asarray(v, dtype=np.float32) for v in vectors], dtype=np.float32))
+    sec_index: Dict[Tuple[str, Any], int] = {}
+    sections: List[Dict[str, Any]] = []
+    members: List[List[int]] = []
+    for i, c in enumerate(chunks):
+        fp = str(c.metadata.get("file_path") or c.metadata.get("source") or "")
+        key = (fp, c.metadata.get("section_index"))
+        j = sec_index.get(key)
+        if j is None:
+            j = sec_index[key] = len(sections)
+            sections.append({
+                "file_path": fp,
+                "section_index": key[1],
+                "header_path": c.metadata.get("header_path") or "",
+                "chunk_ids": [],
+            })
+            members.append([])
+        sections[j]["chunk_ids"].append(c.metadata["chunk_id"])
+        members[j].append(i)
+    files = sorted({sec["file_path"] for sec in sections})
+    file_pos = {fp: i for i, fp in enumerate(files)}
+    sec_vecs = unit(np.vstack([vecs[m].mean(axis=0) for m in members]))
+    sec_file = np.asarray([file_pos[sec["file_path"]] for sec in sections], dtype=np.int32)
+    file_vecs = unit(np.vstack([sec_vecs[sec_file == i].mean(axis=0) for i in range(len(files))]))
+    (index_dir / HIERARCHY_FILE).write_text(
+        json.dumps({"files": files, "sections": sections}, ensure_ascii=False), encoding="utf-8"
+    )
+    np.savez(index_dir / HIERARCHY_VECTORS, file_vecs=file_vecs, section_vecs=sec_vecs, section_file=sec_file)
+
+
+_HIERARCHIES: Dict[str, Optional[Dict[str, Any]]] = {}
+
+
+def load_hierarchy(index_path: Path) -> Optional[Dict[str, Any]]:
+    """Índice hierárquico da geração atual (None para índices sem `hierarchy.json`)."""
+    import numpy as np  # type: ignore
+
+    index_dir = resolve_index_dir(index_path)
+    key = str(index_dir.resolve())
+    if key not in _HIERARCHIES:
+        try:
+            data = json.loads((index_dir / HIERARCHY_FILE).read_text(encoding="utf-8"))
+            with np.load(index_dir / HIERARCHY_VECTORS) as arrays:
+                data.update({name: arrays[name] for name in arrays.files})
+            _HIERARCHIES[key] = data
+        except (OSError, ValueError, KeyError):
+            _HIERARCHIES[key] = None
+    return _HIERARCHIES[key]
+
+
+def hierarchical_chunk_ids(hier: Dict[str, Any], qvec: Any, sections: int = DEFAULT_HIER_SECTIONS) -> Tuple[Set[str], List[int]]:
+    """Busca grossa: melhores arquivos → melhores seções desses arquivos → chunk ids candidatos.
+
+    Considera os `sections` arquivos mais próximos da consulta e, dentre as seções deles, as
+    `sections` mais próximas. Retorna (chunk ids, índices das seções escolhidas).
+    """
+    import numpy as np  # type: ignore
+
+    q = np.asarray(qvec, dtype=np.float32)
+    q = q / (float(np.linalg.norm(q)) or 1.0)
+    file_scores = hier["file_vecs"] @ q
+    top_files = np.argsort(-file_scores)[:max(1, sections)]
+    cand = np.nonzero(np.isin(hier["section_file"], top_files))[0]
+    sec_scores = hier["section_vecs"][cand] @ q
+    chosen = [int(cand[i]) for i in np.argsort(-sec_scores)[:max(1, sections)]]
+    ids: Set[str] = set()
+    for j in chosen:
+        ids.update(hier["sections"][j]["chunk_ids"])
+    return ids, chosen
+
+
+def fit_projection(vectors: Any, target_dim: int, method: str = "pca", seed: int = 0) -> Dict[str, Any]:
+    """Treina a projeção `d → target_dim` sobre os vetores do corpus.
+
+    pca: componentes principais (SVD dos vetores centrados); random: base ortonormal aleatória
+    (QR de matriz gaussiana, semente fixa). Retorna {method, mean, components (d x target_dim)}.
+    """
+    import numpy as np  # type: ignore
+
+    if method not in PROJECTION_METHODS:
+        raise ValueError(f"Método de projeção desconhecido: {method} (use {', '.join(PROJECTION_METHODS)})")
+    X = np.asarray(vectors, dtype=np.float32)
+    n, d = X.shape
+    if not 0 < target_dim < d:
+        raise ValueError(f"Dimensão alvo inválida: {target_dim} (vetores têm {d})")
+    if method == "pca" and target_dim > n:
+        # o SVD de n vetores só tem n componentes: a projeção fica com n dimensões
+        debug(f"PCA com {n} vetores: dimensão alvo reduzida de {target_dim} para {n}")
+        target_dim = n
+    if method == "pca":
+        mean = X.mean(axis=0)
+        _, sv, vt = np.linalg.svd(X - mean, full_matrices=False)
+        components = vt[:target_dim].T
+        var = sv ** 2
+        retained = float(var[:target_dim].sum() / var.sum()) if var.sum() else 1.0
+    else:
+        mean = np.zeros(d, dtype=np.float32)
+        q, _ = np.linalg.qr(np.random.default_rng(seed).standard_normal((d, target_dim)))
+        components = q
+        retained = None
+    return {
+        "method": method,
+        "mean": mean.astype(np.float32),
+        "components": np.ascontiguousarray(components, dtype=np.float32),
+        "variance_retained": retained,
+    }
+
+
+def check_projection(embeddings: Any, target_dim: Optional[int], method: str) -> None:
+    """Valida `reduce_dim`/`reduce_method` contra a dimensão do modelo antes do build (ValueError se inválidos)."""
+    if not target_dim:
+        return
+    if method not in PROJECTION_METHODS:
+        raise ValueError(f"Método de projeção desconhecido: {method} (use {', '.join(PROJECTION_METHODS)})")
+    d = len(embeddings.embed_query("dimensão"))
+    if not 0 < target_dim < d:
+        raise ValueError(f"Dimensão alvo inválida: {target_dim} (o modelo gera vetores de {d})")
+
+
+def apply_projection(proj: Dict[str, Any], vectors: Any) -> Any:
+    import numpy as np  # type: ignore
+
+    return (np.asarray(vectors, dtype=np.float32) - proj["mean"]) @ proj["components"]
+
+
+def lift_projection(proj: Dict[str, Any], vectors: Any) -> Any:
+    """Volta vetores projetados ao espaço original (aproximação), para comparar com consultas completas."""
+    import numpy as np  # type: ignore
+
+    return np.asarray(vectors, dtype=np.float32) @ proj["components"].T + proj["mean"]
+
+
+def save_projection(index_dir: Path, proj: Dict[str, Any]) -> None:
+    import numpy as np  # type: ignore
+
+    np.savez(index_dir / PROJECTION_FILE, method=np.asarray(proj["method"]), mean=proj["mean"], components=proj["components"])
+
+
+def load_projection(index_dir: Path) -> Optional[Dict[str, Any]]:
+    """Projeção gravada com a geração (None se o índice guarda vetores completos)."""
+    import numpy as np  # type: ignore
+
+    path = index_dir / PROJECTION_FILE
+    if not path.exists():
+        return None
+    with np.load(path) as data:
+        return {"method": str(data["method"]), "mean": data["mean"], "components": data["components"]}
+
+
+def projection_recall(
+    vectors: Any,
+    proj: Dict[str, Any],
+    k: int = PROJECTION_RECALL_K,
+    sample: int = PROJECTION_RECALL_SAMPLE,
+) -> Optional[float]:
+    """Recall@k dos vizinhos (L2, sem o próprio vetor) no espaço projetado vs. completo, numa amostra."""
+    import numpy as np  # type: ignore
+
+    X = np.asarray(vectors, dtype=np.float32)
+    n = X.shape[0]
+    k = min(k, n - 1)
+    if k <= 0:
+        return None
+    idx = np.random.default_rng(0).choice(n, size=min(sample, n), replace=False)
+    Y = apply_projection(proj, X)
+
+    def neighbors(M: Any) -> Any:
+        sq = (M ** 2).sum(axis=1)
+        dist = sq[idx][:, None] + sq[None, :] - 2.0 * (M[idx] @ M.T)
+        dist[np.arange(len(idx)), idx] = np.inf
+        return np.argpartition(dist, k, axis=1)[:, :k]
+
+    full, reduced = neighbors(X), neighbors(Y)
+    hits = sum(len(set(a) & set(b)) for a, b in zip(full.tolist(), reduced.tolist()))
+    return round(hits / (len(idx) * k), 4)
+
+
+class _ProjectedEmbeddings(Embeddings):
+    """Embeddings que aplicam a projeção do índice (usado como embedding_function do FAISS reduzido)."""
+
+    def __init__(self, base: Any, proj: Dict[str, Any]) -> None:
+        self.base = base
+        self.proj = proj
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return apply_projection(self.proj, self.base.embed_documents(texts)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return apply_projection(self.proj, [self.base.embed_query(text)])[0].tolist()
+
+
+def _store_query(vs: Any, qvec: Any) -> Any:
+    """Vetor de consulta no espaço do índice (projetado, se o índice foi reduzido)."""
+    proj = getattr(vs, "_rag_projection", None)
+    if proj is None:
+        return qvec
+    return apply_projection(proj, [qvec])[0].tolist()
+
+
+def _generation_vectors(index_path: Path, embeddings: Any) -> Dict[str, Any]:
+    """Vetores completos da geração atual por chunk_id, para reaproveitar em rebuilds incrementais.
+
+    Só vale para FAISS sem projeção (vetores reduzidos não voltam ao espaço original); nos demais
+    casos retorna {} e o build embute tudo. No Chroma o reaproveitamento já é nativo (upsert).
+    """
+    index_dir = resolve_index_dir(index_path)
+    if not (index_dir / "index.faiss").is_file() or (index_dir / PROJECTION_FILE).exists():
+        return {}
+    try:
+        vs = FAISS.load_local(str(index_dir), embeddings, allow_dangerous_deserialization=True)
+        ntotal = int(vs.index.ntotal)
+        mat = vs.index.reconstruct_n(0, ntotal) if ntotal else []
+        return {
+            str(cid): mat[pos]
+            for pos, cid in vs.index_to_docstore_id.items()
+            if 0 <= pos < ntotal
+        }
+    except Exception as e:
+        debug(f"Vetores da geração atual indisponíveis ({e}); embedding completo")
+        return {}
 
 
 def build_index(
@@ -247,7 +1224,29 @@ def build_index(
     exclude_dirs: Optional[Set[str]] = None,
     include_exts: Optional[Set[str]] = None,
     ignore_files: Optional[List[Path]] = None,
+    backend: str = "auto",
+    keep_generations: int = DEFAULT_KEEP_GENERATIONS,
+    dedup: bool = True,
+    dedup_distance: int = DEDUP_HAMMING_DISTANCE,
+    embed_workers: int = DEFAULT_EMBED_WORKERS,
+    embed_threads: Optional[int] = None,
+    reduce_dim: Optional[int] = None,
+    reduce_method: str = "pca",
+    governor: Optional[BuildGovernor] = None,
+    reuse_vectors: bool = False,
 ) -> Tuple[str, int]:
+    """Constrói o índice. backend: auto (FAISS com fallback para Chroma), faiss ou chroma.
+
+    O build é escrito numa geração de staging e publicado atomicamente (ponteiro `current`),
+    de modo que consultas concorrentes nunca veem um índice pela metade. `embed_workers` > 1
+    (ou 0 = automático) distribui o embedding dos chunks entre processos (ver `embed_parallel`).
+    `reduce_dim` treina uma projeção (PCA/aleatória) e grava o FAISS na dimensão reduzida.
+    Com `governor` o embedding roda em lotes com limites de recursos (ver `BuildGovernor`).
+    `reuse_vectors` reaproveita os vetores da geração atual para chunk_ids inalterados, embutindo só
+    os chunks novos (usado pelo `watch`, que garante o mesmo modelo/configuração via journal).
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend desconhecido: {backend} (use {', '.join(BACKENDS)})")
     # Ignora via arquivos (ex.: .copilotignore, .cursorignore)
     ignore_entries: Set[str] = set()
     if ignore_files:
@@ -256,37 +1255,147 @@ def build_index(
     eff_exclude = set(exclude_dirs or set()) | ignore_entries
 
     t0 = time.perf_counter()
+    started = time.time()
+    if governor is not None:
+        governor.reset(index_path)
+        if embed_workers != 1:
+            # o governor embute em lotes no próprio processo (checkpoints entre lotes); sem pool
+            debug(f"embed_workers={embed_workers} ignorado com governor: embedding em 1 processo"
+                  f" com até {governor.threads or 'todas as'} threads")
+        governor.apply_priority()
     paths = list(iter_files(root, include_dirs=include_dirs, exclude_dirs=eff_exclude, include_exts=include_exts))
     docs = load_documents(paths)
+    attach_metadata(docs)
     header_chunks = split_markdown(docs)
     final_chunks = split_char(header_chunks, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    attach_metadata(final_chunks)
-
-    embeddings = HuggingFaceEmbeddings(model_name=model_name)
+    dedup_stats: Optional[Dict[str, Any]] = None
+    if dedup:
+        final_chunks, dedup_stats = dedup_chunks(final_chunks, max_distance=dedup_distance)
+    chunk_ids = assign_chunk_ids(final_chunks)
+
+    embeddings = _get_embeddings(model_name)
+    if backend != "chroma":
+        # opções de projeção inválidas são erro de uso, não falha do FAISS: nada de fallback para Chroma
+        check_projection(embeddings, reduce_dim, reduce_method)
+    embed_stats: Dict[str, Any] = {}
+
+    def embed_fn(texts: List[str]) -> Any:
+        e0 = time.perf_counter()
+        if governor is not None:
+            vectors = governor.embed(texts, model_name)
+            info = {"workers": 1, "threads": governor.threads}
+            if embed_workers != 1:
+                info["workers_requested"] = embed_workers
+        else:
+            vectors, info = embed_parallel(texts, model_name, workers=embed_workers, threads_per_worker=embed_threads)
+        dt = time.perf_counter() - e0
+        embed_stats.update(info, chunks=len(texts), duration_s=round(dt, 4),
+                           chunks_per_s=round(len(texts) / dt, 1) if dt else None)
+        return vectors
+
+    index_path.mkdir(parents=True, exist_ok=True)
+    generation, staging = _stage_generation(index_path)
 
-    index_path.parent.mkdir(parents=True, exist_ok=True)
-
-    # Try FAISS first
     try:
-        vs = FAISS.from_documents(final_chunks, embeddings)
-        vs.save_local(str(index_path))
-        backend = "faiss"
-        debug(f"Índice FAISS salvo em: {index_path}")
-    except Exception as e:
-        if not CHROMA_AVAILABLE:
-            raise RuntimeError(
-                f"Falha ao criar índice FAISS e Chroma não disponível: {e}"
-            )
-        # Fallback to Chroma persistent store
-        debug(f"FAISS indisponível ({e}). Usando Chroma como fallback.")
-        vs = Chroma.from_documents(
-            final_chunks,
-            embedding=embeddings,
-            persist_directory=str(index_path),
-        )
-        vs.persist()
-        backend = "chroma"
-        debug(f"Índice Chroma persistido em: {index_path}")
+        # Try FAISS first (unless Chroma was requested)
+        chroma_stats: Optional[Dict[str, int]] = None
+        unchanged: Optional[str] = None  # geração mantida quando o Chroma já está em dia
+        projection_stats: Optional[Dict[str, Any]] = None
+        use_chroma = backend == "chroma"
+        final_docs: List[Document] = []
+        if not use_chroma:
+            try:
+                texts = [c.page_content for c in final_chunks]
+                prev = _generation_vectors(index_path, embeddings) if reuse_vectors else {}
+                missing = [i for i, cid in enumerate(chunk_ids) if cid not in prev]
+                vectors = None
+                if prev and len(missing) < len(texts):
+                    import numpy as np  # type: ignore
+
+                    dim = len(next(iter(prev.values())))
+                    fresh = embed_fn([texts[i] for i in missing]) if missing else None
+                    if fresh is None or fresh.shape[1] == dim:
+                        vectors = np.empty((len(texts), dim), dtype=np.float32)
+                        for j, i in enumerate(missing):
+                            vectors[i] = fresh[j]
+                        for i, cid in enumerate(chunk_ids):
+                            if cid in prev:
+                                vectors[i] = prev[cid]
+                        embed_stats["reused"] = len(texts) - len(missing)
+                    else:
+                        debug(f"Dimensão do modelo ({fresh.shape[1]}) difere da geração atual ({dim}); embedding completo")
+                    del prev
+                if vectors is None:
+                    vectors = embed_fn(texts)
+                # fronteira com o vector store: só aqui os chunks viram Documents (mesmas strings de `texts`)
+                final_docs = [c.to_document(t) for c, t in zip(final_chunks, texts)]
+                del texts
+                stored, index_emb = vectors, embeddings
+                if reduce_dim:
+                    proj = fit_projection(vectors, reduce_dim, method=reduce_method)
+                    stored = apply_projection(proj, vectors)
+                    index_emb = _ProjectedEmbeddings(embeddings, proj)
+                    save_projection(staging, proj)
+                    projection_stats = {
+                        "method": reduce_method,
+                        "source_dim": int(len(vectors[0])),
+                        "target_dim": int(proj["components"].shape[1]),
+                        "variance_retained": proj["variance_retained"],
+                        f"recall_at_{PROJECTION_RECALL_K}": projection_recall(vectors, proj),
+                    }
+                    debug(f"Projeção {reduce_method}: {projection_stats}")
+                vs = FAISS.from_embeddings(
+                    [(d.page_content, v) for d, v in zip(final_docs, stored)],
+                    index_emb,
+                    metadatas=[d.metadata for d in final_docs],
+                    ids=chunk_ids,
+                )
+                vs.save_local(str(staging))
+                del vs, stored
+                _write_hierarchy(staging, final_docs, vectors)
+                backend = "faiss"
+            except BuildAborted:
+                raise  # aborto do governor não cai no fallback para Chroma
+            except Exception as e:
+                if backend == "faiss":
+                    raise RuntimeError(f"Falha ao criar índice FAISS: {e}") from e
+                if not CHROMA_AVAILABLE:
+                    raise RuntimeError(
+                        f"Falha ao criar índice FAISS e Chroma não disponível: {e}"
+                    ) from e
+                debug(f"FAISS indisponível ({e}). Usando Chroma como fallback.")
+                use_chroma = True
+        if use_chroma:
+            if not CHROMA_AVAILABLE:
+                raise RuntimeError("Backend Chroma solicitado, mas chromadb não está disponível")
+            if reduce_dim:
+                debug("Redução de dimensionalidade disponível apenas no FAISS; Chroma guarda vetores completos")
+            final_docs = final_docs or [c.to_document() for c in final_chunks]
+            backend = "chroma"
+            if _chroma_in_sync(index_path, final_docs):
+                # nada mudou: mantém a geração atual em vez de copiar o store inteiro
+                shutil.rmtree(staging)
+                unchanged = current_generation(index_path)
+            else:
+                # Chroma persistente com upsert/delete incremental por chunk_id, sobre cópia da geração atual
+                shutil.rmtree(staging)
+                staging.mkdir(parents=True)
+                _seed_staging(index_path, staging)
+                vs, chroma_stats = _chroma_upsert(staging, final_docs, embeddings, embed_fn=embed_fn)
+                _write_hierarchy(staging, final_docs, _chroma_vectors(vs, chunk_ids))
+                del vs  # libera o cliente antes de mover o diretório
+        if unchanged is None:
+            _write_facets(staging, final_docs)
+            final_dir = _publish_generation(index_path, generation, staging, keep=keep_generations)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    if unchanged is not None:
+        generation = unchanged
+        chroma_stats = {"upserted": 0, "deleted": 0, "updated": 0, "unchanged": len(final_docs)}
+        debug(f"Índice Chroma sem mudanças; geração {generation} mantida")
+    else:
+        debug(f"Índice {'FAISS' if backend == 'faiss' else 'Chroma'} publicado em: {final_dir} (geração {generation})")
 
     # métricas
     try:
@@ -294,8 +1403,14 @@ def build_index(
             "type": "build",
             "index_path": str(index_path),
             "backend": backend,
+            "generation": generation,
             "docs": len(docs),
             "chunks": len(final_chunks),
+            "chroma": chroma_stats,
+            "dedup": dedup_stats,
+            "embed": embed_stats or None,
+            "projection": projection_stats,
+            "governor": governor.report(started, len(final_chunks)) if governor is not None else None,
             "duration_s": round(time.perf_counter() - t0, 4),
             "timestamp": time.time(),
         })
@@ -304,14 +1419,414 @@ def build_index(
     return backend, len(final_chunks)
 
 
-def load_index(index_path: Path, model_name: str = DEFAULT_MODEL):
-    embeddings = HuggingFaceEmbeddings(model_name=model_name)
+def load_index_groups(manifest: Path) -> Dict[str, List[Dict[str, Any]]]:
+    """Lê o manifesto de grupos de índices (YAML/JSON).
+
+    Formato:
+      groups:
+        rules:
+          indexes:
+            - {index_path: .rag/index.vscode, profile: vscode}
+            - {index_path: .rag/index.cursor, profile: cursor}
+
+    Cada membro aceita ainda include_dirs, exclude_dirs, ignore_files, include_exts,
+    chunk_size, chunk_overlap, model, backend, dedup, dedup_distance, keep_generations,
+    embed_workers, embed_threads, reduce_dim e reduce_method. Uma lista simples de membros também é aceita por grupo.
+    `index_path` e `ignore_files` relativos são resolvidos a partir do diretório do manifesto.
+    """
+    import yaml  # type: ignore
+
+    data = yaml.safe_load(manifest.read_text(encoding="utf-8")) or {}
+    groups = data.get("groups") if isinstance(data, dict) else None
+    if not isinstance(groups, dict):
+        raise ValueError(f"Manifesto inválido (esperado 'groups:'): {manifest}")
+    out: Dict[str, List[Dict[str, Any]]] = {}
+    for name, spec in groups.items():
+        members = spec.get("indexes") if isinstance(spec, dict) else spec
+        if not isinstance(members, list):
+            raise ValueError(f"Grupo '{name}' sem lista de índices em {manifest}")
+        defaults = {k: v for k, v in spec.items() if k != "indexes"} if isinstance(spec, dict) else {}
+        resolved: List[Dict[str, Any]] = []
+        for m in members:
+            m = {**defaults, **({"index_path": m} if isinstance(m, str) else dict(m))}
+            if not m.get("index_path"):
+                raise ValueError(f"Membro sem index_path no grupo '{name}' em {manifest}")
+            m["index_path"] = str(manifest.parent / m["index_path"])
+            if m.get("ignore_files"):
+                m["ignore_files"] = [str(manifest.parent / f) for f in m["ignore_files"]]
+            resolved.append(m)
+        out[str(name)] = resolved
+    return out
+
+
+def build_index_group(
+    manifest: Path,
+    group: str,
+    root: Path,
+    model_name: str = DEFAULT_MODEL,
+    chunk_size: int = 800,
+    chunk_overlap: int = 120,
+    backend: str = "auto",
+    keep_generations: int = DEFAULT_KEEP_GENERATIONS,
+    dedup: bool = True,
+    dedup_distance: int = DEDUP_HAMMING_DISTANCE,
+    embed_workers: int = DEFAULT_EMBED_WORKERS,
+    embed_threads: Optional[int] = None,
+    reduce_dim: Optional[int] = None,
+    reduce_method: str = "pca",
+    governor: Optional["BuildGovernor"] = None,
+) -> List[Tuple[str, str, int]]:
+    """Constrói todos os índices de um grupo do manifesto; retorna [(index_path, backend, chunks)].
+
+    As opções de build recebidas (flags da CLI) valem para todos os membros; valores do grupo ou do
+    membro no manifesto têm precedência.
+    """
+    members = load_index_groups(manifest).get(group)
+    if not members:
+        raise ValueError(f"Grupo '{group}' não encontrado em {manifest}")
+    results: List[Tuple[str, str, int]] = []
+    for m in members:
+        include_dirs, include_exts, ignore_files = _resolve_profile(
+            m.get("profile", "auto"),
+            root,
+            m.get("include_dirs"),
+            set(m["include_exts"]) if m.get("include_exts") else None,
+            [Path(f) for f in (m.get("ignore_files") or [])],
+            label=f"group:{group}",
+        )
+        debug(f"[group:{group}] Construindo {m['index_path']}")
+        backend, n_chunks = build_index(
+            root=root,
+            index_path=Path(m["index_path"]),
+            model_name=m.get("model") or model_name,
+            chunk_size=int(m.get("chunk_size", chunk_size)),
+            chunk_overlap=int(m.get("chunk_overlap", chunk_overlap)),
+            include_dirs=include_dirs,
+            exclude_dirs=set(m["exclude_dirs"]) if m.get("exclude_dirs") else None,
+            include_exts=include_exts,
+            ignore_files=ignore_files,
+            backend=m.get("backend", backend),
+            keep_generations=int(m.get("keep_generations", keep_generations)),
+            dedup=bool(m.get("dedup", dedup)),
+            dedup_distance=int(m.get("dedup_distance", dedup_distance)),
+            embed_workers=int(m.get("embed_workers", embed_workers)),
+            embed_threads=m.get("embed_threads", embed_threads),
+            reduce_dim=m.get("reduce_dim", reduce_dim),
+            reduce_method=m.get("reduce_method", reduce_method),
+            governor=governor,
+        )
+        results.append((str(m["index_path"]), backend, n_chunks))
+    return results
+
+
+_EMBEDDINGS: Dict[str, Any] = {}
+_EMBEDDINGS_LOCK = threading.Lock()
+
+
+def _get_embeddings(model_name: str = DEFAULT_MODEL):
+    """Instância de embeddings compartilhada por modelo (evita recarregar o modelo a cada índice)."""
+    with _EMBEDDINGS_LOCK:
+        emb = _EMBEDDINGS.get(model_name)
+        if emb is None:
+            emb = HuggingFaceEmbeddings(model_name=model_name)
+            _EMBEDDINGS[model_name] = emb
+        return emb
+
+
+# ---------------------- Embedding paralelo (processos) ---------------------- #
+_WORKER_EMBEDDINGS: Any = None
+
+
+def _embed_worker_init(model_name: str, threads: int) -> None:
+    """Inicializa um processo de embedding: limita threads intra-op e carrega o próprio modelo."""
+    global _WORKER_EMBEDDINGS
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    try:
+        import torch  # type: ignore
+
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+    except Exception:
+        pass
+    _WORKER_EMBEDDINGS = HuggingFaceEmbeddings(model_name=model_name)
+
+
+def _embed_worker_run(shm_name: str, shape: Tuple[int, int], start: int, texts: List[str]) -> int:
+    """Embute um shard e escreve os vetores direto na memória compartilhada do processo pai."""
+    import numpy as np  # type: ignore
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        out[start:start + len(texts)] = np.asarray(_WORKER_EMBEDDINGS.embed_documents(texts), dtype=np.float32)
+        del out
+    finally:
+        shm.close()
+    return len(texts)
+
+
+def embed_parallel(
+    texts: List[str],
+    model_name: str = DEFAULT_MODEL,
+    workers: int = DEFAULT_EMBED_WORKERS,
+    threads_per_worker: Optional[int] = None,
+) -> Tuple[Any, Dict[str, Any]]:
+    """Embute `texts` em paralelo (dados) num pool de processos; retorna (matriz float32, info).
+
+    Os textos são divididos em shards contíguos (EMBED_SHARDS_PER_WORKER por processo, para
+    balancear carga); cada processo mantém seu modelo com `threads_per_worker` threads intra-op
+    (padrão: núcleos / processos) e grava os vetores num bloco de memória compartilhada, montado
+    pelo processo pai sem serializar listas. Com 1 processo (ou poucos textos) embute localmente.
+    """
+    import numpy as np  # type: ignore
+
+    cores = os.cpu_count() or 1
+    n = len(texts)
+    workers = cores if workers <= 0 else workers
+    workers = max(1, min(workers, n // EMBED_MIN_SHARD or 1))
+    if n == 0:
+        return np.zeros((0, 0), dtype=np.float32), {"workers": 0, "threads": None}
+    if workers == 1:
+        vectors = np.asarray(_get_embeddings(model_name).embed_documents(texts), dtype=np.float32)
+        return vectors.reshape(n, -1), {"workers": 1, "threads": None}
+
+    from multiprocessing import shared_memory
+
+    threads = threads_per_worker or max(1, cores // workers)
+    dim = len(_get_embeddings(model_name).embed_query("dim"))
+    shard = max(EMBED_MIN_SHARD, -(-n // (workers * EMBED_SHARDS_PER_WORKER)))
+    shm = shared_memory.SharedMemory(create=True, size=n * dim * 4)
+    try:
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=ctx,
+            initializer=_embed_worker_init,
+            initargs=(model_name, threads),
+        ) as ex:
+            futures = [
+                ex.submit(_embed_worker_run, shm.name, (n, dim), i, texts[i:i + shard])
+                for i in range(0, n, shard)
+            ]
+            done = sum(f.result() for f in futures)
+        if done != n:
+            raise RuntimeError(f"Embedding paralelo incompleto: {done}/{n}")
+        vectors = np.ndarray((n, dim), dtype=np.float32, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    debug(f"Embedding paralelo: {n} chunks | {workers} processos x {threads} threads | shards de {shard}")
+    return vectors, {"workers": workers, "threads": threads}
+
+
+# ---------------------------- Governança de builds ---------------------------- #
+def _query_heartbeat_path(index_path: Path) -> Path:
+    return index_path / QUERY_HEARTBEAT_FILE
+
+
+def _touch_query_heartbeat(index_paths: List[Path]) -> None:
+    """Sinaliza uma consulta em andamento para builds governados dos índices (mtime do heartbeat)."""
+    for index_path in index_paths:
+        try:
+            _query_heartbeat_path(index_path).touch()
+        except OSError:
+            pass
+
+
+def _rss_mb() -> float:
+    """Memória residente atual do processo (MB)."""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil  # type: ignore
+
+        return psutil.Process().memory_info().rss / 2**20
+    except Exception:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _recent_query_latencies(since: float) -> List[float]:
+    """Latências (ms) das consultas registradas no arquivo de métricas desde `since` (lê só o fim do arquivo)."""
+    out: List[float] = []
+    try:
+        with open(_METRICS_FILE, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 256 * 1024))
+            lines = f.read().decode("utf-8", errors="ignore").splitlines()
+    except OSError:
+        return out
+    for line in lines:
+        if '"type": "query"' not in line:
+            continue
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            continue
+        if rec.get("timestamp", 0) >= since and rec.get("duration_s") is not None:
+            out.append(float(rec["duration_s"]) * 1000.0)
+    return out
+
+
+class BuildAborted(RuntimeError):
+    """Build interrompido pelo `BuildGovernor` (ex.: teto de memória); nada é publicado."""
+
+
+class BuildGovernor:
+    """Limites de recursos para builds em segundo plano (ex.: `watch` num servidor compartilhado).
+
+    - `threads`: teto de threads intra-op do torch durante o embedding
+    - `nice`/`ionice_idle`: prioridade de CPU e de I/O do processo (best-effort, aplicadas uma vez)
+    - `max_memory_mb`: teto de RSS verificado entre lotes; estourado (mesmo após gc), o build é abortado
+    - `yield_to_queries`: entre lotes, pausa enquanto houver consulta recente no índice em build
+      (heartbeat `<index_path>/query.heartbeat`), até `max_pause_s` por pausa
+    O embedding roda em lotes de `batch_size` chunks no próprio processo (`embed_workers` não se aplica).
+    """
+
+    def __init__(
+        self,
+        threads: Optional[int] = None,
+        nice: int = 0,
+        ionice_idle: bool = False,
+        max_memory_mb: Optional[float] = None,
+        yield_to_queries: bool = False,
+        batch_size: int = GOVERNOR_BATCH_SIZE,
+        query_window_s: float = GOVERNOR_QUERY_WINDOW_S,
+        max_pause_s: float = GOVERNOR_MAX_PAUSE_S,
+    ) -> None:
+        self.threads = threads
+        self.nice = nice
+        self.ionice_idle = ionice_idle
+        self.max_memory_mb = max_memory_mb
+        self.yield_to_queries = yield_to_queries
+        self.batch_size = max(1, batch_size)
+        self.query_window_s = query_window_s
+        self.max_pause_s = max_pause_s
+        self._priority_applied = False
+        self.reset()
+
+    def reset(self, index_path: Optional[Path] = None) -> None:
+        """Zera as estatísticas para um novo build; `index_path` define o heartbeat observado."""
+        self.heartbeat = _query_heartbeat_path(index_path) if index_path is not None else None
+        self.stats: Dict[str, Any] = {"batches": 0, "pauses": 0, "paused_s": 0.0, "peak_rss_mb": 0.0}
+
+    def apply_priority(self) -> None:
+        """nice/ionice do processo (irreversíveis sem privilégios; aplicados uma única vez)."""
+        if self._priority_applied:
+            return
+        self._priority_applied = True
+        if self.nice:
+            try:
+                os.nice(self.nice)
+            except (OSError, AttributeError) as e:
+                debug(f"nice indisponível: {e}")
+        if self.ionice_idle:
+            try:
+                import psutil  # type: ignore
+
+                psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)
+            except Exception:
+                try:
+                    import subprocess
+
+                    subprocess.run(["ionice", "-c", "3", "-p", str(os.getpid())], check=True, capture_output=True)
+                except Exception as e:
+                    debug(f"ionice indisponível: {e}")
+
+    def _query_active(self) -> bool:
+        if self.heartbeat is None:
+            return False
+        try:
+            return time.time() - self.heartbeat.stat().st_mtime < self.query_window_s
+        except OSError:
+            return False
+
+    def checkpoint(self) -> None:
+        """Ponto de cessão entre lotes: verifica memória e pausa enquanto houver consultas ativas."""
+        rss = _rss_mb()
+        if self.max_memory_mb and rss > self.max_memory_mb:
+            import gc
+
+            gc.collect()
+            rss = _rss_mb()
+            if rss > self.max_memory_mb:
+                raise BuildAborted(f"Build abortado: RSS {rss:.0f} MB acima do teto de {self.max_memory_mb:.0f} MB")
+        self.stats["peak_rss_mb"] = round(max(self.stats["peak_rss_mb"], rss), 1)
+        if not self.yield_to_queries or not self._query_active():
+            return
+        p0 = time.perf_counter()
+        self.stats["pauses"] += 1
+        while self._query_active() and time.perf_counter() - p0 < self.max_pause_s:
+            time.sleep(GOVERNOR_PAUSE_S)
+        self.stats["paused_s"] = round(self.stats["paused_s"] + time.perf_counter() - p0, 3)
+
+    def embed(self, texts: List[str], model_name: str = DEFAULT_MODEL) -> Any:
+        """Embute `texts` em lotes pequenos, com teto de threads e checkpoints entre lotes."""
+        import numpy as np  # type: ignore
+
+        self.apply_priority()
+        emb = _get_embeddings(model_name)
+        torch_mod: Any = None
+        prev_threads: Optional[int] = None
+        if self.threads:
+            try:
+                import torch  # type: ignore
+
+                torch_mod = torch
+                prev_threads = torch.get_num_threads()
+                torch.set_num_threads(self.threads)
+            except Exception:
+                torch_mod = None
+        try:
+            parts: List[Any] = []
+            for i in range(0, len(texts), self.batch_size):
+                self.checkpoint()
+                parts.append(np.asarray(emb.embed_documents(texts[i:i + self.batch_size]), dtype=np.float32))
+                self.stats["batches"] += 1
+            self.checkpoint()
+        finally:
+            if torch_mod is not None and prev_threads:
+                torch_mod.set_num_threads(prev_threads)
+        return np.vstack(parts) if parts else np.zeros((0, 0), dtype=np.float32)
+
+    def report(self, started: float, chunks: int) -> Dict[str, Any]:
+        """Vazão do build e p99 das consultas concorrentes (do arquivo de métricas) no período."""
+        elapsed = time.time() - started
+        lat = sorted(_recent_query_latencies(started))
+        p99 = lat[min(len(lat) - 1, max(0, -(-99 * len(lat) // 100) - 1))] if lat else None
+        return {
+            **self.stats,
+            "threads": self.threads,
+            "nice": self.nice or None,
+            "chunks_per_s": round(chunks / elapsed, 1) if elapsed > 0 else None,
+            "queries_during_build": len(lat),
+            "query_p99_ms": round(p99, 2) if p99 is not None else None,
+        }
+
+
+def load_index(index_path: Path, model_name: str = DEFAULT_MODEL, embeddings: Any = None):
+    if embeddings is None:
+        embeddings = _get_embeddings(model_name)
+    index_dir = resolve_index_dir(index_path)
 
     # Try to load FAISS
     try:
         vs = FAISS.load_local(
-            str(index_path), embeddings, allow_dangerous_deserialization=True
+            str(index_dir), embeddings, allow_dangerous_deserialization=True
         )
+        # índice reduzido: consultas passam pela mesma projeção do build
+        proj = load_projection(index_dir)
+        if proj is not None:
+            vs.embedding_function = _ProjectedEmbeddings(embeddings, proj)
+            vs._rag_projection = proj
         return vs, "faiss", embeddings
     except Exception:
         pass
@@ -320,7 +1835,7 @@ def load_index(index_path: Path, model_name: str = DEFAULT_MODEL):
         try:
             vs = Chroma(
                 embedding_function=embeddings,
-                persist_directory=str(index_path),
+                persist_directory=str(index_dir),
             )
             return vs, "chroma", embeddings
         except Exception:
@@ -331,6 +1846,968 @@ def load_index(index_path: Path, model_name: str = DEFAULT_MODEL):
     )
 
 
+class _IndexCache:
+    """Índices carregados por processo, com hot-reload quando a geração `current` muda.
+
+    Leitores de longa duração (servidor de consultas, rag_eval) reutilizam o índice em memória e
+    passam a usar a nova geração na primeira consulta após a publicação, sem reiniciar.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str], Tuple[str, Any, str, Any]] = {}
+
+    def get(self, index_path: Path, model_name: str = DEFAULT_MODEL, embeddings: Any = None) -> Tuple[Any, str, Any, str]:
+        """Retorna (vectorstore, backend, embeddings, token da geração)."""
+        key = (str(index_path.resolve()), model_name)
+        token = _generation_token(index_path)
+        with self._lock:
+            ent = self._entries.get(key)
+        if ent is not None and ent[0] == token:
+            return ent[1], ent[2], ent[3], token
+        vs, backend, emb = load_index(index_path, model_name=model_name, embeddings=embeddings)
+        with self._lock:
+            self._entries[key] = (token, vs, backend, emb)
+        if ent is not None:
+            debug(f"Hot-reload: {index_path} → geração {token}")
+        return vs, backend, emb, token
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+_INDEX_CACHE = _IndexCache()
+
+
+# ------------------------- Manutenção do índice ------------------------- #
+def _dir_bytes(path: Path) -> int:
+    total = 0
+    for p in path.rglob("*"):
+        try:
+            if p.is_file():
+                total += p.stat().st_size
+        except OSError:
+            pass
+    return total
+
+
+def _index_entries(vs: Any, backend: str) -> Tuple[List[Tuple[str, Optional[Document], Any]], Dict[str, Any]]:
+    """Lê todas as entradas do índice: [(id, documento ou None, vetor)] + contadores brutos.
+
+    No FAISS percorre o mapeamento posição → id (vetores sem documento viram None); no Chroma lê a
+    coleção inteira com embeddings.
+    """
+    import numpy as np  # type: ignore
+
+    entries: List[Tuple[str, Optional[Document], Any]] = []
+    if backend == "faiss":
+        store = getattr(vs.docstore, "_dict", {})
+        ntotal = int(vs.index.ntotal)
+        for pos in range(ntotal):
+            cid = vs.index_to_docstore_id.get(pos)
+            doc = store.get(cid) if cid is not None else None
+            entries.append((str(cid), doc if isinstance(doc, Document) else None, vs.index.reconstruct(pos)))
+        mapped = set(vs.index_to_docstore_id.values())
+        raw = {
+            "vectors": ntotal,
+            "dim": int(vs.index.d),
+            "docstore_entries": len(store),
+            "unmapped_positions": sum(1 for pos in range(ntotal) if pos not in vs.index_to_docstore_id),
+            "orphan_docstore_entries": len(set(store) - mapped),
+        }
+        return entries, raw
+
+    res = vs._collection.get(include=["documents", "metadatas", "embeddings"])
+    ids = res.get("ids") or []
+    docs = res.get("documents")
+    metas = res.get("metadatas")
+    vecs = res.get("embeddings")
+    docs = [None] * len(ids) if docs is None else docs
+    metas = [None] * len(ids) if metas is None else metas
+    vecs = [None] * len(ids) if vecs is None else vecs
+    for cid, text, meta, vec in zip(ids, docs, metas, vecs):
+        doc = Document(page_content=text, metadata=dict(meta or {})) if text is not None else None
+        entries.append((str(cid), doc, np.asarray(vec, dtype=np.float32) if vec is not None else None))
+    dim = len(vecs[0]) if len(vecs) and vecs[0] is not None else 0
+    raw = {
+        "vectors": len(ids),
+        "dim": dim,
+        "docstore_entries": sum(1 for d in docs if d is not None),
+        "unmapped_positions": 0,
+        "orphan_docstore_entries": 0,
+    }
+    return entries, raw
+
+
+def _entry_key(doc: Document) -> str:
+    """Identidade de conteúdo de uma entrada: arquivo + offset + texto (repetições legítimas em
+    offsets diferentes do mesmo arquivo não contam como duplicatas)."""
+    fp = str(doc.metadata.get("file_path") or doc.metadata.get("source") or "")
+    start = doc.metadata.get("start_index")
+    return hashlib.sha1(f"{fp}\0{start}\0{doc.page_content}".encode("utf-8")).hexdigest()
+
+
+def _existing_paths(doc: Document, root: Path) -> Tuple[List[str], List[str]]:
+    """Arquivos de origem de um chunk (inclui os `file_paths` da deduplicação) divididos em
+    (existentes, removidos) sob `root`."""
+    alive: List[str] = []
+    gone: List[str] = []
+    for fp in _doc_file_paths(doc):
+        if not fp:
+            continue
+        p = Path(fp)
+        (alive if (p if p.is_absolute() else root / p).exists() else gone).append(fp)
+    return alive, gone
+
+
+_POSITION_KEYS = ("start_index", "end_index", "section_index", "header_path", "h1", "h2", "h3")
+
+
+def _relocate_chunk(meta: Dict[str, Any], text: str, file_path: str, root: Path) -> None:
+    """Recalcula os campos posicionais de `meta` (offsets, seção, cabeçalhos) para `file_path`, o novo
+    representante de um chunk deduplicado. Se o texto não está no arquivo (quase-duplicata), os campos
+    são removidos: sem offsets/seção o chunk não é fundido com vizinhos no empacotamento de contexto."""
+    for key in _POSITION_KEYS:
+        meta.pop(key, None)
+    p = Path(file_path)
+    try:
+        source = (p if p.is_absolute() else root / p).read_text(encoding="utf-8")
+    except (OSError, UnicodeDecodeError):
+        return
+    pos = source.find(text)
+    if pos < 0:
+        return
+    for sec in split_markdown([Document(page_content=source, metadata={})]):
+        if sec.start <= pos < sec.end:
+            meta.update(sec.to_document().metadata)
+            break
+    meta["start_index"], meta["end_index"] = pos, pos + len(text)
+
+
+def inspect_index(index_path: Path, model_name: str = DEFAULT_MODEL, root: Optional[Path] = None) -> Dict[str, Any]:
+    """Estatísticas e verificação de integridade da geração atual do índice.
+
+    Reporta vetores, bytes por vetor (em disco), tamanho do docstore e chunks por arquivo, e verifica
+    a correspondência 1:1 vetor ↔ documento: vetores sem documento, documentos sem vetor, ids
+    repetidos, entradas duplicadas (mesmo arquivo + offset + conteúdo) e, com `root`, chunks cujos
+    arquivos de origem (todos os `file_paths`) não existem mais ou que citam arquivos removidos.
+    """
+    vs, backend, _ = load_index(index_path, model_name=model_name)
+    index_dir = resolve_index_dir(index_path)
+    entries, raw = _index_entries(vs, backend)
+
+    per_file: Dict[str, int] = {}
+    seen_ids: Set[str] = set()
+    seen_content: Set[str] = set()
+    dup_ids = dup_content = missing_docs = orphaned = stale_paths = 0
+    missing_files: Set[str] = set()
+    for cid, doc, _ in entries:
+        if cid in seen_ids:
+            dup_ids += 1
+        seen_ids.add(cid)
+        if doc is None:
+            missing_docs += 1
+            continue
+        fp = str(doc.metadata.get("file_path") or doc.metadata.get("source") or "")
+        per_file[fp] = per_file.get(fp, 0) + 1
+        key = _entry_key(doc)
+        if key in seen_content:
+            dup_content += 1
+        seen_content.add(key)
+        if root is not None:
+            alive, gone = _existing_paths(doc, root)
+            missing_files.update(gone)
+            if gone and not alive:
+                orphaned += 1
+            elif gone:
+                stale_paths += 1
+
+    if backend == "faiss":
+        vec_bytes = (index_dir / "index.faiss").stat().st_size if (index_dir / "index.faiss").exists() else 0
+        store_bytes = (index_dir / "index.pkl").stat().st_size if (index_dir / "index.pkl").exists() else 0
+    else:
+        vec_bytes = _dir_bytes(index_dir)
+        store_bytes = vec_bytes
+    n = raw["vectors"]
+    proj = load_projection(index_dir)
+    projection = None if proj is None else {
+        "method": proj["method"],
+        "source_dim": int(proj["components"].shape[0]),
+        "target_dim": int(proj["components"].shape[1]),
+    }
+    problems = {
+        "vectors_without_doc": missing_docs,
+        "unmapped_positions": raw["unmapped_positions"],
+        "orphan_docstore_entries": raw["orphan_docstore_entries"],
+        "duplicate_ids": dup_ids,
+        "duplicate_entries": dup_content,
+        "chunks_from_missing_files": orphaned,
+        "chunks_citing_missing_files": stale_paths,
+    }
+    return {
+        "index_path": str(index_path),
+        "generation": current_generation(index_path),
+        "backend": backend,
+        "vectors": n,
+        "dim": raw["dim"],
+        "bytes_per_vector": round(vec_bytes / n, 1) if n else None,
+        "projection": projection,
+        "index_bytes": vec_bytes,
+        "docstore_entries": raw["docstore_entries"],
+        "docstore_bytes": store_bytes,
+        "files": len(per_file),
+        "chunks_per_file": dict(sorted(per_file.items(), key=lambda kv: (-kv[1], kv[0]))),
+        "missing_files": sorted(missing_files),
+        "problems": problems,
+        "healthy": not any(problems.values()),
+    }
+
+
+def compact_index(
+    index_path: Path,
+    model_name: str = DEFAULT_MODEL,
+    root: Optional[Path] = None,
+    keep_generations: int = DEFAULT_KEEP_GENERATIONS,
+) -> Dict[str, Any]:
+    """Compacta o índice online: publica uma nova geração só com entradas válidas e únicas.
+
+    Vetores sem documento, ids/entradas duplicados e (com `root`) chunks sem nenhum arquivo de
+    origem existente são descartados; chunks deduplicados que ainda têm alguma origem são mantidos,
+    com `file_path`/`file_paths` reescritos para os arquivos sobreviventes (e offsets/seção recalculados
+    quando o representante muda, ver `_relocate_chunk`). Os vetores restantes são
+    reaproveitados (sem re-embedding). Consultas em andamento seguem na geração anterior até a
+    troca atômica do ponteiro `current`.
+    """
+    import numpy as np  # type: ignore
+
+    t0 = time.perf_counter()
+    vs, backend, embeddings = load_index(index_path, model_name=model_name)
+    entries, _ = _index_entries(vs, backend)
+    kept: List[Tuple[str, Document, Any]] = []
+    seen_ids: Set[str] = set()
+    seen_content: Set[str] = set()
+    for cid, doc, vec in entries:
+        if doc is None or vec is None or cid in seen_ids:
+            continue
+        meta = {**doc.metadata, "chunk_id": doc.metadata.get("chunk_id") or cid}
+        if root is not None:
+            alive, gone = _existing_paths(doc, root)
+            if gone and not alive:
+                continue
+            if gone:
+                if meta.get("file_path") != alive[0]:
+                    _relocate_chunk(meta, doc.page_content, alive[0], root)
+                meta["file_path"] = alive[0]
+                if len(alive) > 1:
+                    meta["file_paths"] = alive
+                else:
+                    meta.pop("file_paths", None)
+        doc = Document(page_content=doc.page_content, metadata=meta)
+        key = _entry_key(doc)
+        if key in seen_content:
+            continue
+        seen_ids.add(cid)
+        seen_content.add(key)
+        kept.append((cid, doc, vec))
+    del vs
+    if not kept:
+        raise RuntimeError(f"Compactação abortada: nenhuma entrada válida em {index_path}")
+
+    generation, staging = _stage_generation(index_path)
+    try:
+        if backend == "faiss":
+            FAISS.from_embeddings(
+                [(d.page_content, v) for _, d, v in kept],
+                embeddings,
+                metadatas=[d.metadata for _, d, _ in kept],
+                ids=[cid for cid, _, _ in kept],
+            ).save_local(str(staging))
+        else:
+            cvs = Chroma(embedding_function=embeddings, persist_directory=str(staging))
+            for i in range(0, len(kept), CHROMA_BATCH_SIZE):
+                batch = kept[i:i + CHROMA_BATCH_SIZE]
+                cvs._collection.upsert(
+                    ids=[cid for cid, _, _ in batch],
+                    embeddings=[np.asarray(v, dtype=np.float32).tolist() for _, _, v in batch],
+                    documents=[d.page_content for _, d, _ in batch],
+                    metadatas=[_chroma_metadata(d.metadata) for _, d, _ in batch],
+                )
+            del cvs
+        proj = load_projection(resolve_index_dir(index_path)) if backend == "faiss" else None
+        if proj is not None:
+            save_projection(staging, proj)
+        vecs = [v for _, _, v in kept]
+        _write_facets(staging, [d for _, d, _ in kept])
+        _write_hierarchy(staging, [d for _, d, _ in kept], lift_projection(proj, vecs) if proj is not None else vecs)
+        _publish_generation(index_path, generation, staging, keep=keep_generations)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    stats = {
+        "generation": generation,
+        "before": len(entries),
+        "after": len(kept),
+        "removed": len(entries) - len(kept),
+        "duration_s": round(time.perf_counter() - t0, 4),
+    }
+    debug(f"Compactação: {stats['before']} → {stats['after']} vetores (geração {generation})")
+    return stats
+
+
+def print_maintenance_report(report: Dict[str, Any], top_files: int = 20) -> None:
+    print(f"\n=== ÍNDICE {report['index_path']} ===")
+    print(f"geração: {report['generation'] or '(legado)'} | backend: {report['backend']}")
+    print(f"vetores: {report['vectors']} (dim {report['dim']}) | bytes/vetor em disco: {report['bytes_per_vector']}")
+    if report.get("projection"):
+        pr = report["projection"]
+        print(f"projeção: {pr['method']} {pr['source_dim']} → {pr['target_dim']}")
+    print(f"docstore: {report['docstore_entries']} entradas | {report['docstore_bytes']} bytes")
+    print(f"arquivos: {report['files']}")
+    for fp, n in list(report["chunks_per_file"].items())[:top_files]:
+        print(f"  {n:5d}  {fp}")
+    if report["files"] > top_files:
+        print(f"  ... (+{report['files'] - top_files} arquivos)")
+    print("integridade: " + ("OK" if report["healthy"] else "PROBLEMAS"))
+    for name, n in report["problems"].items():
+        if n:
+            print(f"  {name}: {n}")
+
+
+def _lift_hits(vs: Any, hits: List[Tuple[Document, Any]]) -> List[Tuple[Document, Any]]:
+    """Vetores de índices reduzidos voltam ao espaço completo (MMR/score federado com a consulta completa)."""
+    proj = getattr(vs, "_rag_projection", None)
+    if proj is None or not hits:
+        return hits
+    lifted = lift_projection(proj, [v for _, v in hits])
+    return [(d, v) for (d, _), v in zip(hits, lifted)]
+
+
+def _search_with_vectors(
+    vs: Any,
+    backend: str,
+    qvec: List[float],
+    fetch_k: int,
+    where: Optional[Dict[str, Any]] = None,
+    allowed: Optional[Set[str]] = None,
+) -> List[Tuple[Document, Any]]:
+    """Busca os `fetch_k` vizinhos mais próximos de `qvec` retornando também seus vetores.
+
+    `where` (filtro de metadados) é aplicado dentro do Chroma; no FAISS os filtros seguem client-side.
+    `allowed` (chunk ids vindos das facetas) restringe a busca: no FAISS os vetores desses ids são
+    lidos do índice e pontuados diretamente; no Chroma vira `chunk_id $in` no `where`.
+    """
+    import numpy as np  # type: ignore
+
+    out: List[Tuple[Document, Any]] = []
+    if allowed is not None and not allowed:
+        return out
+    if backend == "faiss" and allowed is not None:
+        pos_by_id = getattr(vs, "_rag_positions", None)
+        if pos_by_id is None:
+            pos_by_id = {cid: pos for pos, cid in vs.index_to_docstore_id.items()}
+            vs._rag_positions = pos_by_id
+        positions = sorted(pos_by_id[cid] for cid in allowed if cid in pos_by_id)
+        if not positions:
+            return out
+        mat = np.vstack([vs.index.reconstruct(int(pos)) for pos in positions])
+        q = np.asarray(_store_query(vs, qvec), dtype=np.float32)
+        sims = mat @ q / ((np.linalg.norm(mat, axis=1) * (float(np.linalg.norm(q)) or 1.0)) + 1e-12)
+        for j in np.argsort(-sims)[:fetch_k]:
+            doc = vs.docstore.search(vs.index_to_docstore_id[positions[int(j)]])
+            if isinstance(doc, Document):
+                out.append((doc, mat[int(j)]))
+        return _lift_hits(vs, out)
+    if backend == "faiss":
+        n = min(fetch_k, int(vs.index.ntotal))
+        if n <= 0:
+            return out
+        q = np.array([_store_query(vs, qvec)], dtype=np.float32)
+        if getattr(vs, "_normalize_L2", False):
+            import faiss  # type: ignore
+            faiss.normalize_L2(q)
+        _, indices = vs.index.search(q, n)
+        for i in indices[0]:
+            if i == -1:
+                continue
+            doc = vs.docstore.search(vs.index_to_docstore_id[int(i)])
+            if isinstance(doc, Document):
+                out.append((doc, vs.index.reconstruct(int(i))))
+        return _lift_hits(vs, out)
+
+    if allowed is not None:
+        in_ids = {"chunk_id": {"$in": sorted(allowed)}}
+        where = {"$and": [where, in_ids]} if where else in_ids
+    res = vs._collection.query(
+        query_embeddings=[qvec],
+        n_results=fetch_k,
+        where=where,
+        include=["documents", "metadatas", "embeddings"],
+    )
+    texts = (res.get("documents") or [[]])[0]
+    metas = (res.get("metadatas") or [[]])[0]
+    vecs = (res.get("embeddings") or [[]])[0]
+    for text, meta, vec in zip(texts, metas, vecs):
+        out.append((Document(page_content=text or "", metadata=dict(meta or {})), np.asarray(vec, dtype=np.float32)))
+    return out
+
+
+def _federated_search(
+    stores: List[Tuple[Path, Any, str]],
+    qvec: List[float],
+    k: int,
+    fetch_k: int,
+    lambda_mult: float,
+    max_workers: Optional[int] = None,
+    where: Optional[Dict[str, Any]] = None,
+    allowed: Optional[Dict[str, Set[str]]] = None,
+) -> List[Document]:
+    """Busca em vários índices em paralelo, une os candidatos por score (cosseno) e aplica MMR global.
+
+    `allowed` mapeia index_path → chunk ids permitidos (facetas); índices ausentes não são restritos.
+    """
+    import numpy as np  # type: ignore
+    from langchain_community.vectorstores.utils import maximal_marginal_relevance  # type: ignore
+
+    workers = max(1, min(len(stores), max_workers or 8))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rag-search") as ex:
+        per_store = list(ex.map(
+            lambda st: _search_with_vectors(
+                st[1], st[2], qvec, fetch_k,
+                where=where if st[2] == "chroma" else None,
+                allowed=(allowed or {}).get(str(st[0])),
+            ),
+            stores,
+        ))
+
+    q = np.asarray(qvec, dtype=np.float32)
+    q_norm = float(np.linalg.norm(q)) or 1.0
+    cands: List[Tuple[float, Document, Any]] = []
+    for (path, _, _), hits in zip(stores, per_store):
+        for doc, vec in hits:
+            v = np.asarray(vec, dtype=np.float32)
+            score = float(np.dot(q, v) / (q_norm * (float(np.linalg.norm(v)) or 1.0)))
+            meta = {**doc.metadata, "index_path": str(path), "score": round(score, 6)}
+            cands.append((score, Document(page_content=doc.page_content, metadata=meta), v))
+    if not cands:
+        return []
+    cands.sort(key=lambda c: c[0], reverse=True)
+    cands = cands[:fetch_k]
+    selected = maximal_marginal_relevance(
+        np.array([q], dtype=np.float32),
+        [c[2] for c in cands],
+        k=min(k, len(cands)),
+        lambda_mult=lambda_mult,
+    )
+    return [cands[i][1] for i in selected]
+
+
+def _retrieve(
+    q: str,
+    qvec: List[float],
+    stores: List[Tuple[Path, Any, str]],
+    embeddings: Any,
+    k: int,
+    fetch_k: int,
+    lambda_mult: float,
+    filter_step: Optional[str],
+    filter_rule_type: Optional[str],
+    filter_priority: Optional[str],
+    compress: bool,
+    similarity_threshold: float,
+    max_workers: Optional[int] = None,
+    always_apply: bool = False,
+    applies_to: Optional[str] = None,
+    hierarchical_sections: Optional[int] = None,
+    stats: Optional[Dict[str, Any]] = None,
+    planner: Optional[QueryPlanner] = None,
+) -> List[Document]:
+    """MMR (índice único ou federado) + compressão opcional + filtro de metadados.
+
+    Filtros tipados (`always_apply`, `applies_to`) são resolvidos nas facetas de cada índice e
+    restringem a busca aos chunk ids correspondentes; índices sem facetas filtram client-side.
+    Com `hierarchical_sections`, uma busca grossa (arquivos → seções) escolhe as seções candidatas
+    e o MMR fino roda apenas sobre os chunks delas; índices sem hierarquia seguem na busca plana.
+    Com `planner` (consulta com prazo) o `fetch_k` e a compressão se ajustam ao tempo restante.
+    """
+    planner = planner or QueryPlanner()
+    if fetch_k > k:
+        fetch_k = planner.plan_fetch_k(k, fetch_k)
+    # Filtros de metadados empurrados para o Chroma (where); FAISS segue com filtro client-side
+    where = _chroma_where(filter_step, filter_rule_type, filter_priority)
+
+    allowed: Optional[Dict[str, Set[str]]] = None
+    post_facets = False
+    if always_apply or applies_to:
+        allowed = {}
+        for path, _, _ in stores:
+            facets = load_facets(path)
+            if facets is None:
+                post_facets = True
+                continue
+            ids = facet_chunk_ids(facets, always_apply=always_apply, applies_to=applies_to)
+            if ids is not None:
+                allowed[str(path)] = ids
+        planner.mark("facets")
+
+    if hierarchical_sections:
+        allowed = allowed if allowed is not None else {}
+        chosen_sections = candidates = 0
+        for path, _, _ in stores:
+            hier = load_hierarchy(path)
+            if hier is None:
+                continue
+            ids, chosen = hierarchical_chunk_ids(hier, qvec, sections=hierarchical_sections)
+            prev = allowed.get(str(path))
+            allowed[str(path)] = ids if prev is None else ids & prev
+            chosen_sections += len(chosen)
+            candidates += len(allowed[str(path)])
+        if stats is not None:
+            stats["hierarchical"] = {"sections": chosen_sections, "candidates": candidates}
+        planner.mark("hierarchy")
+
+    if len(stores) > 1 or allowed:
+        raw_docs = _federated_search(
+            stores, qvec, k=k, fetch_k=fetch_k,
+            lambda_mult=lambda_mult, max_workers=max_workers, where=where, allowed=allowed,
+        )
+    else:
+        _, vs, backend = stores[0]
+        search_kwargs: Dict[str, Any] = {}
+        if backend == "chroma" and where:
+            search_kwargs["filter"] = where
+        raw_docs = vs.max_marginal_relevance_search_by_vector(
+            _store_query(vs, qvec), k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, **search_kwargs
+        )
+    planner.observe("search_per_candidate", planner.mark("search") / max(1, fetch_k))
+
+    # Optional compression
+    if compress and raw_docs and planner.allows("compress", planner.estimate("compress_per_doc") * len(raw_docs)):
+        compressor = EmbeddingsFilter(
+            embeddings=embeddings, similarity_threshold=similarity_threshold
+        )
+        n_in = len(raw_docs)
+        raw_docs = list(compressor.compress_documents(raw_docs, q))
+        planner.observe("compress_per_doc", planner.mark("compress") / n_in, probe="compress" in planner.probes)
+
+    # Metadata pre-filtering by re-ranking (client-side filter after retrieval)
+    def ok(d: Document) -> bool:
+        if filter_step and d.metadata.get("step") != filter_step:
+            return False
+        if filter_rule_type and d.metadata.get("rule_type") != filter_rule_type:
+            return False
+        if filter_priority and d.metadata.get("priority") != filter_priority:
+            return False
+        if post_facets and str(d.metadata.get("index_path")) not in (allowed or {}):
+            if always_apply and not d.metadata.get("always_apply"):
+                return False
+            if applies_to and not (
+                d.metadata.get("always_apply") or glob_applies(_as_globs(d.metadata.get("globs")), applies_to)
+            ):
+                return False
+        return True
+
+    return [d for d in raw_docs if ok(d)]
+
+
+def _filter_by_path(
+    docs: List[Document],
+    root: Optional[Path],
+    include_dirs: Optional[List[Path]],
+    exclude_dirs: Optional[Set[str]],
+    include_exts: Optional[Set[str]],
+    ignore_files: Optional[List[Path]],
+) -> List[Document]:
+    """Filtro client-side por pastas/extensões/ignores (qualquer arquivo de origem do chunk)."""
+    base_root = root or Path(".")
+    ignore_entries: Set[str] = set()
+    if ignore_files:
+        ignore_entries = _parse_ignore_files(ignore_files)
+    eff_exclude = set(exclude_dirs or set()) | ignore_entries
+
+    def path_ok(fp: Optional[str]) -> bool:
+        if not fp:
+            return False
+        p = Path(fp)
+        if not p.is_absolute():
+            p = (base_root / p).resolve()
+        # include_dirs: manter apenas dentro de algum include dir
+        inside_any = True
+        if include_dirs:
+            inside_any = False
+            for d in include_dirs:
+                d_abs = d if d.is_absolute() else (base_root / d)
+                try:
+                    p.resolve().relative_to(d_abs.resolve())
+                    inside_any = True
+                    break
+                except Exception:
+                    pass
+            if not inside_any:
+                return False
+        # exclude/ignore dirs NÃO sobrepõem include_dirs (se inside_any True, só verificamos exts)
+        if not include_dirs:
+            parts = set(p.parts)
+            if parts & eff_exclude:
+                return False
+        # include_exts
+        if include_exts:
+            exts = {e if e.startswith('.') else f'.{e}' for e in include_exts}
+            if p.suffix.lower() not in exts:
+                return False
+        return True
+
+    return [d for d in docs if any(path_ok(fp) for fp in _doc_file_paths(d))]
+
+
+# --------------------------- Cache semântico --------------------------- #
+class SemanticQueryCache:
+    """Cache semântico de consultas: reaproveita resultados de consultas parafraseadas.
+
+    Entradas guardam (vetor da consulta, chave de filtros/parâmetros/geração, ids e documentos
+    resultantes). Uma nova consulta com a mesma chave e vetor a distância de cosseno <= max_distance
+    de uma entrada devolve os resultados cacheados, pulando MMR, compressão e rerank.
+    Tamanho limitado com despejo LRU ou LFU; `path` opcional persiste o cache em JSON, no máximo a
+    cada `save_interval_s` e ao encerrar o processo (`flush`).
+    """
+
+    def __init__(
+        self,
+        max_entries: int = SEMANTIC_CACHE_SIZE,
+        policy: str = "lru",
+        path: Optional[Path] = None,
+        save_interval_s: float = SEMANTIC_CACHE_SAVE_INTERVAL_S,
+    ) -> None:
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Política de cache desconhecida: {policy} (use lru ou lfu)")
+        self.max_entries = max(1, max_entries)
+        self.policy = policy
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._by_key: Dict[str, List[int]] = {}
+        self._next_id = 0
+        self._loaded = path is None
+        self.save_interval_s = save_interval_s
+        self._dirty = False
+        self._last_save = time.monotonic()
+        self.stats: Dict[str, int] = {"lookups": 0, "hits": 0, "misses": 0, "evictions": 0}
+        if path is not None:
+            atexit.register(self.flush)
+
+    @staticmethod
+    def _unit(vec: Any) -> Any:
+        import numpy as np  # type: ignore
+
+        v = np.asarray(vec, dtype=np.float32)
+        n = float(np.linalg.norm(v))
+        return v / n if n else v
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            if self.path and self.path.exists():
+                data = json.loads(self.path.read_text(encoding="utf-8"))
+                for e in data.get("entries", []):
+                    docs = [Document(page_content=d["page_content"], metadata=d.get("metadata") or {}) for d in e["docs"]]
+                    self._insert(e["key"], self._unit(e["vec"]), docs, int(e.get("hits", 0)))
+        except Exception as ex:
+            debug(f"Cache semântico ignorado ({self.path}): {ex}")
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        self._dirty = False
+        self._last_save = time.monotonic()
+        data = {"entries": [
+            {
+                "key": e["key"],
+                "vec": [round(float(x), 6) for x in e["vec"]],
+                "hits": e["hits"],
+                "ids": e["ids"],
+                "docs": [{"page_content": d.page_content, "metadata": d.metadata} for d in e["docs"]],
+            }
+            for e in self._entries.values()
+        ]}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f".{self.path.name}.{uuid.uuid4().hex[:6]}")
+            tmp.write_text(json.dumps(data, ensure_ascii=False, default=str), encoding="utf-8")
+            os.replace(tmp, self.path)
+        except Exception as ex:
+            debug(f"Falha ao salvar cache semântico: {ex}")
+
+    def _insert(self, key: str, vec: Any, docs: List[Document], hits: int = 0) -> None:
+        eid = self._next_id
+        self._next_id += 1
+        self._entries[eid] = {
+            "key": key,
+            "vec": vec,
+            "docs": docs,
+            "ids": [_chunk_id(d) for d in docs],
+            "hits": hits,
+        }
+        self._by_key.setdefault(key, []).append(eid)
+        while len(self._entries) > self.max_entries:
+            if self.policy == "lfu":
+                victim = min(self._entries, key=lambda i: self._entries[i]["hits"])
+            else:
+                victim = next(iter(self._entries))
+            self._remove(victim)
+            self.stats["evictions"] += 1
+
+    def _remove(self, eid: int) -> None:
+        e = self._entries.pop(eid)
+        ids = self._by_key.get(e["key"], [])
+        if eid in ids:
+            ids.remove(eid)
+        if not ids:
+            self._by_key.pop(e["key"], None)
+
+    def lookup(self, key: str, qvec: Any, max_distance: float) -> Optional[List[Document]]:
+        """Resultados da entrada mais próxima com a mesma chave, se dentro de `max_distance`."""
+        import numpy as np  # type: ignore
+
+        v = self._unit(qvec)
+        with self._lock:
+            self._ensure_loaded()
+            self.stats["lookups"] += 1
+            best: Optional[int] = None
+            best_dist = float("inf")
+            for eid in self._by_key.get(key, []):
+                dist = 1.0 - float(np.dot(v, self._entries[eid]["vec"]))
+                if dist < best_dist:
+                    best, best_dist = eid, dist
+            if best is None or best_dist > max_distance:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            e = self._entries[best]
+            e["hits"] += 1
+            self._entries.move_to_end(best)
+            return [Document(page_content=d.page_content, metadata=dict(d.metadata)) for d in e["docs"]]
+
+    def put(self, key: str, qvec: Any, docs: List[Document]) -> None:
+        with self._lock:
+            self._ensure_loaded()
+            stored = [Document(page_content=d.page_content, metadata=dict(d.metadata)) for d in docs]
+            self._insert(key, self._unit(qvec), stored)
+            self._dirty = True
+            if time.monotonic() - self._last_save >= self.save_interval_s:
+                self._save()
+
+    def flush(self) -> None:
+        """Grava alterações pendentes (chamado também na saída do processo)."""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.stats["lookups"]
+            return {
+                **self.stats,
+                "size": len(self._entries),
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._by_key.clear()
+            self._save()
+
+
+_SEMANTIC_CACHE = SemanticQueryCache()
+
+
+def configure_semantic_cache(
+    max_entries: int = SEMANTIC_CACHE_SIZE,
+    policy: str = "lru",
+    path: Optional[Path] = None,
+) -> SemanticQueryCache:
+    """Substitui o cache semântico do processo (tamanho, política de despejo e persistência)."""
+    global _SEMANTIC_CACHE
+    _SEMANTIC_CACHE = SemanticQueryCache(max_entries=max_entries, policy=policy, path=path)
+    return _SEMANTIC_CACHE
+
+
+class QueryPlanner:
+    """Planejamento de uma consulta com prazo: mede cada etapa e barateia as opcionais.
+
+    Sem `deadline_ms` apenas registra os tempos por etapa. Com prazo, antes de cada etapa opcional
+    compara o custo estimado (média móvel dos custos observados) com o tempo restante: reduz o
+    `fetch_k` do MMR, pula a compressão e pula ou encurta o rerank remoto. As médias móveis são
+    persistidas em `PLANNER_COSTS_FILE` no índice (ver `load_costs`/`save_costs`), e a cada
+    `DEADLINE_PROBE_EVERY` pulos de uma etapa uma consulta a executa mesmo assim (sonda), para que
+    uma estimativa pessimista possa ser corrigida. As degradações aplicadas vão para as métricas.
+    """
+
+    _costs: Dict[str, float] = dict(DEADLINE_COST_DEFAULTS)
+    _costs_lock = threading.Lock()
+    _skips: Dict[str, int] = {}
+    _loaded: Set[str] = set()
+    _dirty = False
+    _saved_at = 0.0
+    _pending: Optional[Path] = None  # índice com gravação adiada pelo intervalo (gravado no atexit)
+
+    def __init__(self, deadline_ms: Optional[float] = None) -> None:
+        self.deadline_ms = deadline_ms if deadline_ms and deadline_ms > 0 else None
+        self.start = time.perf_counter()
+        self._last = self.start
+        self.stages: Dict[str, float] = {}
+        self.degraded: List[str] = []
+        self.probes: List[str] = []
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.start) * 1000.0
+
+    def remaining_ms(self) -> Optional[float]:
+        """Tempo restante até o prazo (None = sem prazo)."""
+        if self.deadline_ms is None:
+            return None
+        return self.deadline_ms - self.elapsed_ms()
+
+    def mark(self, stage: str) -> float:
+        """Fecha a etapa `stage` (tempo desde a marca anterior) e retorna sua duração em ms."""
+        now = time.perf_counter()
+        dt = (now - self._last) * 1000.0
+        self.stages[stage] = round(self.stages.get(stage, 0.0) + dt, 3)
+        self._last = now
+        return dt
+
+    @classmethod
+    def estimate(cls, key: str) -> float:
+        with cls._costs_lock:
+            return cls._costs.get(key, 0.0)
+
+    @classmethod
+    def observe(cls, key: str, value_ms: float, probe: bool = False) -> None:
+        """Atualiza a média móvel do custo observado de uma etapa.
+
+        Medições de sonda substituem a média: a estimativa antiga é justamente a que impedia a etapa de rodar.
+        """
+        with cls._costs_lock:
+            prev = cls._costs.get(key)
+            cls._costs[key] = value_ms if prev is None or probe else (1 - DEADLINE_COST_EWMA) * prev + DEADLINE_COST_EWMA * value_ms
+            cls._dirty = True
+
+    @classmethod
+    def load_costs(cls, index_path: Path) -> None:
+        """Carrega (uma vez por processo e índice) as médias móveis gravadas por consultas anteriores."""
+        key = str(index_path)
+        with cls._costs_lock:
+            if key in cls._loaded:
+                return
+            if not cls._loaded:
+                atexit.register(cls.flush_costs)
+            cls._loaded.add(key)
+        try:
+            saved = json.loads((index_path / PLANNER_COSTS_FILE).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        with cls._costs_lock:
+            for name, value in saved.items():
+                if name in DEADLINE_COST_DEFAULTS and isinstance(value, (int, float)) and value > 0:
+                    cls._costs[name] = float(value)
+
+    @classmethod
+    def save_costs(cls, index_path: Path, force: bool = False) -> None:
+        """Grava as médias móveis no índice se houve observações novas (atômico, best-effort).
+
+        Espaçado por `PLANNER_COSTS_SAVE_INTERVAL_S` (processos longos não gravam a cada consulta);
+        `force` ignora o intervalo, usado após sondas e no encerramento do processo.
+        """
+        with cls._costs_lock:
+            now = time.monotonic()
+            if not cls._dirty:
+                return
+            if not force and cls._saved_at and now - cls._saved_at < PLANNER_COSTS_SAVE_INTERVAL_S:
+                cls._pending = index_path
+                return
+            data = {name: round(value, 4) for name, value in cls._costs.items()}
+            cls._dirty = False
+            cls._saved_at = now
+            cls._pending = None
+        tmp = index_path / f".{PLANNER_COSTS_FILE}.{uuid.uuid4().hex[:6]}"
+        try:
+            tmp.write_text(json.dumps(data), encoding="utf-8")
+            os.replace(tmp, index_path / PLANNER_COSTS_FILE)
+        except OSError as e:
+            try:
+                tmp.unlink()
+            except OSError:
+                pass
+            debug(f"Falha ao gravar custos do planejador: {e}")
+
+    @classmethod
+    def flush_costs(cls) -> None:
+        """Grava a atualização adiada pelo intervalo, se houver."""
+        if cls._pending is not None:
+            cls.save_costs(cls._pending, force=True)
+
+    def plan_fetch_k(self, k: int, fetch_k: int) -> int:
+        """Maior fetch_k (>= k) cujo custo estimado de MMR cabe no tempo restante."""
+        remaining = self.remaining_ms()
+        if remaining is None or fetch_k <= k:
+            return fetch_k
+        per = self.estimate("search_per_candidate")
+        if per <= 0 or per * fetch_k <= remaining:
+            return fetch_k
+        planned = max(k, int(max(0.0, remaining) / per))
+        if planned < fetch_k:
+            self.degraded.append(f"fetch_k:{fetch_k}->{planned}")
+            return planned
+        return fetch_k
+
+    def allows(self, stage: str, estimate_ms: float) -> bool:
+        """True se a etapa opcional cabe no tempo restante; senão registra a degradação.
+
+        A cada `DEADLINE_PROBE_EVERY` pulos seguidos a etapa roda mesmo assim (sonda): sem isso uma
+        estimativa acima do prazo nunca seria remedida.
+        """
+        remaining = self.remaining_ms()
+        if remaining is None or estimate_ms <= remaining:
+            with self._costs_lock:
+                self._skips.pop(stage, None)
+            return True
+        with self._costs_lock:
+            skips = self._skips.get(stage, 0) + 1
+            probe = skips >= DEADLINE_PROBE_EVERY
+            self._skips[stage] = 0 if probe else skips
+        if probe:
+            self.probes.append(stage)
+            return True
+        self.degraded.append(f"skip:{stage}")
+        return False
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "deadline_ms": self.deadline_ms,
+            "elapsed_ms": round(self.elapsed_ms(), 3),
+            "stages_ms": dict(self.stages),
+            "degraded": list(self.degraded),
+            "probes": list(self.probes),
+            "missed": self.deadline_ms is not None and self.elapsed_ms() > self.deadline_ms,
+        }
+
+
+def _semantic_cache_key(**params: Any) -> str:
+    """Chave canônica (JSON) dos parâmetros que afetam o resultado de uma consulta."""
+    def norm(v: Any) -> Any:
+        if isinstance(v, Path):
+            return str(v).replace("\\", "/")
+        if isinstance(v, (set, frozenset)):
+            return sorted(norm(x) for x in v)
+        if isinstance(v, (list, tuple)):
+            return [norm(x) for x in v]
+        return v
+
+    return json.dumps({k: norm(v) for k, v in sorted(params.items())}, ensure_ascii=False, default=str)
+
+
 def query_index(
     index_path: Path,
     q: str,
@@ -352,100 +2829,128 @@ def query_index(
     out_file: Optional[Path] = None,
     rerank_llm: Optional[str] = None,
     rerank_top_n: Optional[int] = None,
+    rerank_timeout: Optional[float] = None,
+    # busca federada (vários índices)
+    extra_index_paths: Optional[List[Path]] = None,
+    max_workers: Optional[int] = None,
+    # cache semântico (None desativa)
+    semantic_cache_distance: Optional[float] = None,
+    context_budget: Optional[int] = DEFAULT_CONTEXT_BUDGET,
+    # filtros tipados (facetas do frontmatter)
+    always_apply: bool = False,
+    applies_to: Optional[str] = None,
+    # busca hierárquica (None = plana): nº de seções candidatas
+    hierarchical_sections: Optional[int] = None,
+    # prazo da consulta em ms (None = sem prazo): etapas opcionais são reduzidas/puladas
+    deadline_ms: Optional[float] = None,
 ) -> List[Document]:
-    vs, backend, embeddings = load_index(index_path, model_name=model_name)
+    planner = QueryPlanner(deadline_ms)
+    QueryPlanner.load_costs(index_path)
+    index_paths = [index_path] + [p for p in (extra_index_paths or []) if p != index_path]
+    federated = len(index_paths) > 1
+    if federated:
+        embeddings = _get_embeddings(model_name)
+        workers = max(1, min(len(index_paths), max_workers or 8))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rag-load") as ex:
+            loaded = list(ex.map(lambda p: _INDEX_CACHE.get(p, model_name=model_name, embeddings=embeddings), index_paths))
+        stores = [(p, vs_, be) for p, (vs_, be, _, _) in zip(index_paths, loaded)]
+        backend = ",".join(sorted({be for _, _, be in stores}))
+        generations = [tok for _, _, _, tok in loaded]
+    else:
+        vs, backend, embeddings, token = _INDEX_CACHE.get(index_path, model_name=model_name)
+        stores = [(index_path, vs, backend)]
+        generations = [token]
+    planner.mark("load")
     q_start = time.perf_counter()
-
-    # Build base retriever with MMR
-    retriever = vs.as_retriever(
-        search_type="mmr",
-        search_kwargs={"k": k, "fetch_k": fetch_k, "lambda_mult": lambda_mult},
-    )
-
-    # Metadata pre-filtering by re-ranking (client-side filter after retrieval)
-    def metadata_filter(docs: List[Document]) -> List[Document]:
-        def ok(d: Document) -> bool:
-            if filter_step and d.metadata.get("step") != filter_step:
-                return False
-            if filter_rule_type and d.metadata.get("rule_type") != filter_rule_type:
-                return False
-            if filter_priority and d.metadata.get("priority") != filter_priority:
-                return False
-            return True
-
-        return [d for d in docs if ok(d)]
-
-    # Optional compression
-    if compress:
-        compressor = EmbeddingsFilter(
-            embeddings=embeddings, similarity_threshold=similarity_threshold
+    _touch_query_heartbeat(index_paths)
+    qvec = embeddings.embed_query(q)
+    planner.mark("embed")
+
+    # Cache semântico: consulta parafraseada (mesmos filtros/parâmetros/geração) reaproveita resultados
+    cache_key: Optional[str] = None
+    cache_hit = False
+    if semantic_cache_distance is not None:
+        cache_key = _semantic_cache_key(
+            index_paths=index_paths, generations=generations, model_name=model_name,
+            k=k, fetch_k=fetch_k, lambda_mult=lambda_mult,
+            filter_step=filter_step, filter_rule_type=filter_rule_type, filter_priority=filter_priority,
+            always_apply=always_apply, applies_to=applies_to,
+            hierarchical_sections=hierarchical_sections,
+            compress=compress, similarity_threshold=similarity_threshold,
+            root=root, include_dirs=include_dirs, exclude_dirs=exclude_dirs,
+            include_exts=include_exts, ignore_files=ignore_files,
+            rerank_llm=rerank_llm, rerank_top_n=rerank_top_n,
         )
-        c_retriever: ContextualCompressionRetriever = ContextualCompressionRetriever(
-            base_compressor=compressor, base_retriever=retriever
-        )
-        raw_docs = c_retriever.invoke(q)
+        cached = _SEMANTIC_CACHE.lookup(cache_key, qvec, max_distance=semantic_cache_distance)
+        cache_hit = cached is not None
+        planner.mark("semantic_cache")
+
+    rerank_s: Optional[float] = None
+    retrieve_stats: Dict[str, Any] = {}
+    if cache_hit:
+        docs = cached
     else:
-        raw_docs = retriever.invoke(q)
-
-    docs = metadata_filter(raw_docs)
-
-    # Optional path/extension/ignore filtering (client-side)
-    if any([include_dirs, exclude_dirs, include_exts, ignore_files]):
-        base_root = root or Path(".")
-        ignore_entries: Set[str] = set()
-        if ignore_files:
-            ignore_entries = _parse_ignore_files(ignore_files)
-        eff_exclude = set(exclude_dirs or set()) | ignore_entries
-
-        def path_ok(fp: Optional[str]) -> bool:
-            if not fp:
-                return False
-            p = Path(fp)
-            if not p.is_absolute():
-                p = (base_root / p).resolve()
-            # include_dirs: manter apenas dentro de algum include dir
-            inside_any = True
-            if include_dirs:
-                inside_any = False
-                for d in include_dirs:
-                    d_abs = d if d.is_absolute() else (base_root / d)
-                    try:
-                        p.resolve().relative_to(d_abs.resolve())
-                        inside_any = True
-                        break
-                    except Exception:
-                        pass
-                if not inside_any:
-                    return False
-            # exclude/ignore dirs NÃO sobrepõem include_dirs (se inside_any True, só verificamos exts)
-            if not include_dirs:
-                parts = set(p.parts)
-                if parts & eff_exclude:
-                    return False
-            # include_exts
-            if include_exts:
-                exts = {e if e.startswith('.') else f'.{e}' for e in include_exts}
-                if p.suffix.lower() not in exts:
-                    return False
-            return True
-
-        docs = [d for d in docs if path_ok(d.metadata.get("file_path"))]
-
-    # Optional LLM-based reranking (best-effort)
-    if rerank_llm and rerank_llm.lower() == "google" and docs:
-        try:
-            ranked = _google_rerank(q, docs, top_n=rerank_top_n or len(docs))
-            if ranked:
-                docs = ranked
-        except Exception as e:
-            debug(f"Rerank (google) falhou: {e}")
+        docs = _retrieve(
+            q, qvec, stores=stores, embeddings=embeddings,
+            k=k, fetch_k=fetch_k, lambda_mult=lambda_mult,
+            filter_step=filter_step, filter_rule_type=filter_rule_type, filter_priority=filter_priority,
+            compress=compress, similarity_threshold=similarity_threshold, max_workers=max_workers,
+            always_apply=always_apply, applies_to=applies_to,
+            hierarchical_sections=hierarchical_sections, stats=retrieve_stats, planner=planner,
+        )
 
-    # Optional aggregated output file
+        # Optional path/extension/ignore filtering (client-side)
+        if any([include_dirs, exclude_dirs, include_exts, ignore_files]):
+            docs = _filter_by_path(docs, root, include_dirs, exclude_dirs, include_exts, ignore_files)
+            planner.mark("path_filter")
+
+        # Optional LLM-based reranking (best-effort, prazo limitado e encurtado pelo prazo da consulta)
+        rerank_wanted = bool(rerank_llm and rerank_llm.lower() == "google" and docs)
+        rerank_ok = False
+        if rerank_wanted and planner.allows(
+            "rerank", max(DEADLINE_MIN_RERANK_MS, planner.estimate("rerank"))
+        ):
+            timeout_s = rerank_timeout if rerank_timeout is not None else RERANK_TIMEOUT_S
+            remaining = planner.remaining_ms()
+            if remaining is not None and remaining / 1000.0 < timeout_s:
+                # numa sonda o tempo restante pode ser menor que o mínimo útil de um rerank
+                remaining = max(remaining, DEADLINE_MIN_RERANK_MS)
+                planner.degraded.append(f"rerank_timeout:{timeout_s:g}->{remaining / 1000.0:.3f}s")
+                timeout_s = remaining / 1000.0
+            _touch_query_heartbeat(index_paths)
+            r_start = time.perf_counter()
+            try:
+                ranked = _google_rerank(q, docs, top_n=rerank_top_n or len(docs), timeout_s=timeout_s)
+                # em falha/timeout/circuito aberto o reranker devolve a própria lista de entrada
+                rerank_ok = ranked is not docs
+                if ranked:
+                    docs = ranked
+            except Exception as e:
+                debug(f"Rerank (google) falhou: {e}")
+            rerank_s = round(time.perf_counter() - r_start, 4)
+            r_ms = planner.mark("rerank")
+            # só chamadas bem-sucedidas alimentam a estimativa: timeouts/erros/circuito aberto não
+            # refletem o custo do rerank, e acertos do cache de ordens (< 1 ms) também não
+            if rerank_ok and r_ms >= 1.0:
+                planner.observe("rerank", r_ms, probe="rerank" in planner.probes)
+
+        # resultados degradados pelo prazo ou sem o rerank pedido não entram no cache
+        # (a chave descreve a consulta completa)
+        if cache_key is not None and not planner.degraded and (rerank_ok or not rerank_wanted):
+            _SEMANTIC_CACHE.put(cache_key, qvec, docs)
+
+    # Optional aggregated output file (contexto empacotado no orçamento de tokens)
+    pack_stats: Optional[Dict[str, Any]] = None
     if out_file:
         try:
-            _write_aggregated_output(out_file, q, docs)
+            pack_stats = _write_aggregated_output(out_file, q, docs, budget_tokens=context_budget)
         except Exception as e:
             debug(f"Falha ao escrever out-file: {e}")
+        planner.mark("out_file")
+    plan = planner.report()
+    QueryPlanner.save_costs(index_path, force=bool(planner.probes))
+    if plan["degraded"]:
+        debug(f"Prazo de {deadline_ms:g} ms: degradações {', '.join(plan['degraded'])}")
     # métricas de query
     try:
         by_step: Dict[str, int] = {}
@@ -455,6 +2960,8 @@ def query_index(
         _write_metrics({
             "type": "query",
             "index_path": str(index_path),
+            "index_paths": [str(p) for p in index_paths] if federated else None,
+            "generation": generations if federated else generations[0],
             "backend": backend,
             "k": k,
             "fetch_k": fetch_k,
@@ -462,8 +2969,21 @@ def query_index(
             "filter_step": filter_step,
             "filter_rule_type": filter_rule_type,
             "filter_priority": filter_priority,
+            "always_apply": always_apply or None,
+            "applies_to": applies_to,
+            "hierarchical": retrieve_stats.get("hierarchical"),
             "compress": compress,
             "similarity_threshold": similarity_threshold,
+            "rerank_llm": rerank_llm,
+            "rerank_s": rerank_s,
+            "semantic_cache": None if cache_key is None else ("hit" if cache_hit else "miss"),
+            "semantic_cache_stats": None if cache_key is None else _SEMANTIC_CACHE.snapshot(),
+            "context_pack": pack_stats,
+            "deadline_ms": plan["deadline_ms"],
+            "degraded": plan["degraded"] or None,
+            "deadline_probes": plan["probes"] or None,
+            "deadline_missed": plan["missed"] if plan["deadline_ms"] is not None else None,
+            "stages_ms": plan["stages_ms"],
             "duration_s": round(time.perf_counter() - q_start, 4),
             "result_count": len(docs),
             "by_step": by_step,
@@ -505,10 +3025,30 @@ def make_parser() -> argparse.ArgumentParser:
     pb.add_argument("--exclude-dirs", type=str, nargs="*", default=None, help="Pastas a excluir (nomes ou caminhos)")
     pb.add_argument("--ignore-files", type=str, nargs="*", default=None, help="Arquivos de ignore a considerar (ex.: .copilotignore, .cursorignore)")
     pb.add_argument("--include-exts", type=str, nargs="*", default=None, help="Extensões a incluir (ex.: .md .mdc)")
+    pb.add_argument("--backend", type=str, choices=list(BACKENDS), default="auto", help="Backend vetorial (auto: FAISS com fallback para Chroma)")
+    pb.add_argument("--no-dedup", action="store_true", help="Desativar deduplicação de chunks quase idênticos")
+    pb.add_argument("--dedup-distance", type=int, default=DEDUP_HAMMING_DISTANCE, help="Distância de Hamming máx. (SimHash 64 bits, <= 3)")
+    pb.add_argument("--keep-generations", type=int, default=DEFAULT_KEEP_GENERATIONS, help="Gerações anteriores mantidas para rollback")
+    pb.add_argument("--embed-workers", type=int, default=DEFAULT_EMBED_WORKERS, help="Processos de embedding (1 = no próprio processo; 0 = um por núcleo)")
+    pb.add_argument("--build-threads", type=int, default=None, help="Teto de threads do torch durante o embedding (build governado)")
+    pb.add_argument("--nice", type=int, default=0, help="Incremento de niceness do processo de build")
+    pb.add_argument("--ionice-idle", action="store_true", help="Prioridade de I/O ociosa (ionice -c 3)")
+    pb.add_argument("--max-memory-mb", type=float, default=None, help="Teto de memória residente; acima dele o build é abortado")
+    pb.add_argument("--yield-to-queries", action="store_true", help="Pausar o embedding entre lotes enquanto houver consultas ativas")
+    pb.add_argument("--build-batch-size", type=int, default=GOVERNOR_BATCH_SIZE, help="Chunks por lote no build governado")
+    pb.add_argument("--reduce-dim", type=int, default=None, help="Reduzir os vetores do FAISS para esta dimensão (projeção treinada no build)")
+    pb.add_argument("--reduce-method", type=str, choices=list(PROJECTION_METHODS), default="pca", help="Projeção: pca ou random (ortogonal aleatória)")
+    pb.add_argument("--embed-threads", type=int, default=None, help="Threads intra-op por processo de embedding (padrão: núcleos / processos)")
+    pb.add_argument("--group", type=str, default=None, help="Construir todos os índices de um grupo do manifesto")
+    pb.add_argument("--manifest", type=str, default=DEFAULT_GROUPS_MANIFEST, help="Manifesto de grupos de índices (YAML)")
 
     # query
     pq = sub.add_parser("query", help="Consultar índice vetorial")
     pq.add_argument("--index-path", type=str, default=DEFAULT_INDEX_PATH, help="Caminho do índice (pasta)")
+    pq.add_argument("--index-paths", type=str, nargs="+", default=None, help="Vários índices para busca federada (MMR global)")
+    pq.add_argument("--group", type=str, default=None, help="Consultar todos os índices de um grupo do manifesto")
+    pq.add_argument("--manifest", type=str, default=DEFAULT_GROUPS_MANIFEST, help="Manifesto de grupos de índices (YAML)")
+    pq.add_argument("--workers", type=int, default=None, help="Threads para carregar/buscar índices em paralelo")
     pq.add_argument("--q", type=str, required=True, help="Consulta (query)")
     pq.add_argument("--k", type=int, default=6, help="Top-k (MMR)")
     pq.add_argument("--fetch-k", type=int, default=20, help="Fetch_k (MMR)")
@@ -516,6 +3056,10 @@ def make_parser() -> argparse.ArgumentParser:
     pq.add_argument("--filter-step", type=str, default=None, help="Filtrar por step (ex.: step1, step2, step3, step5)")
     pq.add_argument("--filter-rule-type", type=str, default=None, help="Filtrar por rule_type (ex.: always-apply)")
     pq.add_argument("--filter-priority", type=str, default=None, help="Filtrar por priority (ex.: high, normal)")
+    pq.add_argument("--always-apply", action="store_true", help="Apenas regras com alwaysApply no frontmatter")
+    pq.add_argument("--hierarchical", action="store_true", help="Busca hierárquica: arquivos → seções → MMR só nos chunks das seções candidatas")
+    pq.add_argument("--sections", type=int, default=DEFAULT_HIER_SECTIONS, help="Seções candidatas na busca hierárquica")
+    pq.add_argument("--applies-to", type=str, default=None, help="Apenas regras aplicáveis a este arquivo (alwaysApply ou globs do frontmatter)")
     pq.add_argument("--compress", action="store_true", help="Ativar compressão contextual (EmbeddingsFilter)")
     pq.add_argument("--similarity-threshold", type=float, default=0.25, help="Threshold para compressor")
     pq.add_argument("--model", type=str, default=DEFAULT_MODEL, help="Modelo de embeddings")
@@ -527,8 +3071,16 @@ def make_parser() -> argparse.ArgumentParser:
     pq.add_argument("--include-exts", type=str, nargs="*", default=None, help="Extensões a permitir (ex.: .md .mdc)")
     # pós-processamento
     pq.add_argument("--out-file", type=str, default=None, help="Arquivo para salvar o contexto agregado dos resultados")
+    pq.add_argument("--context-budget", type=int, default=DEFAULT_CONTEXT_BUDGET, help="Orçamento de tokens (estimados) do --out-file; 0 = sem limite")
     pq.add_argument("--rerank-llm", type=str, choices=["google"], default=None, help="LLM para reranking opcional")
     pq.add_argument("--rerank-top-n", type=int, default=None, help="Limitar top-N após reranking")
+    pq.add_argument("--semantic-cache", action="store_true", help="Reaproveitar resultados de consultas parafraseadas (cache semântico)")
+    pq.add_argument("--semantic-cache-distance", type=float, default=SEMANTIC_CACHE_DISTANCE, help="Distância de cosseno máx. para acerto no cache")
+    pq.add_argument("--semantic-cache-size", type=int, default=SEMANTIC_CACHE_SIZE, help="Entradas máximas no cache semântico")
+    pq.add_argument("--semantic-cache-policy", type=str, choices=["lru", "lfu"], default="lru", help="Política de despejo do cache semântico")
+    pq.add_argument("--semantic-cache-file", type=str, default=".rag/semantic-cache.json", help="Arquivo de persistência do cache semântico")
+    pq.add_argument("--deadline-ms", type=float, default=None, help="Prazo da consulta em ms: reduz fetch_k e pula compressão/rerank quando o tempo não basta")
+    pq.add_argument("--rerank-timeout", type=float, default=None, help=f"Prazo máximo (s) do reranking remoto (padrão {RERANK_TIMEOUT_S})")
 
     # watch (subcomando)
     pw = sub.add_parser("watch", help="Monitorar alterações e reconstruir índice (polling por mtime)")
@@ -542,68 +3094,145 @@ def make_parser() -> argparse.ArgumentParser:
     pw.add_argument("--exclude-dirs", type=str, nargs="*", default=None, help="Pastas a excluir (nomes ou caminhos)")
     pw.add_argument("--ignore-files", type=str, nargs="*", default=None, help="Arquivos de ignore a considerar")
     pw.add_argument("--include-exts", type=str, nargs="*", default=None, help="Extensões a incluir (ex.: .md .mdc)")
+    pw.add_argument("--backend", type=str, choices=list(BACKENDS), default="auto", help="Backend vetorial (auto: FAISS com fallback para Chroma)")
+    pw.add_argument("--keep-generations", type=int, default=DEFAULT_KEEP_GENERATIONS, help="Gerações anteriores mantidas para rollback")
+    pw.add_argument("--build-threads", type=int, default=None, help="Teto de threads do torch durante o embedding (build governado)")
+    pw.add_argument("--nice", type=int, default=0, help="Incremento de niceness do processo de build")
+    pw.add_argument("--ionice-idle", action="store_true", help="Prioridade de I/O ociosa (ionice -c 3)")
+    pw.add_argument("--max-memory-mb", type=float, default=None, help="Teto de memória residente; acima dele o build é abortado")
+    pw.add_argument("--yield-to-queries", action="store_true", help="Pausar o embedding entre lotes enquanto houver consultas ativas")
+    pw.add_argument("--build-batch-size", type=int, default=GOVERNOR_BATCH_SIZE, help="Chunks por lote no build governado")
+    pw.add_argument("--reduce-dim", type=int, default=None, help="Reduzir os vetores do FAISS para esta dimensão")
+    pw.add_argument("--reduce-method", type=str, choices=list(PROJECTION_METHODS), default="pca", help="Projeção: pca ou random")
     pw.add_argument("--interval", type=float, default=2.0, help="Intervalo de polling em segundos")
     pw.add_argument("--quiet", action="store_true", help="Silenciar logs de varredura sem mudanças")
 
+    # rollback (subcomando)
+    pr = sub.add_parser("rollback", help="Listar gerações do índice ou voltar o ponteiro `current`")
+    pr.add_argument("--index-path", type=str, default=DEFAULT_INDEX_PATH, help="Caminho do índice (pasta)")
+    pr.add_argument("--to", type=str, default=None, help="Geração alvo (padrão: a anterior à atual)")
+    pr.add_argument("--list", action="store_true", help="Apenas listar gerações disponíveis")
+
+    # maintain (subcomando)
+    pm = sub.add_parser("maintain", help="Estatísticas, verificação de integridade e compactação do índice")
+    pm.add_argument("--index-path", type=str, default=DEFAULT_INDEX_PATH, help="Caminho do índice (pasta)")
+    pm.add_argument("--model", type=str, default=DEFAULT_MODEL, help="Modelo de embeddings")
+    pm.add_argument("--root", type=str, default=None, help="Raiz do repositório (detecta chunks de arquivos removidos)")
+    pm.add_argument("--compact", action="store_true", help="Publicar nova geração sem órfãos/duplicatas (online)")
+    pm.add_argument("--keep-generations", type=int, default=DEFAULT_KEEP_GENERATIONS, help="Gerações anteriores mantidas para rollback")
+    pm.add_argument("--json", action="store_true", help="Imprimir o relatório em JSON")
+
     return p
 
 
+def _make_governor(args: argparse.Namespace) -> Optional[BuildGovernor]:
+    """BuildGovernor a partir das flags de build/watch (None se nenhum limite foi pedido)."""
+    if not any([args.build_threads, args.nice, args.ionice_idle, args.max_memory_mb, args.yield_to_queries]):
+        return None
+    return BuildGovernor(
+        threads=args.build_threads,
+        nice=args.nice,
+        ionice_idle=args.ionice_idle,
+        max_memory_mb=args.max_memory_mb,
+        yield_to_queries=args.yield_to_queries,
+        batch_size=args.build_batch_size,
+    )
+
+
+def _resolve_profile(
+    profile: str,
+    root: Path,
+    include_dirs: Optional[List[Any]],
+    include_exts: Optional[Set[str]],
+    ignore_files: Optional[List[Path]],
+    label: Optional[str] = None,
+) -> Tuple[Optional[List[Path]], Optional[Set[str]], List[Path]]:
+    """Aplica os defaults do perfil (auto/vscode/cursor) a include_dirs/include_exts/ignore_files."""
+    include_dirs = [Path(d) for d in include_dirs] if include_dirs else include_dirs
+    ignore_files = list(ignore_files or [])
+    tag = f" ({label})" if label else ""
+
+    # Smart auto detection
+    if profile == "auto":
+        copilot_ign = root / ".copilotignore"
+        cursor_ign = root / ".cursorignore"
+        vscode_dir = root / ".github" / "copilot-rules"
+        cursor_dir = root / ".cursor" / "rules"
+        chosen = None
+        if copilot_ign.exists() and vscode_dir.exists():
+            chosen = "vscode"
+        elif cursor_ign.exists() and cursor_dir.exists():
+            chosen = "cursor"
+        # if both exist, prefer vscode by default
+        if chosen == "vscode":
+            include_dirs = include_dirs or [Path(".github") / "copilot-rules"]
+            include_exts = include_exts or {".md"}
+            if not ignore_files and copilot_ign.exists():
+                ignore_files = [copilot_ign]
+            debug(f"[auto]{tag} Perfil VSCode detectado por .copilotignore e .github/copilot-rules")
+        elif chosen == "cursor":
+            include_dirs = include_dirs or [Path(".cursor") / "rules"]
+            include_exts = include_exts or {".mdc"}
+            if not ignore_files and cursor_ign.exists():
+                ignore_files = [cursor_ign]
+            debug(f"[auto]{tag} Perfil Cursor detectado por .cursorignore e .cursor/rules")
+    elif profile == "vscode":
+        # Defaults VSCode: regras em .github/copilot-rules/*.md e ignora .copilotignore
+        if include_dirs is None:
+            include_dirs = [Path(".github") / "copilot-rules"]
+        if not ignore_files:
+            p = root / ".copilotignore"
+            if p.exists():
+                ignore_files = [p]
+        if include_exts is None:
+            include_exts = {".md"}
+    elif profile == "cursor":
+        # Defaults Cursor: regras em .cursor/rules/*.mdc e ignora .cursorignore
+        if include_dirs is None:
+            include_dirs = [Path(".cursor") / "rules"]
+        if not ignore_files:
+            p = root / ".cursorignore"
+            if p.exists():
+                ignore_files = [p]
+        if include_exts is None:
+            include_exts = {".mdc"}
+    return include_dirs, include_exts, ignore_files
+
+
 def main() -> None:
     args = make_parser().parse_args()
 
     if args.cmd == "build":
+        if getattr(args, "group", None):
+            results = build_index_group(
+                Path(args.manifest),
+                args.group,
+                root=Path(args.root),
+                model_name=args.model,
+                chunk_size=args.chunk_size,
+                chunk_overlap=args.chunk_overlap,
+                backend=args.backend,
+                keep_generations=args.keep_generations,
+                dedup=not args.no_dedup,
+                dedup_distance=args.dedup_distance,
+                embed_workers=args.embed_workers,
+                embed_threads=args.embed_threads,
+                reduce_dim=args.reduce_dim,
+                reduce_method=args.reduce_method,
+                governor=_make_governor(args),
+            )
+            for path, backend, n_chunks in results:
+                debug(f"Build concluído ({path}). Backend: {backend} | Chunks: {n_chunks}")
+            return
         # Resolve perfil
-        profile = getattr(args, "profile", "auto")
-        include_dirs = args.include_dirs
-        include_exts = set(args.include_exts) if args.include_exts else None
+        include_dirs, include_exts, ignore_files = _resolve_profile(
+            getattr(args, "profile", "auto"),
+            Path(args.root),
+            args.include_dirs,
+            set(args.include_exts) if args.include_exts else None,
+            [Path(f) for f in (args.ignore_files or [])],
+        )
         exclude_dirs = set(args.exclude_dirs) if args.exclude_dirs else None
-        ignore_files = [Path(f) for f in (args.ignore_files or [])]
-
-        # Smart auto detection
-        if profile == "auto":
-            root_path = Path(args.root)
-            copilot_ign = root_path / ".copilotignore"
-            cursor_ign = root_path / ".cursorignore"
-            vscode_dir = root_path / ".github" / "copilot-rules"
-            cursor_dir = root_path / ".cursor" / "rules"
-            chosen = None
-            if copilot_ign.exists() and vscode_dir.exists():
-                chosen = "vscode"
-            elif cursor_ign.exists() and cursor_dir.exists():
-                chosen = "cursor"
-            # if both exist, prefer vscode by default
-            if chosen == "vscode":
-                include_dirs = include_dirs or [Path(".github") / "copilot-rules"]
-                include_exts = include_exts or {".md"}
-                if not ignore_files and copilot_ign.exists():
-                    ignore_files = [copilot_ign]
-                debug("[auto] Perfil VSCode detectado por .copilotignore e .github/copilot-rules")
-            elif chosen == "cursor":
-                include_dirs = include_dirs or [Path(".cursor") / "rules"]
-                include_exts = include_exts or {".mdc"}
-                if not ignore_files and cursor_ign.exists():
-                    ignore_files = [cursor_ign]
-                debug("[auto] Perfil Cursor detectado por .cursorignore e .cursor/rules")
-        elif profile == "vscode":
-            # Defaults VSCode: regras em .github/copilot-rules/*.md e ignora .copilotignore
-            if include_dirs is None:
-                include_dirs = [Path(".github") / "copilot-rules"]
-            if not ignore_files:
-                p = Path(args.root) / ".copilotignore"
-                if p.exists():
-                    ignore_files = [p]
-            if include_exts is None:
-                include_exts = {".md"}
-        elif profile == "cursor":
-            # Defaults Cursor: regras em .cursor/rules/*.mdc e ignora .cursorignore
-            if include_dirs is None:
-                include_dirs = [Path(".cursor") / "rules"]
-            if not ignore_files:
-                p = Path(args.root) / ".cursorignore"
-                if p.exists():
-                    ignore_files = [p]
-            if include_exts is None:
-                include_exts = {".mdc"}
 
         backend, n_chunks = build_index(
             root=Path(args.root),
@@ -615,60 +3244,48 @@ def main() -> None:
             exclude_dirs=exclude_dirs,
             include_exts=include_exts,
             ignore_files=ignore_files,
+            backend=args.backend,
+            keep_generations=args.keep_generations,
+            dedup=not args.no_dedup,
+            dedup_distance=args.dedup_distance,
+            embed_workers=args.embed_workers,
+            embed_threads=args.embed_threads,
+            reduce_dim=args.reduce_dim,
+            reduce_method=args.reduce_method,
+            governor=_make_governor(args),
         )
         debug(f"Build concluído. Backend: {backend} | Chunks: {n_chunks}")
     elif args.cmd == "query":
-        # Resolve perfil e filtros
-        profile = getattr(args, "profile", "auto")
+        # Índices: --index-path, --index-paths (federado) ou --group (manifesto)
+        index_paths = [Path(p) for p in (args.index_paths or [])]
+        if getattr(args, "group", None):
+            members = load_index_groups(Path(args.manifest)).get(args.group)
+            if not members:
+                raise SystemExit(f"Grupo '{args.group}' não encontrado em {args.manifest}")
+            index_paths = [Path(m["index_path"]) for m in members]
+        if not index_paths:
+            index_paths = [Path(args.index_path)]
+        federated = len(index_paths) > 1
+
+        # Resolve perfil e filtros (na busca federada, apenas filtros explícitos)
         include_dirs = args.include_dirs
         include_exts = set(args.include_exts) if args.include_exts else None
         exclude_dirs = set(args.exclude_dirs) if args.exclude_dirs else None
         ignore_files = [Path(f) for f in (args.ignore_files or [])]
+        if not federated:
+            include_dirs, include_exts, ignore_files = _resolve_profile(
+                getattr(args, "profile", "auto"), Path(args.root),
+                include_dirs, include_exts, ignore_files, label="query",
+            )
 
-        if profile == "auto":
-            root_path = Path(args.root)
-            copilot_ign = root_path / ".copilotignore"
-            cursor_ign = root_path / ".cursorignore"
-            vscode_dir = root_path / ".github" / "copilot-rules"
-            cursor_dir = root_path / ".cursor" / "rules"
-            chosen = None
-            if copilot_ign.exists() and vscode_dir.exists():
-                chosen = "vscode"
-            elif cursor_ign.exists() and cursor_dir.exists():
-                chosen = "cursor"
-            if chosen == "vscode":
-                include_dirs = include_dirs or [Path(".github") / "copilot-rules"]
-                include_exts = include_exts or {".md"}
-                if not ignore_files and copilot_ign.exists():
-                    ignore_files = [copilot_ign]
-                debug("[auto] (query) Perfil VSCode detectado")
-            elif chosen == "cursor":
-                include_dirs = include_dirs or [Path(".cursor") / "rules"]
-                include_exts = include_exts or {".mdc"}
-                if not ignore_files and cursor_ign.exists():
-                    ignore_files = [cursor_ign]
-                debug("[auto] (query) Perfil Cursor detectado")
-        elif profile == "vscode":
-            if include_dirs is None:
-                include_dirs = [Path(".github") / "copilot-rules"]
-            if not ignore_files:
-                p = Path(args.root) / ".copilotignore"
-                if p.exists():
-                    ignore_files = [p]
-            if include_exts is None:
-                include_exts = {".md"}
-        elif profile == "cursor":
-            if include_dirs is None:
-                include_dirs = [Path(".cursor") / "rules"]
-            if not ignore_files:
-                p = Path(args.root) / ".cursorignore"
-                if p.exists():
-                    ignore_files = [p]
-            if include_exts is None:
-                include_exts = {".mdc"}
-
+        if args.semantic_cache:
+            configure_semantic_cache(
+                max_entries=args.semantic_cache_size,
+                policy=args.semantic_cache_policy,
+                path=Path(args.semantic_cache_file) if args.semantic_cache_file else None,
+            )
         results = query_index(
-            index_path=Path(args.index_path),
+            index_path=index_paths[0],
             q=args.q,
             k=args.k,
             fetch_k=args.fetch_k,
@@ -687,57 +3304,28 @@ def main() -> None:
             out_file=Path(args.out_file) if getattr(args, "out_file", None) else None,
             rerank_llm=getattr(args, "rerank_llm", None),
             rerank_top_n=getattr(args, "rerank_top_n", None),
+            rerank_timeout=getattr(args, "rerank_timeout", None),
+            extra_index_paths=index_paths[1:],
+            max_workers=getattr(args, "workers", None),
+            semantic_cache_distance=args.semantic_cache_distance if args.semantic_cache else None,
+            context_budget=args.context_budget,
+            always_apply=args.always_apply,
+            applies_to=args.applies_to,
+            hierarchical_sections=args.sections if args.hierarchical else None,
+            deadline_ms=args.deadline_ms,
         )
         print_results(results)
     elif args.cmd == "watch":
         # Resolve perfil padrão semelhante ao build
-        profile = getattr(args, "profile", "auto")
-        include_dirs = args.include_dirs
-        include_exts = set(args.include_exts) if args.include_exts else None
+        include_dirs, include_exts, ignore_files = _resolve_profile(
+            getattr(args, "profile", "auto"),
+            Path(args.root),
+            args.include_dirs,
+            set(args.include_exts) if args.include_exts else None,
+            [Path(f) for f in (args.ignore_files or [])],
+            label="watch",
+        )
         exclude_dirs = set(args.exclude_dirs) if args.exclude_dirs else None
-        ignore_files = [Path(f) for f in (args.ignore_files or [])]
-
-        if profile == "auto":
-            root_path = Path(args.root)
-            copilot_ign = root_path / ".copilotignore"
-            cursor_ign = root_path / ".cursorignore"
-            vscode_dir = root_path / ".github" / "copilot-rules"
-            cursor_dir = root_path / ".cursor" / "rules"
-            chosen = None
-            if copilot_ign.exists() and vscode_dir.exists():
-                chosen = "vscode"
-            elif cursor_ign.exists() and cursor_dir.exists():
-                chosen = "cursor"
-            if chosen == "vscode":
-                include_dirs = include_dirs or [Path(".github") / "copilot-rules"]
-                include_exts = include_exts or {".md"}
-                if not ignore_files and copilot_ign.exists():
-                    ignore_files = [copilot_ign]
-                debug("[auto] (watch) Perfil VSCode detectado")
-            elif chosen == "cursor":
-                include_dirs = include_dirs or [Path(".cursor") / "rules"]
-                include_exts = include_exts or {".mdc"}
-                if not ignore_files and cursor_ign.exists():
-                    ignore_files = [cursor_ign]
-                debug("[auto] (watch) Perfil Cursor detectado")
-        elif profile == "vscode":
-            if include_dirs is None:
-                include_dirs = [Path(".github") / "copilot-rules"]
-            if not ignore_files:
-                p = Path(args.root) / ".copilotignore"
-                if p.exists():
-                    ignore_files = [p]
-            if include_exts is None:
-                include_exts = {".md"}
-        elif profile == "cursor":
-            if include_dirs is None:
-                include_dirs = [Path(".cursor") / "rules"]
-            if not ignore_files:
-                p = Path(args.root) / ".cursorignore"
-                if p.exists():
-                    ignore_files = [p]
-            if include_exts is None:
-                include_exts = {".mdc"}
 
         _watch_loop(
             root=Path(args.root),
@@ -751,14 +3339,54 @@ def main() -> None:
             ignore_files=ignore_files,
             interval=args.interval,
             quiet=args.quiet,
+            backend=args.backend,
+            keep_generations=args.keep_generations,
+            reduce_dim=args.reduce_dim,
+            reduce_method=args.reduce_method,
+            governor=_make_governor(args),
         )
+    elif args.cmd == "rollback":
+        index_path = Path(args.index_path)
+        if args.list:
+            current = current_generation(index_path)
+            for g in list_generations(index_path):
+                print(f"{'*' if g == current else ' '} {g}")
+            return
+        rollback_index(index_path, to=args.to)
+    elif args.cmd == "maintain":
+        index_path = Path(args.index_path)
+        root = Path(args.root) if args.root else None
+        report = inspect_index(index_path, model_name=args.model, root=root)
+        compaction: Optional[Dict[str, Any]] = None
+        if args.compact:
+            compaction = compact_index(index_path, model_name=args.model, root=root, keep_generations=args.keep_generations)
+            report = inspect_index(index_path, model_name=args.model, root=root)
+        if args.json:
+            print(json.dumps({**report, "compaction": compaction}, ensure_ascii=False, indent=2))
+        else:
+            print_maintenance_report(report)
+        try:
+            _write_metrics({
+                "type": "maintain",
+                "index_path": str(index_path),
+                "generation": report["generation"],
+                "backend": report["backend"],
+                "vectors": report["vectors"],
+                "bytes_per_vector": report["bytes_per_vector"],
+                "docstore_entries": report["docstore_entries"],
+                "files": report["files"],
+                "problems": report["problems"],
+                "compaction": compaction,
+                "timestamp": time.time(),
+            })
+        except Exception:
+            pass
+        if not report["healthy"]:
+            raise SystemExit(1)
     else:
         raise SystemExit(2)
 
 
-if __name__ == "__main__":
-    main()
-
 # -------------------------- Utilidades internas -------------------------- #
 _METRICS_FILE = ".rag/metrics.jsonl"
 
@@ -803,6 +3431,89 @@ def _snapshot_files(
     return snap
 
 
+def _file_sha1(path: Path) -> str:
+    h = hashlib.sha1()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _watch_fingerprint(**params: Any) -> str:
+    """Hash da configuração que determina o conteúdo do índice (modelo, chunking, backend…)."""
+    norm = {k: sorted(map(str, v)) if isinstance(v, (set, list, tuple)) else v for k, v in params.items()}
+    return hashlib.sha1(json.dumps(norm, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def load_watch_journal(index_path: Path) -> Optional[Dict[str, Any]]:
+    """Journal do watch gravado ao lado do índice (None se ausente, ilegível ou de outra versão)."""
+    try:
+        data = json.loads((index_path / WATCH_JOURNAL_FILE).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("version") != WATCH_JOURNAL_VERSION:
+        return None
+    return data
+
+
+def save_watch_journal(
+    index_path: Path,
+    files: Dict[str, Tuple[float, int, str]],
+    generation: Optional[str],
+    fingerprint: str,
+) -> None:
+    """Grava o journal atomicamente (arquivo temporário + rename)."""
+    data = {
+        "version": WATCH_JOURNAL_VERSION,
+        "generation": generation,
+        "fingerprint": fingerprint,
+        "updated": time.time(),
+        "files": {rel: list(v) for rel, v in sorted(files.items())},
+    }
+    index_path.mkdir(parents=True, exist_ok=True)
+    tmp = index_path / f".{WATCH_JOURNAL_FILE}.{uuid.uuid4().hex[:6]}"
+    try:
+        tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, index_path / WATCH_JOURNAL_FILE)
+    except OSError as e:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+        debug(f"Falha ao gravar journal do watch: {e}")
+
+
+def _journal_diff(
+    root: Path,
+    known: Dict[str, Tuple[float, int, str]],
+    snap: Dict[str, Tuple[float, int]],
+) -> Tuple[Set[str], Set[str], Set[str], Dict[str, Tuple[float, int, str]]]:
+    """Compara o snapshot com o estado indexado: (criados, alterados, removidos, novo estado).
+
+    Só arquivos com mtime/tamanho diferentes são relidos; o hash do conteúdo decide se houve mudança
+    real (ex.: `touch` ou checkout sem alteração não dispara rebuild).
+    """
+    created: Set[str] = set()
+    changed: Set[str] = set()
+    state: Dict[str, Tuple[float, int, str]] = {}
+    for rel, (mtime, size) in snap.items():
+        prev = known.get(rel)
+        if prev is not None and prev[0] == mtime and prev[1] == size:
+            state[rel] = prev
+            continue
+        try:
+            digest = _file_sha1(root / rel)
+        except OSError:
+            continue
+        state[rel] = (mtime, size, digest)
+        if prev is None:
+            created.add(rel)
+        elif prev[2] != digest:
+            changed.add(rel)
+    deleted = set(known) - set(state)
+    return created, changed, deleted, state
+
+
 def _watch_loop(
     root: Path,
     index_path: Path,
@@ -815,22 +3526,77 @@ def _watch_loop(
     ignore_files: Optional[List[Path]],
     interval: float,
     quiet: bool,
+    backend: str = "auto",
+    keep_generations: int = DEFAULT_KEEP_GENERATIONS,
+    reduce_dim: Optional[int] = None,
+    reduce_method: str = "pca",
+    governor: Optional[BuildGovernor] = None,
 ) -> None:
+    """Polling por alterações com journal persistente (`WATCH_JOURNAL_FILE`) ao lado do índice.
+
+    Na inicialização o journal (mtime/tamanho/sha1 por arquivo + geração indexada) é comparado com o
+    disco: se nada mudou enquanto o watch esteve parado não há rebuild; caso contrário só o diff é
+    embutido, reaproveitando os vetores da geração registrada. Journal ausente, de outra configuração
+    ou de outra geração força um rebuild completo.
+    """
     debug(f"Watch iniciado em {root} | index={index_path} | interval={interval}s")
-    last_snap = _snapshot_files(root, include_dirs, exclude_dirs, include_exts, ignore_files)
+    fingerprint = _watch_fingerprint(
+        root=root.resolve(),
+        model=model_name,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        include_dirs=include_dirs,
+        exclude_dirs=exclude_dirs,
+        include_exts=include_exts,
+        ignore_files=ignore_files or [],
+        backend=backend,
+        reduce_dim=reduce_dim,
+        reduce_method=reduce_method,
+    )
+    journal = load_watch_journal(index_path)
+    generation = current_generation(index_path)
+    if journal is None:
+        reason = "journal ausente"
+    elif journal.get("fingerprint") != fingerprint:
+        reason = "configuração alterada"
+    elif not generation or journal.get("generation") != generation:
+        reason = f"geração {generation} difere do journal ({journal.get('generation')})"
+    else:
+        reason = None
+    # estado indexado {rel_path: (mtime, tamanho, sha1)} e a geração que o contém
+    known: Dict[str, Tuple[float, int, str]] = {}
+    indexed_gen: Optional[str] = None
+    if reason is None:
+        known = {rel: (float(v[0]), int(v[1]), str(v[2])) for rel, v in (journal or {}).get("files", {}).items()}
+        indexed_gen = generation
+        debug(f"Journal do watch carregado ({len(known)} arquivos, geração {generation})")
+    else:
+        debug(f"Journal do watch inválido ({reason}) → rebuild completo na inicialização")
+    catch_up = True
     while True:
-        time.sleep(max(0.2, interval))
+        if not catch_up:
+            time.sleep(max(0.2, interval))
         snap = _snapshot_files(root, include_dirs, exclude_dirs, include_exts, ignore_files)
-        if snap != last_snap:
-            created = set(snap) - set(last_snap)
-            deleted = set(last_snap) - set(snap)
-            changed = {
-                k for k in (set(snap) & set(last_snap))
-                if snap[k] != last_snap[k]
-            }
-            debug(f"Mudanças detectadas: +{len(created)} ~{len(changed)} -{len(deleted)} → rebuild")
-            t0 = time.perf_counter()
-            backend, n_chunks = build_index(
+        created, changed, deleted, state = _journal_diff(root, known, snap)
+        full = catch_up and reason is not None
+        if not (created or changed or deleted or full):
+            if state != known:
+                # só mtime mudou (conteúdo idêntico): atualiza o journal sem rebuild
+                save_watch_journal(index_path, state, indexed_gen, fingerprint)
+                known = state
+            if catch_up:
+                debug("Journal em dia com o índice; nenhum rebuild necessário")
+            elif not quiet:
+                debug("Nenhuma mudança…")
+            catch_up = False
+            continue
+        label = "rebuild de recuperação" if catch_up else "rebuild"
+        debug(f"Mudanças detectadas: +{len(created)} ~{len(changed)} -{len(deleted)} → {label}")
+        # vetores só são reaproveitados se ninguém publicou outra geração desde o último build do watch
+        reuse = indexed_gen is not None and current_generation(index_path) == indexed_gen
+        t0 = time.perf_counter()
+        try:
+            used_backend, n_chunks = build_index(
                 root=root,
                 index_path=index_path,
                 model_name=model_name,
@@ -840,82 +3606,482 @@ def _watch_loop(
                 exclude_dirs=exclude_dirs,
                 include_exts=include_exts,
                 ignore_files=ignore_files,
+                backend=backend,
+                keep_generations=keep_generations,
+                reduce_dim=reduce_dim,
+                reduce_method=reduce_method,
+                governor=governor,
+                reuse_vectors=reuse,
             )
+        except BuildAborted as e:
+            # geração atual segue publicada; o journal não avança e a mudança é retentada no próximo ciclo
+            debug(f"{e}; mantendo geração {current_generation(index_path)}")
             _write_metrics({
                 "type": "watch_build",
                 "index_path": str(index_path),
-                "backend": backend,
+                "aborted": str(e),
                 "duration_s": round(time.perf_counter() - t0, 4),
                 "timestamp": time.time(),
-                "created": len(created),
-                "changed": len(changed),
-                "deleted": len(deleted),
             })
-            last_snap = snap
-        elif not quiet:
-            debug("Nenhuma mudança…")
+            catch_up = False
+            continue
+        indexed_gen = current_generation(index_path)
+        save_watch_journal(index_path, state, indexed_gen, fingerprint)
+        _write_metrics({
+            "type": "watch_build",
+            "index_path": str(index_path),
+            "backend": used_backend,
+            "generation": indexed_gen,
+            "catch_up": catch_up,
+            "full": full,
+            "reused_vectors": reuse,
+            "duration_s": round(time.perf_counter() - t0, 4),
+            "timestamp": time.time(),
+            "created": len(created),
+            "changed": len(changed),
+            "deleted": len(deleted),
+        })
+        known = state
+        catch_up = False
+
+
+def _estimate_tokens(text: str) -> int:
+    """Estimativa de tokens (~CONTEXT_CHARS_PER_TOKEN caracteres por token), sem depender de tokenizer."""
+    return max(1, -(-len(text) // CONTEXT_CHARS_PER_TOKEN))
+
 
+def _header_path(meta: Dict[str, Any]) -> str:
+    return " > ".join(str(meta[h]) for h in ("h1", "h2", "h3") if meta.get(h))
 
-def _write_aggregated_output(path: Path, query: str, docs: List[Document], limit_chars: int = 2000) -> None:
+
+def _merge_spans(docs: List[Document]) -> List[Dict[str, Any]]:
+    """Funde chunks sobrepostos/adjacentes do mesmo arquivo e seção usando os offsets armazenados.
+
+    Cada span guarda o texto combinado (sem repetir o overlap), a relevância (melhor posição entre os
+    chunks fundidos) e os metadados do chunk mais relevante. Chunks sem offsets (índices antigos)
+    viram spans isolados; texto contido em outro span do mesmo arquivo é descartado.
+    """
+    spans: List[Dict[str, Any]] = []
+    by_section: Dict[Tuple[str, Any], List[Dict[str, Any]]] = {}
+    n = len(docs)
+    for rank, d in enumerate(docs):
+        text = d.page_content or ""
+        if not text.strip():
+            continue
+        meta = d.metadata
+        fp = str(meta.get("file_path") or meta.get("source") or "")
+        rel = float(n - rank) / n
+        start, end = meta.get("start_index"), meta.get("end_index")
+        span = {
+            "file_path": fp,
+            "section": meta.get("section_index"),
+            "start": start if isinstance(start, int) else None,
+            "end": end if isinstance(end, int) else None,
+            "text": text,
+            "rel": rel,
+            "meta": meta,
+            "chunks": 1,
+        }
+        if span["start"] is None or span["end"] is None or span["section"] is None:
+            spans.append(span)
+            continue
+        by_section.setdefault((fp, span["section"]), []).append(span)
+
+    for group in by_section.values():
+        group.sort(key=lambda s_: s_["start"])
+        cur = group[0]
+        for nxt in group[1:]:
+            if nxt["start"] <= cur["end"]:
+                if nxt["end"] > cur["end"]:
+                    cur["text"] += nxt["text"][cur["end"] - nxt["start"]:]
+                    cur["end"] = nxt["end"]
+                if nxt["rel"] > cur["rel"]:
+                    cur["rel"], cur["meta"] = nxt["rel"], nxt["meta"]
+                cur["chunks"] += nxt["chunks"]
+            else:
+                spans.append(cur)
+                cur = nxt
+        spans.append(cur)
+
+    # texto redundante: spans contidos em outro span do mesmo arquivo
+    kept: List[Dict[str, Any]] = []
+    for sp in sorted(spans, key=lambda s_: -len(s_["text"])):
+        if any(k["file_path"] == sp["file_path"] and sp["text"] in k["text"] for k in kept):
+            continue
+        kept.append(sp)
+    return kept
+
+
+def pack_context(
+    docs: List[Document],
+    budget_tokens: Optional[int] = DEFAULT_CONTEXT_BUDGET,
+    lambda_mult: float = CONTEXT_LAMBDA,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """Seleciona spans (chunks fundidos) por relevância marginal até preencher o orçamento de tokens.
+
+    A cada passo escolhe o span com maior `lambda*relevância - (1-lambda)*redundância` (Jaccard de
+    palavras contra os já escolhidos) que caiba no orçamento; spans quase idênticos aos escolhidos
+    (>= CONTEXT_REDUNDANCY) são descartados e o último pode ser truncado em fim de linha.
+    """
+    spans = _merge_spans(docs)
+    words = [set(re.findall(r"\w+", sp["text"].lower())) for sp in spans]
+    raw_tokens = sum(_estimate_tokens(d.page_content or "") for d in docs)
+    remaining = budget_tokens if budget_tokens and budget_tokens > 0 else None
+    selected: List[int] = []
+    candidates = list(range(len(spans)))
+    truncated = 0
+    while candidates:
+        best, best_score = None, float("-inf")
+        for i in list(candidates):
+            red = max(
+                (len(words[i] & words[j]) / max(1, len(words[i] | words[j])) for j in selected),
+                default=0.0,
+            )
+            if red >= CONTEXT_REDUNDANCY:
+                candidates.remove(i)
+                continue
+            score = lambda_mult * spans[i]["rel"] - (1 - lambda_mult) * red
+            if score > best_score:
+                best, best_score = i, score
+        if best is None:
+            break
+        candidates.remove(best)
+        cost = _estimate_tokens(spans[best]["text"])
+        if remaining is not None and cost > remaining:
+            if remaining < CONTEXT_MIN_TAIL_TOKENS:
+                continue
+            cut = spans[best]["text"][: remaining * CONTEXT_CHARS_PER_TOKEN]
+            spans[best]["text"] = cut[: cut.rfind("\n")] if "\n" in cut else cut
+            cost = _estimate_tokens(spans[best]["text"])
+            truncated += 1
+        selected.append(best)
+        if remaining is not None:
+            remaining -= cost
+
+    chosen = [spans[i] for i in selected]
+    packed_tokens = sum(_estimate_tokens(sp["text"]) for sp in chosen)
+    stats = {
+        "chunks_in": len(docs),
+        "spans": len(spans),
+        "spans_packed": len(chosen),
+        "truncated": truncated,
+        "raw_tokens": raw_tokens,
+        "packed_tokens": packed_tokens,
+        "budget_tokens": budget_tokens or None,
+    }
+    return chosen, stats
+
+
+def _write_aggregated_output(
+    path: Path,
+    query: str,
+    docs: List[Document],
+    budget_tokens: Optional[int] = DEFAULT_CONTEXT_BUDGET,
+) -> Dict[str, Any]:
+    """Grava o contexto empacotado: spans agrupados por arquivo e cabeçalho, em ordem de offset."""
+    spans, stats = pack_context(docs, budget_tokens=budget_tokens)
+    files: "OrderedDict[str, OrderedDict[str, List[Dict[str, Any]]]]" = OrderedDict()
+    # arquivos ordenados pelo span mais relevante; seções e spans em ordem de leitura
+    for sp in sorted(spans, key=lambda s_: -s_["rel"]):
+        files.setdefault(sp["file_path"], OrderedDict()).setdefault(_header_path(sp["meta"]), []).append(sp)
     path.parent.mkdir(parents=True, exist_ok=True)
     with path.open("w", encoding="utf-8") as f:
         f.write(f"# Consulta\n{query}\n\n")
-        for i, d in enumerate(docs, 1):
-            fp = d.metadata.get("file_path")
-            step = d.metadata.get("step")
-            rtype = d.metadata.get("rule_type")
-            pri = d.metadata.get("priority")
+        for i, (fp, sections) in enumerate(files.items(), 1):
+            meta = next(iter(sections.values()))[0]["meta"]
+            step = meta.get("step")
+            rtype = meta.get("rule_type")
+            pri = meta.get("priority")
             f.write(f"## [{i}] {fp} | step={step} | type={rtype} | priority={pri}\n")
-            f.write((d.page_content or "").strip()[:limit_chars])
-            f.write("\n\n")
+            for header, items in sorted(
+                sections.items(),
+                key=lambda kv: min(s_["section"] if s_["section"] is not None else 1 << 30 for s_ in kv[1]),
+            ):
+                if header:
+                    f.write(f"### {header}\n")
+                for sp in sorted(items, key=lambda s_: (s_["section"] or 0, s_["start"] or 0)):
+                    f.write(sp["text"].strip())
+                    f.write("\n\n")
+    return stats
+
+
+# -------------------------- Rerank remoto (Gemini) -------------------------- #
+def _chunk_id(d: Document) -> str:
+    """Identificador estável de um chunk (metadado `chunk_id` ou hash de arquivo + conteúdo)."""
+    cid = d.metadata.get("chunk_id")
+    if cid:
+        return str(cid)
+    fp = str(d.metadata.get("file_path") or d.metadata.get("source") or "")
+    return _chunk_hash(fp, d.page_content or "")
+
+
+def _chunk_hash(file_path: str, text: str) -> str:
+    return hashlib.sha1(f"{file_path}\0{text}".encode("utf-8")).hexdigest()[:16]
+
+
+class _RemoteReranker:
+    """Reranker remoto (Gemini, API REST `generateContent`) com cliente HTTP assíncrono, prazo rígido, circuit breaker e cache.
+
+    - As chamadas síncronas rodam num loop asyncio próprio (thread dedicada), onde o cliente HTTP é reutilizado
+    - Cada chamada respeita `timeout_s` (criação do cliente inclusa); estourado o prazo, a ordem original é mantida
+    - Após `breaker_failures` falhas seguidas o circuito abre por `breaker_cooldown_s`; passado o cooldown
+      (meio-aberto) a próxima chamada é um teste: sucesso fecha o circuito, falha o reabre
+    - A ordem retornada é cacheada (LRU) por consulta + ids dos chunks candidatos
+    - `RAG_RERANK_ENDPOINT` aponta o cliente para outro servidor HTTP (ex.: stand-in local em testes)
+    """
 
+    def __init__(
+        self,
+        model: str = RERANK_MODEL,
+        timeout_s: float = RERANK_TIMEOUT_S,
+        concurrency: int = RERANK_CONCURRENCY,
+        cache_size: int = RERANK_CACHE_SIZE,
+        breaker_failures: int = RERANK_BREAKER_FAILURES,
+        breaker_cooldown_s: float = RERANK_BREAKER_COOLDOWN_S,
+    ) -> None:
+        self.model = model
+        self.timeout_s = timeout_s
+        self.concurrency = max(1, concurrency)
+        self.cache_size = cache_size
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown_s = breaker_cooldown_s
+        self._lock = threading.Lock()
+        # um cliente por loop asyncio: conexões do httpx ficam presas ao loop que as criou
+        self._clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Tuple[Any, Any]]" = weakref.WeakKeyDictionary()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._cache: "OrderedDict[Tuple[str, Tuple[str, ...]], List[str]]" = OrderedDict()
+        self._failures = 0
+        self._open_until = 0.0
+        self.stats: Dict[str, int] = {
+            "calls": 0, "cache_hits": 0, "timeouts": 0, "errors": 0, "short_circuits": 0,
+        }
+
+    def _get_client(self) -> Any:
+        endpoint = os.environ.get("RAG_RERANK_ENDPOINT") or None
+        api_key = os.environ.get("GOOGLE_API_KEY") or None
+        if not api_key and not endpoint:
+            debug("GOOGLE_API_KEY ausente; ignorando rerank")
+            return None
+        loop = asyncio.get_running_loop()
+        key = (endpoint, api_key)
+        with self._lock:
+            cached = self._clients.get(loop)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+            try:
+                import httpx  # type: ignore
+            except Exception as e:
+                debug(f"httpx não disponível: {e}")
+                return None
+            base = endpoint or RERANK_API_URL
+            if "://" not in base:
+                base = f"https://{base}"
+            # o prazo é controlado por asyncio.wait_for; a chave é opcional para stand-ins locais
+            client = httpx.AsyncClient(
+                base_url=base,
+                headers={"x-goog-api-key": api_key} if api_key else {},
+                timeout=None,
+            )
+            self._clients[loop] = (key, client)
+            return client
+
+    async def _generate(self, prompt: str) -> Optional[str]:
+        """Uma chamada `generateContent`; None se não há cliente configurado."""
+        client = self._get_client()
+        if client is None:
+            return None
+        with self._lock:
+            self.stats["calls"] += 1
+        resp = await client.post(
+            f"/v1beta/models/{self.model}:generateContent",
+            json={
+                "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+                "generationConfig": {"temperature": 0.0},
+            },
+        )
+        resp.raise_for_status()
+        candidates = resp.json().get("candidates") or [{}]
+        parts = (candidates[0].get("content") or {}).get("parts") or []
+        return "".join(str(p.get("text", "")) for p in parts)
+
+    def _run(self, coro: Any) -> Any:
+        """Executa `coro` no loop do reranker (criado sob demanda numa thread daemon) e espera o resultado."""
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="rag-rerank", daemon=True).start()
+                self._loop = loop
+            loop = self._loop
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def _breaker_open(self) -> bool:
+        with self._lock:
+            return time.monotonic() < self._open_until
+
+    def _record(self, ok: bool) -> None:
+        with self._lock:
+            if ok:
+                self._failures = 0
+                self._open_until = 0.0
+                return
+            self._failures += 1
+            # cooldown já vencido (meio-aberto): a chamada de teste falhou, reabre sem esperar novas falhas
+            if self._open_until or self._failures >= self.breaker_failures:
+                self._open_until = time.monotonic() + self.breaker_cooldown_s
+                self._failures = 0
+                debug(f"Rerank: circuito aberto por {self.breaker_cooldown_s:.0f}s")
+
+    def _cache_get(self, key: Tuple[str, Tuple[str, ...]]) -> Optional[List[str]]:
+        with self._lock:
+            order = self._cache.get(key)
+            if order is not None:
+                self._cache.move_to_end(key)
+                self.stats["cache_hits"] += 1
+            return order
+
+    def _cache_put(self, key: Tuple[str, Tuple[str, ...]], order: List[str]) -> None:
+        with self._lock:
+            self._cache[key] = order
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    @staticmethod
+    def _prompt(query: str, docs: List[Document]) -> str:
+        items = []
+        for i, d in enumerate(docs, 1):
+            txt = (d.page_content or "").replace("\n", " ")
+            items.append(f"[{i}] {txt[:500]}")
+        return (
+            "Você é um reranker. Ordene por relevância à consulta a lista abaixo e retorne apenas os índices, separados por vírgula.\n"
+            f"Consulta: {query}\n"
+            "Documentos:\n" + "\n".join(items) + "\n"
+            "Responda: 1,5,3...\n"
+        )
 
-def _google_rerank(query: str, docs: List[Document], top_n: int) -> List[Document]:
-    """Reranking simples com Gemini: pede ao modelo para ordenar trechos por relevância.
-    Requer env GOOGLE_API_KEY e langchain-google-genai instalado. Fallback: retorna docs originais."""
-    try:
-        from langchain_google_genai import ChatGoogleGenerativeAI  # type: ignore
-    except Exception as e:
-        debug(f"langchain-google-genai não disponível: {e}")
-        return docs
-    import os
-    api_key = os.environ.get("GOOGLE_API_KEY")
-    if not api_key:
-        debug("GOOGLE_API_KEY ausente; ignorando rerank")
-        return docs
-
-    llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash", temperature=0.0)
-
-    # Monta prompt compacto
-    items = []
-    for i, d in enumerate(docs, 1):
-        txt = (d.page_content or "").replace("\n", " ")
-        items.append(f"[{i}] {txt[:500]}")
-    prompt = (
-        "Você é um reranker. Ordene por relevância à consulta a lista abaixo e retorne apenas os índices, separados por vírgula.\n"
-        f"Consulta: {query}\n"
-        "Documentos:\n" + "\n".join(items) + "\n"
-        "Responda: 1,5,3...\n"
-    )
-    try:
-        resp = llm.invoke(prompt)
-        text = getattr(resp, "content", None) or getattr(resp, "text", "") or str(resp)
-        # extrai números
-        import re
-        idxs = [int(x) for x in re.findall(r"\d+", text)]
-        # mantém ordem única e válida
-        seen = set()
-        order = []
-        for i in idxs:
-            if 1 <= i <= len(docs) and i not in seen:
+    @staticmethod
+    def _parse_order(text: str, n: int) -> List[int]:
+        seen: Set[int] = set()
+        order: List[int] = []
+        for x in re.findall(r"\d+", text):
+            i = int(x)
+            if 1 <= i <= n and i not in seen:
                 seen.add(i)
                 order.append(i)
-        if not order:
-            return docs
-        ordered = [docs[i-1] for i in order]
+        return order
+
+    @staticmethod
+    def _apply(docs: List[Document], order: List[str], top_n: Optional[int]) -> List[Document]:
+        by_id = {_chunk_id(d): d for d in docs}
+        ordered = [by_id[cid] for cid in order if cid in by_id]
         if top_n and top_n > 0:
             ordered = ordered[:top_n]
         return ordered
-    except Exception as e:
-        debug(f"Falha no Gemini rerank: {e}")
-        return docs
+
+    async def arerank(
+        self,
+        query: str,
+        docs: List[Document],
+        top_n: Optional[int] = None,
+        timeout_s: Optional[float] = None,
+        sem: Optional[asyncio.Semaphore] = None,
+    ) -> List[Document]:
+        """Reordena `docs` por relevância; em qualquer falha retorna a própria lista `docs` (mesmo objeto)."""
+        if not docs:
+            return docs
+        ids = tuple(_chunk_id(d) for d in docs)
+        key = (query, ids)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return self._apply(docs, cached, top_n)
+        if self._breaker_open():
+            with self._lock:
+                self.stats["short_circuits"] += 1
+            return docs
+        prompt = self._prompt(query, docs)
+        deadline = self.timeout_s if timeout_s is None else min(timeout_s, self.timeout_s)
+        try:
+            if sem is not None:
+                await sem.acquire()
+            try:
+                text = await asyncio.wait_for(self._generate(prompt), timeout=max(0.0, deadline))
+            finally:
+                if sem is not None:
+                    sem.release()
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.stats["timeouts"] += 1
+            self._record(False)
+            debug(f"Rerank (google) excedeu o prazo de {deadline:.2f}s; mantendo ordem original")
+            return docs
+        except Exception as e:
+            with self._lock:
+                self.stats["errors"] += 1
+            self._record(False)
+            debug(f"Falha no Gemini rerank: {e}")
+            return docs
+        if text is None:
+            return docs
+
+        self._record(True)
+        idxs = self._parse_order(text, len(docs))
+        if not idxs:
+            return docs
+        order = [ids[i - 1] for i in idxs]
+        self._cache_put(key, order)
+        return self._apply(docs, order, top_n)
+
+    async def arerank_many(
+        self,
+        items: List[Tuple[str, List[Document], Optional[int]]],
+        timeout_s: Optional[float] = None,
+    ) -> List[List[Document]]:
+        """Reordena várias consultas em paralelo, limitado a `concurrency` chamadas simultâneas."""
+        sem = asyncio.Semaphore(self.concurrency)
+        return list(await asyncio.gather(*[
+            self.arerank(q, docs, top_n=top_n, timeout_s=timeout_s, sem=sem)
+            for q, docs, top_n in items
+        ]))
+
+    def rerank(
+        self,
+        query: str,
+        docs: List[Document],
+        top_n: Optional[int] = None,
+        timeout_s: Optional[float] = None,
+    ) -> List[Document]:
+        return self._run(self.arerank(query, docs, top_n=top_n, timeout_s=timeout_s))
+
+    def rerank_many(
+        self,
+        items: List[Tuple[str, List[Document], Optional[int]]],
+        timeout_s: Optional[float] = None,
+    ) -> List[List[Document]]:
+        return self._run(self.arerank_many(items, timeout_s=timeout_s))
+
+
+_RERANKER = _RemoteReranker()
+
+
+def _google_rerank(
+    query: str,
+    docs: List[Document],
+    top_n: int,
+    timeout_s: Optional[float] = None,
+) -> List[Document]:
+    """Reranking com Gemini: pede ao modelo para ordenar trechos por relevância.
+    Requer env GOOGLE_API_KEY (ou RAG_RERANK_ENDPOINT) e httpx instalado.
+    Fallback: retorna a própria lista `docs` (a ordem original)."""
+    return _RERANKER.rerank(query, docs, top_n=top_n, timeout_s=timeout_s)
+
+
+def _google_rerank_many(
+    items: List[Tuple[str, List[Document], Optional[int]]],
+    timeout_s: Optional[float] = None,
+) -> List[List[Document]]:
+    """Versão em lote de `_google_rerank`: [(consulta, docs, top_n)] → listas reordenadas."""
+    return _RERANKER.rerank_many(items, timeout_s=timeout_s)
+
+
+if __name__ == "__main__":
+    main()